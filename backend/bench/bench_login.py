@@ -0,0 +1,99 @@
+# backend/bench/bench_login.py
+# 登录吞吐压测：模拟交班时的登录高峰，比较不同 bcrypt 代价、并发上限下的登录速率与延迟，
+# 以及凭刷新令牌续期 (不走 bcrypt) 的速率。
+#
+# 用法:
+#   JWT_SECRET=bench python backend/bench/bench_login.py --rounds 10,11,12 --logins 200 --concurrency 32
+#
+# 只压测 passwords 模块本身 (CPU 密集部分)，不连接数据库；数据库部分见 bench_handlers.py。
+# Lambda 单实例一次只处理一个请求，--slots 对应多线程部署 (backend/service) 时的 PASSWORD_HASH_CONCURRENCY。
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('JWT_SECRET', 'bench-secret-not-for-production-use-0001')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'layers', 'database_utils'))
+import passwords  # noqa: E402
+
+PASSWORD = 'correct horse battery staple'
+
+
+def run(fn, total, concurrency):
+    """并发执行 fn total 次，返回 (每次耗时 ms 列表, 总耗时 s, 被限流次数)。"""
+    latencies, busy = [], [0]
+    lock = threading.Lock()
+
+    def one(_):
+        started = time.perf_counter()
+        try:
+            fn()
+        except passwords.HasherBusy:
+            with lock:
+                busy[0] += 1
+            return
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    return latencies, time.perf_counter() - started, busy[0]
+
+
+def report(label, latencies, wall, busy):
+    if len(latencies) >= 2:
+        q = statistics.quantiles(latencies, n=100)
+        p50, p95, p99 = q[49], q[94], q[98]
+    else:
+        p50 = p95 = p99 = latencies[0] if latencies else 0.0
+    print(f'{label:<28}{len(latencies) / wall:>10.1f}/s{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}{busy:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='登录吞吐压测')
+    parser.add_argument('--rounds', default='10,11,12', help='要比较的 bcrypt 代价，逗号分隔')
+    parser.add_argument('--logins', type=int, default=200, help='每组登录次数')
+    parser.add_argument('--concurrency', type=int, default=32, help='同时发起登录的客户端数')
+    parser.add_argument('--slots', type=int, default=os.cpu_count() or 1, help='哈希并发上限 (信号量大小)')
+    parser.add_argument('--wait', type=float, default=5.0, help='等待哈希槽位的超时 (秒)')
+    parser.add_argument('--refreshes', type=int, default=20000, help='刷新令牌续期次数')
+    args = parser.parse_args()
+
+    passwords._slots = threading.BoundedSemaphore(args.slots)
+    passwords.HASH_WAIT_SECONDS = args.wait
+    print(f'CPU {os.cpu_count()} 核，哈希并发上限 {args.slots}，客户端并发 {args.concurrency}')
+    print(f'{"场景":<28}{"速率":>12}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"限流":>8}')
+
+    for rounds in [int(r) for r in args.rounds.split(',')]:
+        passwords.BCRYPT_ROUNDS = rounds
+        stored = passwords.hash_password(PASSWORD)
+        latencies, wall, busy = run(lambda: passwords.verify_password(PASSWORD, stored), args.logins, args.concurrency)
+        report(f'bcrypt 登录 cost={rounds}', latencies, wall, busy)
+
+    # 代价变更后的首次登录：校验旧哈希 + 按新代价重新哈希
+    rounds = [int(r) for r in args.rounds.split(',')]
+    passwords.BCRYPT_ROUNDS = min(rounds)
+    stored = passwords.hash_password(PASSWORD, rounds=max(rounds))
+    latencies, wall, busy = run(lambda: passwords.verify_password(PASSWORD, stored), max(1, args.logins // 4),
+                                args.concurrency)
+    report(f'rehash cost={max(rounds)}->{min(rounds)}', latencies, wall, busy)
+
+    # 刷新令牌续期：验签 + 指纹比对 + 签发新令牌
+    token = passwords.issue_refresh_token({'user_id': 1, 'tenant_id': 1, 'username': 'bench'}, stored)
+
+    def refresh():
+        claims = passwords.decode_refresh_token(token)
+        passwords.check_password_version(claims, stored)
+        passwords.issue_refresh_token({k: claims[k] for k in ('user_id', 'tenant_id', 'username')}, stored)
+    latencies, wall, busy = run(refresh, args.refreshes, args.concurrency)
+    report('刷新令牌续期', latencies, wall, busy)
+
+
+if __name__ == '__main__':
+    main()
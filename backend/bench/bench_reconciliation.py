@@ -0,0 +1,135 @@
+# backend/bench/bench_reconciliation.py
+# 银行对账匹配压测：生成 10 万行合成对账单与对应的未结清订单，测量解析、建索引、匹配各阶段耗时。
+#
+# 用法:
+#   python backend/bench/bench_reconciliation.py --lines 100000 --format csv
+#
+# 只压测内存中的解析与匹配 (reconciliation.parse_statement / build_index / match_lines)，不连接数据库；
+# 入账走 payments.apply_payments 的批量路径，耗时与行数基本线性，可用 --naive 对比逐行全表扫描的做法。
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+import reconciliation  # noqa: E402
+
+# 每行对账单的生成方式及占比
+MIX = [('reference_exact', 0.4), ('reference_partial', 0.1), ('amount_exact', 0.3),
+       ('amount_tolerance', 0.1), ('noise', 0.1)]
+
+
+def generate(lines, seed):
+    """返回 (open_items, 对账单行)；对账单行顺序打乱，模拟真实文件。"""
+    rng = random.Random(seed)
+    items, statement = [], []
+    start = date(2024, 1, 1)
+    kinds = [k for k, _ in MIX]
+    weights = [w for _, w in MIX]
+    for i in range(lines):
+        kind = rng.choices(kinds, weights)[0]
+        order_type = 'sales' if rng.random() < 0.7 else 'purchase'
+        prefix = 'SO' if order_type == 'sales' else 'PO'
+        # 金额分布在 1 ~ 50000 元之间，包含大量重复金额
+        outstanding = Decimal(rng.randint(100, 5_000_000)) / 100
+        if rng.random() < 0.2:
+            outstanding = Decimal(rng.choice([99, 199, 500, 1000, 2999]))
+        item = {'id': f'order-{i}', 'order_no': f'{prefix}-{i:08d}', 'partner_id': f'partner-{i % 5000}',
+                'type': order_type, 'outstanding': outstanding, 'created_at': start + timedelta(minutes=i)}
+        items.append(item)
+
+        sign = 1 if order_type == 'sales' else -1
+        amount, reference, description = outstanding, '', '转账'
+        if kind == 'reference_exact':
+            reference = item['order_no']
+        elif kind == 'reference_partial':
+            amount = (outstanding / 2).quantize(Decimal('0.01'))
+            description = f'货款 {item["order_no"]} 首付'
+        elif kind == 'amount_tolerance':
+            amount = outstanding - Decimal(rng.randint(1, 80)) / 100  # 扣手续费
+        elif kind == 'noise':
+            amount = Decimal(rng.randint(1, 99)) / 100
+            description = '利息'
+        statement.append((start + timedelta(days=rng.randint(0, 365)), sign * amount, reference, description))
+    rng.shuffle(statement)
+    return items, statement
+
+
+def to_csv(statement):
+    buf = io.StringIO()
+    buf.write('date,amount,reference,description\n')
+    for d, amount, ref, desc in statement:
+        buf.write(f'{d.isoformat()},{amount},{ref},{desc}\n')
+    buf.seek(0)
+    return buf
+
+
+def to_ofx(statement):
+    buf = io.StringIO()
+    buf.write('OFXHEADER:100\n<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>\n')
+    for i, (d, amount, ref, desc) in enumerate(statement):
+        buf.write(f'<STMTTRN>\n<DTPOSTED>{d:%Y%m%d}\n<TRNAMT>{amount}\n<FITID>{i}\n'
+                  f'<REFNUM>{ref}\n<NAME>{desc}\n</STMTTRN>\n')
+    buf.write('</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>\n')
+    buf.seek(0)
+    return buf
+
+
+def naive_match(lines, items):
+    """对照组：每行对账单线性扫描全部订单 (原先的人工对账逻辑)。"""
+    used, matched = set(), 0
+    for line in lines:
+        for item in items:
+            if item['id'] not in used and abs(line['amount']) == item['outstanding']:
+                used.add(item['id'])
+                matched += 1
+                break
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser(description='银行对账匹配压测')
+    parser.add_argument('--lines', type=int, default=100_000)
+    parser.add_argument('--format', choices=['csv', 'ofx'], default='csv')
+    parser.add_argument('--tolerance-cents', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--naive', type=int, default=0, help='对照组：用前 N 行跑逐行全表扫描')
+    args = parser.parse_args()
+
+    items, statement = generate(args.lines, args.seed)
+    stream = to_csv(statement) if args.format == 'csv' else to_ofx(statement)
+    print(f'对账单 {args.lines} 行 ({args.format}, {len(stream.getvalue()) / 1e6:.1f} MB)，未结清订单 {len(items)} 张')
+
+    t0 = time.perf_counter()
+    lines = list(reconciliation.parse_statement(stream, args.format))
+    t1 = time.perf_counter()
+    index = reconciliation.build_index(items)
+    t2 = time.perf_counter()
+    matches, unmatched = reconciliation.match_lines(lines, index, args.tolerance_cents)
+    t3 = time.perf_counter()
+
+    rules = {}
+    for m in matches:
+        rules[m['rule']] = rules.get(m['rule'], 0) + 1
+    print(f'解析   {(t1 - t0) * 1000:8.1f} ms  ({len(lines) / (t1 - t0):,.0f} 行/秒)')
+    print(f'建索引 {(t2 - t1) * 1000:8.1f} ms')
+    print(f'匹配   {(t3 - t2) * 1000:8.1f} ms  ({len(lines) / (t3 - t2):,.0f} 行/秒)')
+    print(f'匹配 {len(matches)} 行，未匹配 {len(unmatched)} 行，规则分布 {rules}')
+
+    if args.naive:
+        sample = lines[:args.naive]
+        t4 = time.perf_counter()
+        naive_match(sample, items)
+        t5 = time.perf_counter()
+        per_line = (t5 - t4) / len(sample)
+        print(f'对照组 (逐行扫描) {len(sample)} 行耗时 {(t5 - t4) * 1000:.1f} ms，'
+              f'推算 {len(lines)} 行约 {per_line * len(lines):.1f} s')
+
+
+if __name__ == '__main__':
+    main()
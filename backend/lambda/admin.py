@@ -1,8 +1,10 @@
 # backend/lambda/admin.py
 # 版本: 2.0 (数据供给API)
 
+import hashlib
 import json
 import os
+import time
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import datetime
@@ -13,6 +15,12 @@ DB_USER = os.environ.get('DB_USER')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
 DB_NAME = os.environ.get('DB_NAME')
 
+# 套餐/行业列表很少变化：进程内缓存已序列化的结果，客户端凭 ETag 重新验证 (未变化时 304)。
+# 修改在 saas_admin 中进行，那里的缓存会立即失效；本进程最迟 REFERENCE_CACHE_TTL 秒后重新读取。
+REFERENCE_CACHE_TTL = float(os.environ.get('REFERENCE_CACHE_TTL', '300'))
+REFERENCE_CACHE_CONTROL = 'public, max-age=60, stale-while-revalidate=300'
+_reference_cache = {}  # table_name -> (过期时间, 响应体, ETag)
+
 def get_db_connection():
     return psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME)
 
@@ -21,14 +29,20 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError(f"Type {type(obj)} not serializable")
 
-def create_response(status_code, body):
+def create_response(status_code, body, payload=None, etag=None, event=None):
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*'
+    }
+    if etag:
+        headers.update({'ETag': etag, 'Cache-Control': REFERENCE_CACHE_CONTROL})
+        if_none_match = {k.lower(): v for k, v in ((event or {}).get('headers') or {}).items()}.get('if-none-match', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return {'statusCode': 304, 'headers': headers, 'body': ''}
     return {
         'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps(body, default=json_serial)
+        'headers': headers,
+        'body': payload if payload is not None else json.dumps(body, default=json_serial)
     }
 
 # --- 主路由: /admin/{resource} ---
@@ -45,26 +59,29 @@ def lambda_handler(event, context):
 
     if method == 'GET':
         if resource == 'plans':
-            return get_plans()
+            return get_plans(event)
         elif resource == 'industries':
-            return get_industries()
+            return get_industries(event)
         # 未来可以扩展其他 admin GET 路由
 
     return create_response(404, {'error': '管理员资源未找到'})
 
 
 # --- API 实现 ---
-def get_plans():
+def get_plans(event=None):
     """获取所有可用的订阅方案列表"""
-    return get_resource_list('public.plans', 'code, name, description')
+    return get_resource_list('public.plans', 'code, name, description', event)
 
-def get_industries():
+def get_industries(event=None):
     """获取所有可选的行业列表"""
-    return get_resource_list('public.industries', 'id, name')
+    return get_resource_list('public.industries', 'id, name', event)
 
 
-def get_resource_list(table_name, columns):
+def get_resource_list(table_name, columns, event=None):
     """通用函数，用于从指定的公共表中获取资源列表"""
+    cached = _reference_cache.get(table_name)
+    if cached and cached[0] > time.monotonic():
+        return create_response(200, None, payload=cached[1], etag=cached[2], event=event)
     conn = None
     try:
         conn = get_db_connection()
@@ -72,7 +89,10 @@ def get_resource_list(table_name, columns):
             # 直接使用字符串格式化是安全的，因为 table_name 和 columns 来自内部代码，不是用户输入
             cur.execute(f"SELECT {columns} FROM {table_name} ORDER BY id ASC;")
             data = cur.fetchall()
-            return create_response(200, data)
+            payload = json.dumps(data, default=json_serial)
+            etag = '"' + hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32] + '"'
+            _reference_cache[table_name] = (time.monotonic() + REFERENCE_CACHE_TTL, payload, etag)
+            return create_response(200, data, payload=payload, etag=etag, event=event)
     except Exception as e:
         print(f"Database error in get_resource_list({table_name}): {e}")
         return create_response(500, {'error': f'获取 {table_name} 列表失败'})
@@ -0,0 +1,109 @@
+# backend/lambda/aging.py
+# 应收 / 应付账龄：按往来单位统计 0-30 / 31-60 / 61-90 / 90+ 天的未清金额。
+#
+# - 一条 SQL 完成：窗口函数按往来单位累计单据金额，已收/已付总额按先进先出冲抵最早的单据，
+#   剩余未清金额再按单据日期距 as_of 的天数分桶。
+#     应收 = 销售单 - 收款 (income)；应付 = 采购单 - 付款 (expense)。
+# - orders / financial_transactions 由所有租户共用，两部分都按 tenant_id 过滤。
+# - 结果按租户缓存在进程内 (AGING_CACHE_TTL 秒)；本进程内的收付款入账会调用 invalidate 立即失效，
+#   其他 Lambda (订单、POS) 的变动在 TTL 到期后体现。
+
+import os
+import threading
+import time
+import uuid
+from datetime import date
+
+CACHE_TTL = int(os.environ.get('AGING_CACHE_TTL', '60'))
+BUCKETS = ('days_0_30', 'days_31_60', 'days_61_90', 'days_90_plus')
+
+# 参数: tenant_id, as_of, tenant_id, as_of, as_of, kind, kind, partner_id, partner_id
+AGING_SQL = """
+WITH documents AS (
+    SELECT o.partner_id, d.kind, o.id AS order_id, o.created_at::date AS doc_date, o.total_amount AS amount,
+           SUM(o.total_amount) OVER (PARTITION BY o.partner_id, d.kind ORDER BY o.created_at, o.id) AS running_due
+    FROM orders o
+    CROSS JOIN LATERAL (SELECT CASE o.type WHEN 'sales' THEN 'receivable' ELSE 'payable' END AS kind) d
+    WHERE o.tenant_id = %s AND o.type IN ('sales', 'purchase') AND o.status <> 'cancelled'
+      AND o.partner_id IS NOT NULL AND o.created_at::date <= %s
+),
+settled AS (
+    SELECT partner_id, CASE type WHEN 'income' THEN 'receivable' ELSE 'payable' END AS kind, SUM(amount) AS paid
+    FROM financial_transactions
+    WHERE tenant_id = %s AND partner_id IS NOT NULL AND type IN ('income', 'expense') AND created_at::date <= %s
+    GROUP BY 1, 2
+),
+open_items AS (
+    -- 已付总额先冲抵最早的单据：单据未清额 = min(金额, max(累计金额 - 已付, 0))
+    SELECT doc.partner_id, doc.kind, %s::date - doc.doc_date AS age,
+           LEAST(doc.amount, GREATEST(doc.running_due - COALESCE(s.paid, 0), 0)) AS open_amount
+    FROM documents doc
+    LEFT JOIN settled s ON s.partner_id = doc.partner_id AND s.kind = doc.kind
+)
+SELECT oi.partner_id, p.name AS partner_name, oi.kind,
+       COALESCE(SUM(oi.open_amount) FILTER (WHERE oi.age <= 30), 0) AS days_0_30,
+       COALESCE(SUM(oi.open_amount) FILTER (WHERE oi.age BETWEEN 31 AND 60), 0) AS days_31_60,
+       COALESCE(SUM(oi.open_amount) FILTER (WHERE oi.age BETWEEN 61 AND 90), 0) AS days_61_90,
+       COALESCE(SUM(oi.open_amount) FILTER (WHERE oi.age > 90), 0) AS days_90_plus,
+       SUM(oi.open_amount) AS total,
+       MAX(oi.age) AS oldest_days,
+       COUNT(*) AS open_documents
+FROM open_items oi
+JOIN partners p ON p.id = oi.partner_id
+WHERE oi.open_amount > 0
+  AND (%s::text IS NULL OR oi.kind = %s)
+  AND (%s::uuid IS NULL OR oi.partner_id = %s::uuid)
+GROUP BY oi.partner_id, p.name, oi.kind
+ORDER BY oi.kind, total DESC
+"""
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class AgingQueryError(ValueError):
+    """查询参数不合法 (as_of 不是日期、partner_id 不是 UUID)，处理函数据此返回 400。"""
+
+
+def invalidate(tenant_id):
+    """清除该租户的全部账龄缓存（收付款入账后调用）。"""
+    with _cache_lock:
+        for key in [k for k in _cache if k[0] == tenant_id]:
+            del _cache[key]
+
+
+def _summarize(rows):
+    totals = {}
+    for row in rows:
+        kind_total = totals.setdefault(row['kind'], dict.fromkeys(BUCKETS + ('total',), 0))
+        for column in BUCKETS + ('total',):
+            kind_total[column] += row[column]
+    return totals
+
+
+def get_aging(cursor, tenant_id, as_of=None, kind=None, partner_id=None, refresh=False):
+    """返回 {'as_of', 'partners': [...], 'totals': {kind: {...}}, 'cached'}。"""
+    as_of = as_of or date.today().isoformat()
+    try:
+        date.fromisoformat(as_of)
+    except ValueError:
+        raise AgingQueryError('as_of 必须为 YYYY-MM-DD 格式的日期') from None
+    if partner_id:
+        try:
+            uuid.UUID(partner_id)
+        except ValueError:
+            raise AgingQueryError('partner_id 不是合法的 UUID') from None
+    key = (tenant_id, as_of, kind, partner_id)
+    now = time.monotonic()
+    if not refresh:
+        with _cache_lock:
+            entry = _cache.get(key)
+        if entry and now - entry[0] < CACHE_TTL:
+            return dict(entry[1], cached=True)
+
+    cursor.execute(AGING_SQL, (tenant_id, as_of, tenant_id, as_of, as_of, kind, kind, partner_id, partner_id))
+    rows = cursor.fetchall()
+    result = {'as_of': as_of, 'partners': rows, 'totals': _summarize(rows)}
+    with _cache_lock:
+        _cache[key] = (now, result)
+    return dict(result, cached=False)
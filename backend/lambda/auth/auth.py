@@ -16,54 +16,101 @@
 
 import json
 import os
-import bcrypt
 import jwt
 import psycopg2
 import psycopg2.extras # 导入DictCursor
-import boto3
 from datetime import datetime, timedelta
 
 # 从 Lambda Layer 导入我们的数据库工具
-from db_utils import build_response, get_public_connection, get_tenant_db_connection
+from db_utils import build_response, instrument, resolve_tenant, run_pooled
+from tracing import span, trace_handler
+from credentials import secrets
+# 业务模块通过 `from auth import authorize, require_permission` 使用权益快照鉴权
+from entitlements import authorize, require_permission  # noqa: F401
+from passwords import (HasherBusy, InvalidRefreshToken, check_password_version, decode_refresh_token,
+                       hash_password, issue_refresh_token, verify_password)
 
 # 全局常量
 JWT_SECRET = os.environ.get("JWT_SECRET")
 SUPER_ADMIN_USERNAME = "superadmin"
 SUPER_ADMIN_SECRET_ARN = os.environ.get("SUPER_ADMIN_SECRET_ARN")
 
-# 初始化 AWS 客户端
-secrets_manager_client = boto3.client('secretsmanager')
+# 超级管理员机密在 Secrets Manager (本地为 credentials.LocalProvider) 中的 ID
+SUPER_ADMIN_SECRET_ID = SUPER_ADMIN_SECRET_ARN or "super-admin"
 
 def get_super_admin_password_hash():
-    """安全地从 AWS Secrets Manager 获取密码，并实现自播种逻辑。"""
+    """从缓存的凭据提供者获取超级管理员密码哈希，并实现自播种逻辑 (明文密码首次使用时哈希后写回)。"""
     try:
-        get_secret_value_response = secrets_manager_client.get_secret_value(
-            SecretId=SUPER_ADMIN_SECRET_ARN
-        )
-        secret_string = get_secret_value_response['SecretString']
-        secret_data = json.loads(secret_string)
+        with span('auth.credentials'):
+            secret_data, _ = secrets().get(SUPER_ADMIN_SECRET_ID)
         password = secret_data['password']
 
         if password.startswith('$2b$'):
             return password.encode('utf-8')
         else:
             print("[INFO] 检测到明文密码，正在执行首次哈希和更新...")
-            plaintext_password = password.encode('utf-8')
-            hashed_password = bcrypt.hashpw(plaintext_password, bcrypt.gensalt())
-            
-            secret_data['password'] = hashed_password.decode('utf-8')
-
-            secrets_manager_client.update_secret(
-                SecretId=SUPER_ADMIN_SECRET_ARN,
-                SecretString=json.dumps(secret_data)
-            )
+            hashed_password = hash_password(password)
+            store_super_admin_password_hash(hashed_password, secret_data)
             print("[SUCCESS] 密码已成功哈希并安全存储。")
-            return hashed_password
+            return hashed_password.encode('utf-8')
 
+    except HasherBusy:
+        raise
     except Exception as e:
         print(f"[FATAL_ERROR] 无法从 Secrets Manager 获取或处理超级管理员密码: {e}")
         return None
 
+def store_super_admin_password_hash(hashed_password, secret_data=None):
+    """把新的哈希写回 Secrets Manager (首次哈希或登录时按新代价重新哈希)，并更新本地缓存。"""
+    if secret_data is None:
+        secret_data, _ = secrets().get(SUPER_ADMIN_SECRET_ID)
+    secret_data['password'] = hashed_password
+    secrets().put(SUPER_ADMIN_SECRET_ID, secret_data)
+
+def super_admin_session(username, password_hash):
+    """签发超级管理员的 access token 与刷新令牌。"""
+    user_object = {
+        "id": "superadmin",
+        "username": username,
+        "is_super_admin": True,
+        "email": "superadmin@internal.system"
+    }
+    payload = {
+        "username": username,
+        "is_super_admin": True,
+        "exp": datetime.utcnow() + timedelta(hours=8) 
+    }
+    with span('auth.jwt_encode'):
+        token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
+        refresh_token = issue_refresh_token({"username": username, "is_super_admin": True}, password_hash)
+    return build_response(200, {"token": token, "refreshToken": refresh_token, "user": user_object})
+
+def tenant_session(user_record, tenant_id, password_hash):
+    """签发租户用户的 access token 与刷新令牌。"""
+    role = (user_record.get("role") or "staff").strip().lower()
+    user_object = {
+        "id": str(user_record["id"]),
+        "username": user_record["name"],
+        "name": user_record["name"],
+        "fullName": user_record.get("name") or user_record["email"],
+        "email": user_record["email"],
+        "role": role if role in ("admin", "sales", "warehouse", "finance") else "staff",
+        "tenant_id": str(tenant_id),
+        "createdAt": user_record["created_at"].isoformat() if user_record.get("created_at") else None,
+    }
+    payload = {
+        "user_id": user_record["id"],
+        "tenant_id": tenant_id,
+        "username": user_record["name"], # [修正] 从 `name` 字段获取用户名
+        "role": role,
+        "exp": datetime.utcnow() + timedelta(hours=24)
+    }
+    with span('auth.jwt_encode'):
+        token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
+        refresh_token = issue_refresh_token(
+            {"user_id": user_record["id"], "tenant_id": tenant_id, "username": user_record["name"]}, password_hash)
+    return build_response(200, {"token": token, "refreshToken": refresh_token, "user": user_object})
+
 def super_admin_login(username, password):
     """处理超级管理员登录逻辑, 返回统一的 {token, user} 对象。"""
     if username != SUPER_ADMIN_USERNAME:
@@ -73,132 +120,139 @@ def super_admin_login(username, password):
     if not password_hash:
         return build_response(500, {"message": "无法验证超级管理员: 内部配置错误"})
 
-    if bcrypt.checkpw(password.encode('utf-8'), password_hash):
-        user_object = {
-            "id": "superadmin",
-            "username": username,
-            "is_super_admin": True,
-            "email": "superadmin@internal.system"
-        }
-        payload = {
-            "username": username,
-            "is_super_admin": True,
-            "exp": datetime.utcnow() + timedelta(hours=8) 
-        }
-        token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
-        return build_response(200, {"token": token, "user": user_object})
+    with span('auth.bcrypt_verify'):
+        is_password_correct, new_hash = verify_password(password, password_hash)
+    if not is_password_correct and secrets().recheck(SUPER_ADMIN_SECRET_ID):
+        # 机密版本已变化 (运维刚轮换过密码)：用新值再校验一次
+        password_hash = get_super_admin_password_hash()
+        if password_hash:
+            with span('auth.bcrypt_verify'):
+                is_password_correct, new_hash = verify_password(password, password_hash)
+    if is_password_correct:
+        if new_hash:
+            # 代价配置已变更：透明地按新代价重新哈希
+            try:
+                store_super_admin_password_hash(new_hash)
+                password_hash = new_hash
+            except Exception as e:
+                print(f"[WARN] 超级管理员密码重新哈希后写回失败: {e}")
+        return super_admin_session(username, password_hash)
     else:
         return build_response(401, {"message": "无效的凭据"})
 
+def _user_query(cur, schema_name, column):
+    """租户 users 表的 schema 限定查询，池中连接无需切换 search_path。"""
+    return f'SELECT * FROM {psycopg2.extensions.quote_ident(schema_name, cur)}."users" WHERE {column} = %s;'
+
 def tenant_user_login(tenant_domain, username, password):
-    """处理租户用户登录逻辑, 使用 name 字段并返回统一的 {token, user} 对象。"""
-    # ==================== [START DEBUG LOGGING] ====================
-    print(f"[DEBUG] tenant_user_login: 收到请求: tenant_domain='{tenant_domain}', username='{username}', password='{password}'")
-    # ===================== [END DEBUG LOGGING] =====================
-    public_conn = None
-    tenant_conn = None
+    """
+    处理租户用户登录逻辑, 使用 name 字段并返回统一的 {token, user} 对象。
+    域名 -> 租户走进程内缓存，用户查询在池中的连接上以 schema 限定方式执行：热容器上一次往返、无握手。
+    """
+    def lookup(conn):
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            tenant = resolve_tenant(cur, tenant_domain)
+            if not tenant or tenant['status'] != 'active':
+                return tenant, None
+            # [修正] 使用 `name` 而非 `username` 进行查询
+            cur.execute(_user_query(cur, tenant['schema_name'], 'name'), (username,))
+            return tenant, cur.fetchone()
+
     try:
-        public_conn = get_public_connection()
-        if not public_conn:
-            # ==================== [START DEBUG LOGGING] ====================
-            print("[ERROR] tenant_user_login: get_public_connection() 返回了 None。")
-            # ===================== [END DEBUG LOGGING] =====================
-            return build_response(503, {"message": "无法连接到认证服务"})
+        tenant, user_record = run_pooled(lookup)
+    except psycopg2.Error as e:
+        print(f"[ERROR] tenant_user_login: 查询租户/用户失败: {e}")
+        return build_response(503, {"message": "无法连接到认证服务"})
 
-        with public_conn.cursor() as cur:
-            cur.execute("SELECT schema_name, id, status FROM public.tenants WHERE domain = %s;", (tenant_domain,))
-            tenant_data = cur.fetchone()
-        
-        if not tenant_data:
-            # ==================== [START DEBUG LOGGING] ====================
-            print(f"[ERROR] tenant_user_login: 在 public.tenants 中未找到域为 '{tenant_domain}' 的租户。")
-            # ===================== [END DEBUG LOGGING] =====================
-            return build_response(404, {"message": f"域为 '{tenant_domain}' 的租户不存在"})
-        
-        schema_name, tenant_id, status = tenant_data
-        # ==================== [START DEBUG LOGGING] ====================
-        print(f"[DEBUG] tenant_user_login: 成功从 public.tenants 获取到租户信息. Schema='{schema_name}', ID='{tenant_id}', 状态='{status}'")
-        # ===================== [END DEBUG LOGGING] =====================
-
-        if status != 'active':
-            # ==================== [START DEBUG LOGGING] ====================
-            print(f"[ERROR] tenant_user_login: 租户 '{tenant_domain}' 状态为 '{status}', 非 'active'。")
-            # ===================== [END DEBUG LOGGING] =====================
-            return build_response(403, {"message": f"租户 '{tenant_domain}' 当前未激活"})
-
-        tenant_conn = get_tenant_db_connection(schema_name)
-        if not tenant_conn:
-             # ==================== [START DEBUG LOGGING] ====================
-             print(f"[ERROR] tenant_user_login: get_tenant_db_connection('{schema_name}') 返回了 None。")
-             # ===================== [END DEBUG LOGGING] =====================
-             return build_response(503, {"message": "无法连接到租户数据库"})
-
-        with tenant_conn.cursor() as cur:
-            cur.execute(f'''SET search_path TO \"{schema_name}\", public;''')
-            # ==================== [START DEBUG LOGGING] ====================
-            print(f"[DEBUG] tenant_user_login: 已为当前连接成功执行 SET search_path TO \"{schema_name}\"。")
-            # ===================== [END DEBUG LOGGING] =====================
-
-        with tenant_conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            # [修正] 使用 `name` 而非 `username` 进行查询
-            cur.execute("SELECT * FROM users WHERE name = %s;", (username,))
-            user_record = cur.fetchone()
-
-        if not user_record:
-            # ==================== [START DEBUG LOGGING] ====================
-            print(f"[ERROR] tenant_user_login: 在 schema '{schema_name}' 中执行查询后，未能找到用户 '{username}'。user_record is None。")
-            # ===================== [END DEBUG LOGGING] =====================
-            return build_response(401, {"message": "无效的凭据"})
-        
-        # ==================== [START DEBUG LOGGING] ====================
-        print(f"[DEBUG] tenant_user_login: 成功找到用户记录: {dict(user_record)}")
-        # ===================== [END DEBUG LOGGING] =====================
-        
-        password_hash = user_record['password_hash']
-        # ==================== [START DEBUG LOGGING] ====================
-        print(f"[DEBUG] tenant_user_login: 用于校验的 password (明文): '{password}'")
-        print(f"[DEBUG] tenant_user_login: 用于校验的 password_hash (来自DB): '{password_hash}'")
-        # ===================== [END DEBUG LOGGING] =====================
-
-        is_password_correct = bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
-        # ==================== [START DEBUG LOGGING] ====================
-        print(f"[DEBUG] tenant_user_login: bcrypt.checkpw 密码比对结果: {is_password_correct}")
-        # ===================== [END DEBUG LOGGING] =====================
-
-        if is_password_correct:
-            role = (user_record.get("role") or "staff").strip().lower()
-            user_object = {
-                "id": str(user_record["id"]),
-                "username": user_record["name"],
-                "name": user_record["name"],
-                "fullName": user_record.get("name") or user_record["email"],
-                "email": user_record["email"],
-                "role": role if role in ("admin", "sales", "warehouse", "finance") else "staff",
-                "tenant_id": str(tenant_id),
-                "createdAt": user_record["created_at"].isoformat() if user_record.get("created_at") else None,
-            }
-            payload = {
-                "user_id": user_record["id"],
-                "tenant_id": tenant_id,
-                "username": user_record["name"], # [修正] 从 `name` 字段获取用户名
-                "exp": datetime.utcnow() + timedelta(hours=24)
-            }
-            token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
-            return build_response(200, {"token": token, "user": user_object})
-        else:
-            return build_response(401, {"message": "无效的凭据"})
+    if not tenant:
+        print(f"[ERROR] tenant_user_login: 在 public.tenants 中未找到域为 '{tenant_domain}' 的租户。")
+        return build_response(404, {"message": f"域为 '{tenant_domain}' 的租户不存在"})
+
+    if tenant['status'] != 'active':
+        print(f"[ERROR] tenant_user_login: 租户 '{tenant_domain}' 状态为 '{tenant['status']}', 非 'active'。")
+        return build_response(403, {"message": f"租户 '{tenant_domain}' 当前未激活"})
+
+    if not user_record:
+        print(f"[ERROR] tenant_user_login: 在 schema '{tenant['schema_name']}' 中未能找到用户 '{username}'。")
+        return build_response(401, {"message": "无效的凭据"})
+
+    password_hash = user_record['password_hash']
+
+    # bcrypt 在归还连接之后进行，不占用池中的连接
+    with span('auth.bcrypt_verify'):
+        is_password_correct, new_hash = verify_password(password, password_hash)
+
+    if not is_password_correct:
+        return build_response(401, {"message": "无效的凭据"})
+
+    if new_hash:
+        # 代价配置已变更：透明地按新代价重新哈希
+        def rehash(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    f'UPDATE {psycopg2.extensions.quote_ident(tenant["schema_name"], cur)}."users" SET password_hash = %s WHERE id = %s;',
+                    (new_hash, user_record["id"]))
+            conn.commit()
+        try:
+            run_pooled(rehash)
+            password_hash = new_hash
+        except psycopg2.Error as e:
+            print(f"[WARN] tenant_user_login: 重新哈希后写回失败: {e}")
+    return tenant_session(user_record, tenant['id'], password_hash)
+
+def refresh_session(refresh_token):
+    """凭刷新令牌换发新的 access token (并轮换刷新令牌)，不做 bcrypt 校验。"""
+    try:
+        claims = decode_refresh_token(refresh_token)
+        if claims.get("is_super_admin"):
+            password_hash = get_super_admin_password_hash()
+            if not password_hash:
+                return build_response(500, {"message": "无法验证超级管理员: 内部配置错误"})
+            try:
+                check_password_version(claims, password_hash)
+            except InvalidRefreshToken:
+                # 缓存的哈希可能落后于其他实例写回的新哈希 (如按新代价重新哈希)
+                if not secrets().recheck(SUPER_ADMIN_SECRET_ID):
+                    raise
+                password_hash = get_super_admin_password_hash()
+                check_password_version(claims, password_hash or b"")
+            return super_admin_session(claims["username"], password_hash)
 
-    finally:
-        if public_conn: public_conn.close()
-        if tenant_conn: tenant_conn.close()
+        def lookup(conn):
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute("SELECT schema_name, status FROM public.tenants WHERE id = %s;", (claims.get("tenant_id"),))
+                tenant_data = cur.fetchone()
+                if not tenant_data or tenant_data['status'] != 'active':
+                    return None
+                cur.execute(_user_query(cur, tenant_data['schema_name'], 'id'), (claims.get("user_id"),))
+                return cur.fetchone() or None
 
+        try:
+            user_record = run_pooled(lookup)
+        except psycopg2.Error as e:
+            print(f"[ERROR] refresh_session: 查询租户/用户失败: {e}")
+            return build_response(503, {"message": "无法连接到认证服务"})
+        if not user_record or user_record.get("is_active") is False:
+            raise InvalidRefreshToken("租户未激活或用户不存在/已停用")
+        check_password_version(claims, user_record["password_hash"])
+        return tenant_session(user_record, claims["tenant_id"], user_record["password_hash"])
+    except InvalidRefreshToken as e:
+        return build_response(401, {"message": f"刷新令牌无效: {e}"})
+
+@instrument
+@trace_handler('auth')
 def handler(event, context):
     """Lambda 函数的主处理程序，采用正确的登录逻辑路由。"""
     try:
-        body = json.loads(event.get('body', '{}'))
+        with span('parse'):
+            body = json.loads(event.get('body', '{}'))
         password = body.get('password')
         username = body.get('username') 
         tenant_domain = body.get('tenantDomain')
+
+        # 0. 凭刷新令牌续期，不需要密码
+        if body.get('refreshToken'):
+            return refresh_session(body['refreshToken'])
         
         # 1. 优先判断是否为超级管理员登录
         if username == SUPER_ADMIN_USERNAME:
@@ -220,6 +274,8 @@ def handler(event, context):
 
     except json.JSONDecodeError:
         return build_response(400, {"message": "无效的 JSON 请求体"})
+    except HasherBusy as e:
+        return build_response(503, {"message": str(e)}, headers={"Retry-After": "1"})
     except Exception as e:
         print(f"[UNEXPECTED_ERROR] 在 handler 中出现意外错误: {e}")
         return build_response(500, {"message": "服务器内部错误"})
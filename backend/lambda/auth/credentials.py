@@ -0,0 +1,211 @@
+# backend/lambda/auth/credentials.py
+# 凭据提供者：统一读取 Secrets Manager 中的机密 (超级管理员密码哈希，以后还有轮换的数据库凭据等)，
+# 在进程内缓存，避免每次登录都发起一次远程调用。
+#
+# - 缓存 SECRET_CACHE_TTL 秒 (默认 300)。剩余有效期不足 SECRET_REFRESH_AHEAD 秒 (默认 60) 时，
+#   本次仍返回缓存值，同时在后台线程刷新，请求路径上不等待远程调用。
+# - 按版本失效：每个缓存条目记录机密的版本 (Secrets Manager 的 VersionId)。校验失败等场景调用 recheck()，
+#   它最多每 SECRET_RECHECK_INTERVAL 秒 (默认 30) 重新拉取一次；版本变化时替换缓存并返回 True，
+#   这样运维轮换密码后无需等 TTL 到期，错误密码也无法把每次请求都变成远程调用。
+# - 刷新失败时继续使用旧值 (最多再用一个 TTL)，Secrets Manager 短暂不可用不影响登录。
+# - 本地/测试替身：CREDENTIALS_PROVIDER=local 时从 LOCAL_SECRETS_FILE (JSON 文件，{机密 ID: {...}})
+#   或 LOCAL_SECRETS (同格式的 JSON 字符串) 读取，写回也落在该文件，不需要 AWS 环境。
+#
+# Lambda 在两次调用之间会冻结进程，后台刷新线程可能在下一次调用时才跑完；期间返回的仍是有效的旧值。
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from tracing import span
+
+SECRET_CACHE_TTL = float(os.environ.get('SECRET_CACHE_TTL', '300'))
+SECRET_REFRESH_AHEAD = float(os.environ.get('SECRET_REFRESH_AHEAD', '60'))
+SECRET_RECHECK_INTERVAL = float(os.environ.get('SECRET_RECHECK_INTERVAL', '30'))
+
+
+class SecretsManagerProvider:
+    """从 AWS Secrets Manager 读写 JSON 机密。"""
+
+    def __init__(self):
+        import boto3
+        self.client = boto3.client('secretsmanager')
+
+    def fetch(self, secret_id):
+        """返回 (机密内容 dict, 版本)。"""
+        with span('credentials.fetch', provider='secretsmanager'):
+            response = self.client.get_secret_value(SecretId=secret_id)
+        return json.loads(response['SecretString']), response.get('VersionId')
+
+    def store(self, secret_id, data):
+        """写入新内容，返回新版本。"""
+        with span('credentials.store', provider='secretsmanager'):
+            response = self.client.update_secret(SecretId=secret_id, SecretString=json.dumps(data))
+        return response.get('VersionId')
+
+
+class LocalProvider:
+    """本地替身：机密来自 JSON 文件或环境变量，版本为内容的哈希。"""
+
+    def __init__(self, path=None, inline=None):
+        self.path = path
+        self.inline = json.loads(inline) if inline else {}
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        return self.inline
+
+    @staticmethod
+    def _version(data):
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def fetch(self, secret_id):
+        with self.lock:
+            secrets = self._load()
+        if secret_id not in secrets:
+            raise KeyError(f'本地机密不存在: {secret_id}')
+        data = secrets[secret_id]
+        return dict(data), self._version(data)
+
+    def store(self, secret_id, data):
+        with self.lock:
+            secrets = dict(self._load())
+            secrets[secret_id] = data
+            if self.path:
+                with open(self.path, 'w', encoding='utf-8') as f:
+                    json.dump(secrets, f, ensure_ascii=False, indent=2)
+            else:
+                self.inline = secrets
+        return self._version(data)
+
+
+class _Entry:
+    __slots__ = ('data', 'version', 'fetched_at', 'expires_at', 'refreshing')
+
+    def __init__(self, data, version, now, ttl):
+        self.data = data
+        self.version = version
+        self.fetched_at = now
+        self.expires_at = now + ttl
+        self.refreshing = False
+
+
+class CachedSecrets:
+    """带 TTL、提前后台刷新与按版本失效的机密缓存。"""
+
+    def __init__(self, provider, ttl=SECRET_CACHE_TTL, refresh_ahead=SECRET_REFRESH_AHEAD,
+                 recheck_interval=SECRET_RECHECK_INTERVAL):
+        self.provider = provider
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl / 2)
+        self.recheck_interval = recheck_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+
+    def _fetch_lock(self, secret_id):
+        with self._lock:
+            return self._fetch_locks.setdefault(secret_id, threading.Lock())
+
+    def _load(self, secret_id):
+        """同步拉取并写入缓存；拉取失败时若有旧值则延长使用，否则抛出。"""
+        with self._fetch_lock(secret_id):
+            now = time.monotonic()
+            entry = self._entries.get(secret_id)
+            if entry and entry.fetched_at > now - 1 and not entry.refreshing:
+                return entry  # 等锁期间已被其他线程刷新
+            try:
+                data, version = self.provider.fetch(secret_id)
+            except Exception as e:
+                if entry is None:
+                    raise
+                print(f"[WARN] credentials: 刷新机密 {secret_id} 失败，继续使用缓存值: {e}")
+                entry.expires_at = now + self.ttl
+                entry.refreshing = False
+                return entry
+            entry = _Entry(data, version, now, self.ttl)
+            with self._lock:
+                self._entries[secret_id] = entry
+            return entry
+
+    def _refresh_in_background(self, secret_id, entry):
+        with self._lock:
+            if entry.refreshing:
+                return
+            entry.refreshing = True
+
+        def run():
+            try:
+                self._load(secret_id)
+            except Exception as e:
+                print(f"[WARN] credentials: 后台刷新机密 {secret_id} 失败: {e}")
+            finally:
+                entry.refreshing = False
+        threading.Thread(target=run, name=f'secret-refresh-{secret_id}', daemon=True).start()
+
+    def get(self, secret_id):
+        """返回 (机密内容 dict 的副本, 版本)。命中缓存时不发起远程调用。"""
+        with self._lock:
+            entry = self._entries.get(secret_id)
+        now = time.monotonic()
+        if entry is None or entry.expires_at <= now:
+            entry = self._load(secret_id)
+        elif entry.expires_at - now <= self.refresh_ahead:
+            self._refresh_in_background(secret_id, entry)
+        return dict(entry.data), entry.version
+
+    def recheck(self, secret_id):
+        """
+        机密可能已在别处变更时调用 (如密码校验失败)。
+        距上次拉取不足 recheck_interval 秒时直接返回 False；否则重新拉取，版本变化时返回 True。
+        """
+        with self._lock:
+            entry = self._entries.get(secret_id)
+        if entry is None:
+            self._load(secret_id)
+            return True
+        if time.monotonic() - entry.fetched_at < self.recheck_interval:
+            return False
+        old_version = entry.version
+        entry.refreshing = True  # 让 _load 跳过“刚刚刷新过”的判断
+        return self._load(secret_id).version != old_version
+
+    def put(self, secret_id, data):
+        """写入新内容并直接更新本地缓存。"""
+        version = self.provider.store(secret_id, data)
+        with self._lock:
+            self._entries[secret_id] = _Entry(dict(data), version, time.monotonic(), self.ttl)
+        return version
+
+    def invalidate(self, secret_id=None, version=None):
+        """丢弃缓存；指定 version 时只在缓存版本与之不同时丢弃。"""
+        with self._lock:
+            if secret_id is None:
+                self._entries.clear()
+            elif version is None or getattr(self._entries.get(secret_id), 'version', version) != version:
+                self._entries.pop(secret_id, None)
+
+
+def default_provider():
+    if os.environ.get('CREDENTIALS_PROVIDER', 'secretsmanager') == 'local':
+        return LocalProvider(os.environ.get('LOCAL_SECRETS_FILE'), os.environ.get('LOCAL_SECRETS'))
+    return SecretsManagerProvider()
+
+
+_secrets = None
+_secrets_lock = threading.Lock()
+
+
+def secrets():
+    """进程内共享的 CachedSecrets (首次使用时创建)。"""
+    global _secrets
+    if _secrets is None:
+        with _secrets_lock:
+            if _secrets is None:
+                _secrets = CachedSecrets(default_provider())
+    return _secrets
@@ -0,0 +1,282 @@
+# backend/lambda/costing.py
+# 库存成本核算：在订单完成时把销售成本固化到 order_items，报表不再关联 products.cost_price。
+#
+# - 入库 (采购完成、销售退货、盘盈) 调用 record_inbound，同时维护:
+#     product_costs: 移动加权平均成本与账面数量；
+#     cost_layers:   先进先出 (FIFO) 成本层。
+# - 出库 (销售完成、采购退货、盘亏) 调用 consume，按 COSTING_METHOD 计算本次出库成本。
+#   出库事务不更新也不锁定 product_costs / cost_layers (热点商品的每笔销售都会争抢这些行)，
+#   只追加一条 cost_consumptions 记录；fold 按商品合并这些记录，扣减账面数量并消耗 FIFO 成本层。
+#   fold 由 fold_handler 定时执行，入库前也会先对该商品执行一次，保证移动平均使用最新的账面数量。
+#   FIFO 成本在出库时按 "成本层 - 尚未合并的消耗" 估算；并发出库可能按同一层计价，层的实际消耗以 fold 为准。
+# - snapshot_order_costs 把每一行的 unit_cost / cost_total 写回 order_items。
+# - rebuild_handler 可按 inventory_logs 的时间顺序重放，重建成本状态。
+
+import json
+import os
+from decimal import Decimal
+
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+import ddl
+
+DB_HOST = os.environ.get('DB_HOST')
+DB_USER = os.environ.get('DB_USER')
+DB_PASSWORD = os.environ.get('DB_PASSWORD')
+DB_NAME = os.environ.get('DB_NAME')
+
+# moving_average (默认) 或 fifo
+COSTING_METHOD = os.environ.get('COSTING_METHOD', 'moving_average')
+
+CREATE_COSTING_TABLES_SQL = """
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS unit_cost NUMERIC(14, 4);
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS cost_total NUMERIC(14, 2);
+ALTER TABLE inventory_logs ADD COLUMN IF NOT EXISTS unit_cost NUMERIC(14, 4);
+CREATE INDEX IF NOT EXISTS idx_order_items_cost ON order_items (order_id) INCLUDE (total_price, cost_total);
+CREATE TABLE IF NOT EXISTS product_costs (
+    product_id UUID PRIMARY KEY,
+    avg_cost NUMERIC(14, 4) NOT NULL DEFAULT 0,
+    on_hand INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS cost_layers (
+    id BIGSERIAL PRIMARY KEY,
+    product_id UUID NOT NULL,
+    unit_cost NUMERIC(14, 4) NOT NULL,
+    remaining_qty INT NOT NULL,
+    received_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_cost_layers_open ON cost_layers (product_id, id) WHERE remaining_qty > 0;
+CREATE TABLE IF NOT EXISTS cost_consumptions (
+    id BIGSERIAL PRIMARY KEY,
+    product_id UUID NOT NULL,
+    quantity INT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_cost_consumptions_product ON cost_consumptions (product_id);
+"""
+
+# 每次 fold 最多处理的商品数
+FOLD_BATCH_SIZE = int(os.environ.get('COST_FOLD_BATCH_SIZE', '500'))
+
+# 按 FIFO 顺序消耗成本层：每层扣减 min(层余量, 本商品消耗总量 - 之前各层余量之和)
+DEPLETE_LAYERS_SQL = """
+WITH v(product_id, quantity) AS (VALUES %s),
+c AS (SELECT l.id, v.quantity,
+             SUM(l.remaining_qty) OVER (PARTITION BY l.product_id ORDER BY l.id) - l.remaining_qty AS before
+      FROM cost_layers l JOIN v ON l.product_id = v.product_id::uuid
+      WHERE l.remaining_qty > 0)
+UPDATE cost_layers l SET remaining_qty = l.remaining_qty - LEAST(l.remaining_qty, c.quantity - c.before)
+FROM c WHERE l.id = c.id AND c.before < c.quantity
+"""
+
+_tables_ready = False
+
+
+def get_db_connection():
+    return psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME)
+
+
+def ensure_tables(cursor):
+    global _tables_ready
+    if not _tables_ready:
+        _tables_ready = ddl.apply(cursor, CREATE_COSTING_TABLES_SQL)
+
+
+def _fallback_cost(cursor, product_id):
+    """没有成本记录时退回商品档案上的 cost_price（仅用于历史数据或首次出库）。"""
+    cursor.execute("SELECT cost_price FROM products WHERE id = %s", (product_id,))
+    row = cursor.fetchone()
+    return Decimal(row['cost_price'] or 0) if row else Decimal(0)
+
+
+def fold(cursor, product_ids=None, batch_size=FOLD_BATCH_SIZE):
+    """把尚未合并的出库消耗并入 product_costs 的账面数量与 FIFO 成本层，返回合并的商品数。"""
+    ensure_tables(cursor)
+    if product_ids is None:
+        cursor.execute("SELECT DISTINCT product_id::text AS product_id FROM cost_consumptions LIMIT %s", (batch_size,))
+        product_ids = [r['product_id'] for r in cursor.fetchall()]
+    product_ids = sorted({str(p) for p in product_ids})
+    if not product_ids:
+        return 0
+    # 同一商品的合并与入库串行 (按商品排序加锁，不会死锁)；出库只追加记录，不受影响
+    cursor.execute(
+        "SELECT pg_advisory_xact_lock(hashtext('cost:' || p)) FROM unnest(%s::text[]) AS p ORDER BY p",
+        (product_ids,))
+    cursor.execute(
+        """DELETE FROM cost_consumptions WHERE product_id = ANY(%s::uuid[])
+           RETURNING product_id::text AS product_id, quantity""",
+        (product_ids,))
+    totals = {}
+    for row in cursor.fetchall():
+        totals[row['product_id']] = totals.get(row['product_id'], 0) + row['quantity']
+    if not totals:
+        return 0
+    values = sorted(totals.items())
+    execute_values(
+        cursor,
+        """UPDATE product_costs SET on_hand = product_costs.on_hand - v.quantity, updated_at = CURRENT_TIMESTAMP
+           FROM (VALUES %s) AS v(product_id, quantity) WHERE product_costs.product_id = v.product_id::uuid""",
+        values, template='(%s, %s::int)')
+    # 无论采用哪种方法都消耗 FIFO 层，保证切换方法后数据仍然一致
+    execute_values(cursor, DEPLETE_LAYERS_SQL, values, template='(%s, %s::int)', page_size=len(values))
+    return len(totals)
+
+
+def record_inbound(cursor, product_id, qty, unit_cost):
+    """入库：更新移动加权平均成本，并追加一个 FIFO 成本层。"""
+    ensure_tables(cursor)
+    if qty <= 0:
+        return
+    unit_cost = Decimal(str(unit_cost if unit_cost is not None else _fallback_cost(cursor, product_id)))
+    # 先合并该商品尚未合并的出库，平均成本按当前账面数量加权
+    fold(cursor, [product_id])
+    cursor.execute(
+        """INSERT INTO product_costs (product_id, avg_cost, on_hand) VALUES (%s, %s, %s)
+           ON CONFLICT (product_id) DO UPDATE SET
+               avg_cost = CASE WHEN product_costs.on_hand <= 0 THEN EXCLUDED.avg_cost
+                               ELSE (product_costs.avg_cost * product_costs.on_hand + EXCLUDED.avg_cost * EXCLUDED.on_hand)
+                                    / (product_costs.on_hand + EXCLUDED.on_hand) END,
+               on_hand = product_costs.on_hand + EXCLUDED.on_hand,
+               updated_at = CURRENT_TIMESTAMP""",
+        (product_id, unit_cost, qty))
+    cursor.execute(
+        "INSERT INTO cost_layers (product_id, unit_cost, remaining_qty) VALUES (%s, %s, %s)",
+        (product_id, unit_cost, qty))
+
+
+def consume(cursor, product_id, qty):
+    """出库：返回本次出库的总成本，并追加一条待合并的消耗记录 (不锁定成本行)。"""
+    ensure_tables(cursor)
+    if qty <= 0:
+        return Decimal(0)
+    cursor.execute("SELECT avg_cost FROM product_costs WHERE product_id = %s", (product_id,))
+    row = cursor.fetchone()
+    avg_cost = Decimal(row['avg_cost']) if row else _fallback_cost(cursor, product_id)
+
+    cost = qty * avg_cost
+    if COSTING_METHOD == 'fifo':
+        # 跳过尚未合并的消耗已占用的部分，从下一层开始计价
+        cursor.execute(
+            """SELECT unit_cost, remaining_qty,
+                      (SELECT COALESCE(SUM(quantity), 0) FROM cost_consumptions WHERE product_id = %s) AS pending
+               FROM cost_layers WHERE product_id = %s AND remaining_qty > 0 ORDER BY id""",
+            (product_id, product_id))
+        skip, remaining, cost = None, qty, Decimal(0)
+        for layer in cursor.fetchall():
+            if skip is None:
+                skip = layer['pending']
+            used = min(skip, layer['remaining_qty'])
+            skip -= used
+            take = min(layer['remaining_qty'] - used, remaining)
+            cost += take * Decimal(layer['unit_cost'])
+            remaining -= take
+            if remaining == 0:
+                break
+        # 成本层不足（历史库存未建层）的部分按平均成本计
+        cost += remaining * avg_cost
+
+    cursor.execute("INSERT INTO cost_consumptions (product_id, quantity) VALUES (%s, %s)", (product_id, qty))
+    return cost
+
+
+def record_adjustment(cursor, product_id, change_qty):
+    """盘点/手工调整：盘盈按当前平均成本入账，盘亏按出库消耗。"""
+    ensure_tables(cursor)
+    if change_qty > 0:
+        cursor.execute("SELECT avg_cost FROM product_costs WHERE product_id = %s", (product_id,))
+        row = cursor.fetchone()
+        record_inbound(cursor, product_id, change_qty, row['avg_cost'] if row else None)
+    elif change_qty < 0:
+        consume(cursor, product_id, -change_qty)
+
+
+def snapshot_order_costs(cursor, order_id):
+    """计算订单每一行的出库成本并写入 order_items.unit_cost / cost_total，返回订单总成本。"""
+    ensure_tables(cursor)
+    cursor.execute("SELECT id, product_id, quantity FROM order_items WHERE order_id = %s ORDER BY id", (order_id,))
+    rows, total = [], Decimal(0)
+    for item in cursor.fetchall():
+        cost = consume(cursor, item['product_id'], item['quantity'])
+        unit_cost = (cost / item['quantity']) if item['quantity'] else Decimal(0)
+        rows.append((item['id'], unit_cost, cost))
+        total += cost
+    if rows:
+        execute_values(
+            cursor,
+            """UPDATE order_items SET unit_cost = v.unit_cost::numeric, cost_total = v.cost_total::numeric
+               FROM (VALUES %s) AS v(id, unit_cost, cost_total) WHERE order_items.id = v.id""",
+            rows)
+    return total
+
+
+def rebuild(cursor, product_ids=None):
+    """清空成本状态后按 inventory_logs 的先后顺序重放（入库需带 unit_cost，缺失时按档案成本）。"""
+    ensure_tables(cursor)
+    product_filter = " WHERE product_id = ANY(%s::uuid[])" if product_ids else ""
+    params = ([str(p) for p in product_ids],) if product_ids else ()
+    cursor.execute("DELETE FROM product_costs" + product_filter, params)
+    cursor.execute("DELETE FROM cost_layers" + product_filter, params)
+    cursor.execute("DELETE FROM cost_consumptions" + product_filter, params)
+    cursor.execute(
+        "SELECT product_id, change_qty, unit_cost, type FROM inventory_logs" + product_filter + " ORDER BY created_at, id",
+        params)
+    replayed = 0
+    for log in cursor.fetchall():
+        # 调拨不改变成本
+        if log['type'] in ('transfer_in', 'transfer_out'):
+            continue
+        if log['change_qty'] > 0:
+            record_inbound(cursor, log['product_id'], log['change_qty'], log['unit_cost'])
+        elif log['change_qty'] < 0:
+            consume(cursor, log['product_id'], -log['change_qty'])
+        replayed += 1
+    # 重放产生的出库消耗在同一事务内合并完
+    if product_ids:
+        fold(cursor, product_ids)
+    else:
+        while fold(cursor):
+            pass
+    return replayed
+
+
+def fold_handler(event, context):
+    """定时任务入口：分批合并出库消耗，每批单独提交，直到没有待合并的记录或接近 Lambda 超时。"""
+    batch_size = int((event or {}).get('batch_size') or FOLD_BATCH_SIZE)
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    folded = 0
+    try:
+        while True:
+            if context and hasattr(context, 'get_remaining_time_in_millis') and context.get_remaining_time_in_millis() < 5000:
+                break
+            products = fold(cursor, batch_size=batch_size)
+            conn.commit()
+            folded += products
+            if products == 0:
+                break
+        return {'statusCode': 200, 'body': json.dumps({'folded_products': folded})}
+    except (Exception, psycopg2.Error) as error:
+        conn.rollback()
+        return {'statusCode': 500, 'body': json.dumps({'error': f'成本合并失败: {error}'})}
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def rebuild_handler(event, context):
+    """成本重建任务入口: event = { product_ids? }。"""
+    event = event or {}
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        replayed = rebuild(cursor, event.get('product_ids'))
+        conn.commit()
+        return {'statusCode': 200, 'body': json.dumps({'replayed_logs': replayed, 'method': COSTING_METHOD})}
+    except (Exception, psycopg2.Error) as error:
+        conn.rollback()
+        return {'statusCode': 500, 'body': json.dumps({'error': f'成本重建失败: {error}'})}
+    finally:
+        cursor.close()
+        conn.close()
@@ -10,6 +10,9 @@ import os
 import psycopg2
 import logging
 
+# 数据生成器位于 DatabaseUtilsLayer
+from datagen import generate as generate_synthetic_data
+
 # 配置日志
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -29,6 +32,8 @@ def handler(event, context):
     apply_seed = event.get('apply_seed', False)
     if apply_seed:
         logger.info("检测到 apply_seed=true，将对所有已定义租户强制应用种子数据。")
+    # 可选：在种子数据之后追加合成的规模测试数据，如 {"skus": 20000, "days": 365, "orders_per_day": 2000}
+    synthetic = event.get('synthetic')
 
     conn = None
     try:
@@ -107,6 +112,9 @@ def handler(event, context):
                 cur.execute(f"SET search_path TO \"{schema_name}\", public;")
                 cur.execute(seed_sql)
                 logger.info(f"种子数据已成功填充到 '{schema_name}'。")
+                if synthetic:
+                    result = generate_synthetic_data(conn, schema_name, layout='tenant', log=logger.info, **synthetic)
+                    logger.info(f"合成数据已写入 '{schema_name}': {result['rows']}")
 
             logger.info("所有租户处理完毕，提交事务。")
             conn.commit()
@@ -293,3 +293,13 @@ BEGIN
         INSERT INTO public.industry_demo_products (industry_id, sku, name, specs, unit, base_price, cost_price) VALUES (i_其他, 'SAMPLE-000', '示例商品', '通用', '件', 99.00, 50.00);
     END IF;
 END $$;
+
+-- ========= 租户每日用量 (metering 在进程内累加后批量 upsert；ai_calls 受 plans.ai_calls_per_day 限制) =========
+CREATE TABLE IF NOT EXISTS public.tenant_usage_daily (
+    tenant_id INT NOT NULL REFERENCES public.tenants(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    metric VARCHAR(50) NOT NULL,
+    count BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (tenant_id, day, metric)
+);
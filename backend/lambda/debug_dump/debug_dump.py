@@ -1,98 +1,262 @@
-
 # backend/lambda/debug_dump/debug_dump.py
-# 一个临时的、不安全的调试工具，用于转储数据库中的所有数据到日志中。
+# 数据库诊断快照：每个 schema 的表行数、占用空间以及少量抽样行，用于快速查看健康状况。
+#
+# - 不再读取全表：行数取统计信息 (pg_class.reltuples / pg_stat_user_tables)，可选精确计数；
+#   抽样每表最多 MAX_SAMPLE_ROWS 行，敏感列打码。
+# - 多个 schema 由小线程池并行处理，每个线程使用自己的只读连接，互不阻塞。
+# - 硬性预算：总耗时 (time_budget_seconds，同时作为每条语句的 statement_timeout)
+#   与抽样数据大小 (memory_budget_mb)，超出后停止抽样/放弃剩余 schema 并在结果中标注。
+# - 每张表处理完即以单行 JSON 写入日志，日志侧可边跑边看。
+# - 整个快照占用一个报表通道槽位 (admission.report_lane)，与租户报表共享有界并发，不会挤占 POS 等交互请求。
 
-import os
-import psycopg2
-import logging
 import json
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import psycopg2
 from psycopg2.extras import RealDictCursor
 
 # 借用现有的工具层
-from db_utils import get_public_connection, build_response, CustomEncoder
+from db_utils import get_public_connection, build_response, CustomEncoder, instrument
+from admission import Throttled, report_lane
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+DEFAULT_SAMPLE_ROWS = 5
+MAX_SAMPLE_ROWS = 50
+DEFAULT_WORKERS = 4
+MAX_WORKERS = 8
+DEFAULT_TIME_BUDGET = 20.0      # 秒
+DEFAULT_MEMORY_BUDGET_MB = 16   # 抽样数据总大小上限
+SENSITIVE_COLUMNS = ('password', 'password_hash', 'token', 'secret', 'refresh_token')
+
+TABLE_STATS_SQL = """
+SELECT c.relname AS table_name,
+       GREATEST(c.reltuples, 0)::bigint AS estimated_rows,
+       s.n_live_tup AS live_rows, s.n_dead_tup AS dead_rows,
+       pg_total_relation_size(c.oid) AS total_bytes,
+       pg_relation_size(c.oid) AS table_bytes,
+       pg_indexes_size(c.oid) AS index_bytes,
+       s.last_autovacuum, s.last_autoanalyze
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+WHERE n.nspname = %s AND c.relkind IN ('r', 'p')
+ORDER BY c.relname
+"""
+
+
+class _Budget:
+    """跨线程共享的时间与抽样大小预算。"""
+
+    def __init__(self, seconds, memory_bytes):
+        self.deadline = time.monotonic() + seconds
+        self.memory_left = memory_bytes
+        self.lock = threading.Lock()
+        self.memory_exhausted = False
+        self.cancelled = False
+        self.connections = set()
+
+    def remaining_ms(self):
+        return 0 if self.cancelled else max(0, int((self.deadline - time.monotonic()) * 1000))
+
+    def track(self, conn):
+        """登记工作线程的连接；预算已被取消时返回 False，调用方应立即放弃。"""
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.connections.add(conn)
+            return True
+
+    def untrack(self, conn):
+        with self.lock:
+            self.connections.discard(conn)
+
+    def cancel(self):
+        """超时后中止所有仍在执行的语句，让工作线程尽快退出。"""
+        with self.lock:
+            self.cancelled = True
+            connections = list(self.connections)
+        for conn in connections:
+            try:
+                conn.cancel()
+            except Exception as e:
+                logger.warning(f"[DebugSnapshot] cancel failed: {e}")
+
+    def reserve(self, size):
+        with self.lock:
+            if size > self.memory_left:
+                self.memory_exhausted = True
+                return False
+            self.memory_left -= size
+            return True
+
+
+def _mask(row):
+    return {k: ('***' if k in SENSITIVE_COLUMNS and v is not None else v) for k, v in row.items()}
+
+
+def _snapshot_schema(schema, options, budget):
+    """在独立连接上收集一个 schema 的快照。"""
+    result = {'schema': schema, 'tables': [], 'status': 'ok'}
+    conn = get_public_connection()
+    if not conn:
+        result['status'] = 'connection_failed'
+        return result
+    if not budget.track(conn):
+        conn.close()
+        result['status'] = 'timeout'
+        return result
+    try:
+        conn.set_session(readonly=True, autocommit=True)
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SET statement_timeout = %s", (max(budget.remaining_ms(), 1),))
+            cur.execute(TABLE_STATS_SQL, (schema,))
+            tables = cur.fetchall()
+            for stats in tables:
+                if budget.remaining_ms() == 0:
+                    result['status'] = 'timeout'
+                    break
+                table = stats['table_name']
+                ident = f"{psycopg2.extensions.quote_ident(schema, cur)}.{psycopg2.extensions.quote_ident(table, cur)}"
+                entry = dict(stats)
+                try:
+                    cur.execute("SET statement_timeout = %s", (max(budget.remaining_ms(), 1),))
+                    if options['exact_counts']:
+                        cur.execute(f"SELECT COUNT(*) AS n FROM {ident}")
+                        entry['exact_rows'] = cur.fetchone()['n']
+                    if options['sample_rows'] and not budget.memory_exhausted:
+                        cur.execute(f"SELECT * FROM {ident} LIMIT %s", (options['sample_rows'],))
+                        sample = [_mask(r) for r in cur.fetchall()]
+                        encoded = json.dumps(sample, cls=CustomEncoder, ensure_ascii=False)
+                        if budget.reserve(len(encoded.encode('utf-8'))):
+                            entry['sample'] = sample
+                        else:
+                            entry['sample_skipped'] = 'memory_budget'
+                except psycopg2.Error as e:
+                    entry['error'] = str(e).strip()
+                # 单行日志，不缩进
+                logger.info(json.dumps({'schema': schema, **{k: v for k, v in entry.items() if k != 'sample'},
+                                        'sample_rows': len(entry.get('sample', []))}, cls=CustomEncoder, ensure_ascii=False))
+                result['tables'].append(entry)
+    except psycopg2.Error as e:
+        result['status'] = 'error'
+        result['error'] = str(e).strip()
+    finally:
+        budget.untrack(conn)
+        conn.close()
+    return result
+
+
+def _number(params, name, default, parse):
+    """解析数值参数；不是有限数值时抛出 ValueError，由 handler 返回 400。"""
+    value = params.get(name, default)
+    try:
+        number = parse(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} 必须为数值: {value!r}") from None
+    if not math.isfinite(number):
+        raise ValueError(f"{name} 必须为有限数值: {value!r}")
+    return number
+
+
+def _options(event):
+    params = {**(event.get('queryStringParameters') or {}), **{k: v for k, v in event.items() if k != 'queryStringParameters'}}
+    as_bool = lambda v: str(v).lower() in ('1', 'true', 'yes')
+    return {
+        'sample_rows': max(0, min(_number(params, 'sample_rows', DEFAULT_SAMPLE_ROWS, int), MAX_SAMPLE_ROWS)),
+        'workers': max(1, min(_number(params, 'workers', DEFAULT_WORKERS, int), MAX_WORKERS)),
+        'time_budget': _number(params, 'time_budget_seconds', DEFAULT_TIME_BUDGET, float),
+        'memory_budget': int(_number(params, 'memory_budget_mb', DEFAULT_MEMORY_BUDGET_MB, float) * 1024 * 1024),
+        'exact_counts': as_bool(params.get('exact_counts', False)),
+        'schemas': [s for s in str(params.get('schemas', '')).split(',') if s],
+    }
+
+
+@instrument
 def handler(event, context):
+    """在报表通道中执行诊断快照；参数不合法时返回 400，通道繁忙时返回 429。"""
+    try:
+        options = _options(event or {})
+    except ValueError as e:
+        return build_response(400, {"message": str(e)})
+    lane_conn = get_public_connection()
+    if not lane_conn:
+        logger.error("Database connection failed.")
+        return build_response(503, {"message": "Database connection failed"})
+    try:
+        with report_lane(lane_conn, 0):
+            return _snapshot(options, context)
+    except Throttled as e:
+        return build_response(429, {"message": str(e)}, headers={'Retry-After': str(e.retry_after)})
+    finally:
+        lane_conn.close()
+
+
+def _snapshot(options, context):
     """
-    主处理函数：连接数据库，获取所有schema，然后转储每个schema下所有表的内容。
+    返回各 schema 的诊断快照。
+    options 由 _options 解析 (query string 或直接调用的 event): sample_rows, workers, time_budget_seconds,
+    memory_budget_mb, exact_counts, schemas
     """
-    logger.info("!!!!!! [DebugDbDumpFunction] START: THIS IS AN INSECURE DEBUG FUNCTION. !!!!!!")
-    conn = None
-    all_data_for_response = {} # 用于API响应的聚合数据
-    
-    try:
-        # 使用公共连接（通常是超级用户），以确保有足够权限读取所有内容
-        conn = get_public_connection()
-        if not conn:
-            # 如果没有连接，则记录错误并返回
-            logger.error("Database connection failed.")
-            return build_response(503, {"message": "Database connection failed"})
+    # 不超过 Lambda 剩余时间 (留 3 秒用于组装响应)
+    if context and hasattr(context, 'get_remaining_time_in_millis'):
+        options['time_budget'] = min(options['time_budget'], context.get_remaining_time_in_millis() / 1000.0 - 3)
+    budget = _Budget(max(options['time_budget'], 1.0), options['memory_budget'])
+    started = time.monotonic()
+    logger.info(f"[DebugSnapshot] START options={options}")
 
+    conn = get_public_connection()
+    if not conn:
+        logger.error("Database connection failed.")
+        return build_response(503, {"message": "Database connection failed"})
+    try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # 1. 获取所有租户的 schema 名称
-            logger.info("Step 1: Fetching all tenant schemas from public.tenants...")
-            cur.execute("SELECT name, schema_name FROM public.tenants;")
+            cur.execute("SET statement_timeout = %s", (max(budget.remaining_ms(), 1),))
+            cur.execute("SELECT name, schema_name FROM public.tenants")
             tenants = cur.fetchall()
-            tenant_schemas = [row['schema_name'] for row in tenants if row.get('schema_name')]
-            logger.info(f"Found tenant schemas: {tenant_schemas}")
-            
-            # 将 'public' schema 和所有租户 schema 合并为一个列表
-            schemas_to_dump = ['public'] + tenant_schemas
-            logger.info(f"Total schemas to dump: {schemas_to_dump}")
-            all_data_for_response['schemas_found'] = schemas_to_dump
-            all_data_for_response['tenants_public_data'] = tenants
-
-            # 2. 遍历每一个 schema
-            for schema in schemas_to_dump:
-                all_data_for_response[schema] = {}
-                logger.info(f"========== Dumping Schema: {schema} ==========")
-
-                # 获取当前 schema 下的所有表名
-                cur.execute("""
-                    SELECT table_name 
-                    FROM information_schema.tables 
-                    WHERE table_schema = %s;
-                """, (schema,))
-                
-                tables = [row['table_name'] for row in cur.fetchall()]
-                if not tables:
-                    logger.warning(f"No tables found in schema '{schema}'.")
-                    continue
-                
-                logger.info(f"Found tables in '{schema}': {tables}")
-
-                # 3. 遍历并转储每一个表的内容
-                for table in tables:
-                    # 使用安全的方式引用表名，避免SQL注入
-                    table_fqn = psycopg2.extensions.quote_ident(table, cur)
-                    schema_fqn = psycopg2.extensions.quote_ident(schema, cur)
-                    
-                    logger.info(f"----- Dumping Table: {schema}.{table} -----")
-                    try:
-                        cur.execute(f"SELECT * FROM {schema_fqn}.{table_fqn};")
-                        table_content = cur.fetchall()
-                        
-                        # 为了方便在日志中阅读，将内容格式化为 JSON 并打印
-                        pretty_json = json.dumps(table_content, indent=2, cls=CustomEncoder, ensure_ascii=False)
-                        logger.info(pretty_json)
-                        
-                        all_data_for_response[schema][table] = table_content
-
-                    except Exception as e:
-                        error_message = f"Could not dump table {schema}.{table}. Reason: {e}"
-                        logger.error(error_message)
-                        all_data_for_response[schema][table] = {"error": error_message}
-
-        logger.info("!!!!!! [DebugDbDumpFunction] END: All requested schemas and tables have been processed. !!!!!!")
-        # 虽然主要目的是打印日志，但也将数据返回给API调用者，方便直接查看
-        return build_response(200, all_data_for_response, encoder=CustomEncoder)
-
-    except (Exception, psycopg2.Error) as e:
-        logger.error(f"A critical error occurred: {e}", exc_info=True)
+            cur.execute("SELECT pg_database_size(current_database()) AS database_bytes")
+            database_bytes = cur.fetchone()['database_bytes']
+    except psycopg2.Error as e:
+        logger.error(f"Failed to list tenants: {e}")
         return build_response(500, {"message": f"A critical error occurred: {str(e)}"})
     finally:
-        if conn:
-            conn.close()
-            logger.info("Database connection closed.")
+        conn.close()
+
+    schemas = ['public'] + [t['schema_name'] for t in tenants if t.get('schema_name')]
+    if options['schemas']:
+        schemas = [s for s in schemas if s in options['schemas']]
+
+    results = {}
+    pool = ThreadPoolExecutor(max_workers=options['workers'])
+    futures = {pool.submit(_snapshot_schema, schema, options, budget): schema for schema in schemas}
+    done, pending = wait(futures, timeout=budget.remaining_ms() / 1000.0 + 1)
+    for future in done:
+        results[futures[future]] = future.result()
+    if pending:
+        # 超时：取消尚未开始的 schema，并中止仍在执行的语句；等线程退出 (连接已关闭) 后再返回，
+        # 避免常驻服务中遗留占用连接的线程
+        for future in pending:
+            future.cancel()
+        budget.cancel()
+    pool.shutdown(wait=True)
+    for future in pending:
+        if future.cancelled():
+            results[futures[future]] = {'schema': futures[future], 'status': 'timeout', 'tables': []}
+        else:
+            results[futures[future]] = {**future.result(), 'status': 'timeout'}
+
+    elapsed = round(time.monotonic() - started, 3)
+    logger.info(f"[DebugSnapshot] END schemas={len(schemas)} elapsed={elapsed}s memory_exhausted={budget.memory_exhausted}")
+    return build_response(200, {
+        'database_bytes': database_bytes,
+        'tenants': tenants,
+        'schemas': [results[s] for s in schemas],
+        'elapsed_seconds': elapsed,
+        'budget': {'time_seconds': options['time_budget'], 'memory_bytes': options['memory_budget'],
+                   'memory_exhausted': budget.memory_exhausted},
+    }, encoder=CustomEncoder)
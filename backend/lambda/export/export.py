@@ -0,0 +1,380 @@
+# backend/lambda/export/export.py
+# 面向数仓的批量导出：逐个租户 schema，把业务表流式写成列式文件 (Parquet / Arrow) 或 gzip CSV。
+#
+# - 服务器端命名游标 (named cursor) 分批读取，每批 EXPORT_BATCH_SIZE 行，内存占用与表大小无关。
+# - 增量导出：public.export_watermarks 记录每个 (schema, 表) 上次导出的时间水位，
+#   本次只导出 (上次水位, 本次水位] 之间的行；本次水位 = 开始时间 - EXPORT_WATERMARK_LAG 秒，
+#   给仍在进行中的事务留出提交时间。没有时间列的明细表 (order_items) 通过父表 (orders) 的时间列筛选。
+# - 输出位置可插拔：本地目录 (LocalFileSink，本地调试/测试用) 或 S3 (S3Sink)。
+#   调用方可以指定 sink，但只能是 EXPORT_SINK 本身或其下的子前缀 / 子目录；
+#   tables / schemas 只取 EXPORT_TABLES 与已登记租户 schema 中的项。
+# - pyarrow 为可选依赖，未安装时只能导出 csv。
+
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import tempfile
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor
+
+from db_utils import get_public_connection, build_response, CustomEncoder, instrument
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - 取决于部署包
+    pa = None
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '10000'))
+WATERMARK_LAG_SECONDS = int(os.environ.get('EXPORT_WATERMARK_LAG', '60'))
+DEFAULT_FORMAT = os.environ.get('EXPORT_FORMAT', 'parquet')
+DEFAULT_SINK = os.environ.get('EXPORT_SINK', '/tmp/exports')
+
+# 导出的表及增量方式；watermark 为 None 时自动选择 updated_at / created_at，
+# parent = (父表, 外键列)，用父表的时间列筛选。schema 中不存在的表会被跳过。
+EXPORT_TABLES = {
+    'orders': {},
+    'order_items': {'parent': ('orders', 'order_id')},
+    'inventory_movements': {},
+    'inventory_logs': {},
+    'financial_transactions': {},
+}
+
+FORMATS = {'parquet': 'parquet', 'arrow': 'arrow', 'csv': 'csv.gz'}
+
+CREATE_WATERMARK_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS public.export_watermarks (
+    schema_name VARCHAR(63) NOT NULL,
+    table_name VARCHAR(63) NOT NULL,
+    watermark_column VARCHAR(63),
+    last_value TIMESTAMP WITH TIME ZONE,
+    last_run_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    rows_exported BIGINT NOT NULL DEFAULT 0,
+    object_key TEXT,
+    PRIMARY KEY (schema_name, table_name)
+);
+"""
+
+
+class ExportError(Exception):
+    """导出参数不合法或缺少依赖。"""
+
+
+# --- 输出位置 ---
+
+class LocalFileSink:
+    """写入本地目录，用于本地调试与测试。"""
+
+    def __init__(self, root):
+        self.root = root
+
+    @contextmanager
+    def open(self, key):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + '.partial'
+        with open(partial, 'wb') as f:
+            yield f
+        os.replace(partial, path)  # 写完才出现正式文件名，下游不会读到半个文件
+
+    def uri(self, key):
+        return os.path.join(self.root, key)
+
+
+class S3Sink:
+    """先写入 Lambda 的 /tmp 临时文件，完成后分段上传到 S3。"""
+
+    def __init__(self, bucket, prefix=''):
+        import boto3
+        self.client = boto3.client('s3')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    @contextmanager
+    def open(self, key):
+        with tempfile.NamedTemporaryFile(dir=os.environ.get('EXPORT_TMP_DIR', '/tmp'), delete=True) as f:
+            yield f
+            f.flush()
+            self.client.upload_file(f.name, self.bucket, self._key(key))
+
+    def uri(self, key):
+        return f"s3://{self.bucket}/{self._key(key)}"
+
+
+def get_sink(target):
+    """s3://bucket/prefix -> S3Sink；其他视为本地目录 (可带 file:// 前缀)。"""
+    if target.startswith('s3://'):
+        bucket, _, prefix = target[5:].partition('/')
+        return S3Sink(bucket, prefix)
+    if target.startswith('file://'):
+        target = target[7:]
+    return LocalFileSink(target)
+
+
+def resolve_sink(requested=None):
+    """调用方指定的 sink 必须位于 EXPORT_SINK 之下 (同一 bucket 的子前缀，或本地子目录)，否则抛出 ExportError。"""
+    if not requested or requested == DEFAULT_SINK:
+        return get_sink(DEFAULT_SINK)
+    if DEFAULT_SINK.startswith('s3://'):
+        base_bucket, _, base_prefix = DEFAULT_SINK[5:].partition('/')
+        bucket, _, prefix = requested[5:].partition('/') if requested.startswith('s3://') else ('', '', '')
+        base_prefix, prefix = base_prefix.strip('/'), prefix.strip('/')
+        allowed = (bucket == base_bucket and '..' not in prefix.split('/')
+                   and (not base_prefix or prefix == base_prefix or prefix.startswith(base_prefix + '/')))
+    else:
+        local = lambda target: os.path.realpath(target[7:] if target.startswith('file://') else target)
+        root = local(DEFAULT_SINK)
+        allowed = not requested.startswith('s3://') and os.path.commonpath([root, local(requested)]) == root
+    if not allowed:
+        raise ExportError(f'sink 必须位于 {DEFAULT_SINK} 之下')
+    return get_sink(requested)
+
+
+# --- 文件写入 ---
+
+def _arrow_type(column):
+    data_type = column['data_type']
+    if data_type in ('smallint', 'integer'):
+        return pa.int32()
+    if data_type == 'bigint':
+        return pa.int64()
+    if data_type == 'numeric' and column['numeric_precision']:
+        return pa.decimal128(min(column['numeric_precision'], 38), column['numeric_scale'] or 0)
+    if data_type in ('real', 'double precision'):
+        return pa.float64()
+    if data_type == 'boolean':
+        return pa.bool_()
+    if data_type == 'date':
+        return pa.date32()
+    if data_type == 'timestamp with time zone':
+        return pa.timestamp('us', tz='UTC')
+    if data_type == 'timestamp without time zone':
+        return pa.timestamp('us')
+    return pa.string()  # uuid / text / varchar / json / 不限精度的 numeric
+
+
+def _to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, cls=CustomEncoder, ensure_ascii=False)
+    return str(value)
+
+
+class _ColumnarWriter:
+    def __init__(self, fileobj, columns, fmt):
+        if pa is None:
+            raise ExportError(f'导出 {fmt} 需要安装 pyarrow')
+        self.names = [c['column_name'] for c in columns]
+        self.schema = pa.schema([(c['column_name'], _arrow_type(c)) for c in columns])
+        self.text_columns = {i for i, f in enumerate(self.schema) if f.type == pa.string()}
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(fileobj, self.schema, compression='zstd')
+        else:
+            self.writer = pa_ipc.new_file(fileobj, self.schema)
+
+    def write(self, rows):
+        arrays = []
+        for i, (name, field) in enumerate(zip(self.names, self.schema)):
+            values = [r[name] for r in rows]
+            if i in self.text_columns:
+                values = [_to_text(v) for v in values]
+            arrays.append(pa.array(values, type=field.type))
+        self.writer.write_batch(pa.record_batch(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class _CsvWriter:
+    def __init__(self, fileobj, columns, fmt):
+        self.names = [c['column_name'] for c in columns]
+        self.gz = gzip.GzipFile(fileobj=fileobj, mode='wb')
+        self.text = io.TextIOWrapper(self.gz, encoding='utf-8', newline='')
+        self.csv = csv.writer(self.text)
+        self.csv.writerow(self.names)
+
+    def write(self, rows):
+        self.csv.writerows([[_csv_value(r[n]) for n in self.names] for r in rows])
+
+    def close(self):
+        self.text.flush()
+        self.text.detach()
+        self.gz.close()
+
+
+def _csv_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, cls=CustomEncoder, ensure_ascii=False)
+    if isinstance(value, Decimal):
+        return format(value, 'f')
+    return value
+
+
+def _open_writer(fileobj, columns, fmt):
+    return _CsvWriter(fileobj, columns, fmt) if fmt == 'csv' else _ColumnarWriter(fileobj, columns, fmt)
+
+
+# --- 导出 ---
+
+def _table_columns(cur, schema, table):
+    cur.execute(
+        """SELECT column_name, data_type, numeric_precision, numeric_scale FROM information_schema.columns
+           WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position""",
+        (schema, table))
+    return cur.fetchall()
+
+
+def _watermark_column(columns):
+    names = {c['column_name'] for c in columns}
+    for candidate in ('updated_at', 'created_at'):
+        if candidate in names:
+            return candidate
+    return None
+
+
+def _build_query(schema, table, spec, columns, parent_columns, since, until):
+    """返回 (sql.Composed, params, 水位列描述)。"""
+    base = sql.SQL("SELECT t.* FROM {}.{} t").format(sql.Identifier(schema), sql.Identifier(table))
+    if 'parent' in spec and parent_columns is not None:
+        parent, fk = spec['parent']
+        column = _watermark_column(parent_columns)
+        if not column:
+            return base, [], None
+        query = base + sql.SQL(" JOIN {}.{} p ON p.id = t.{} WHERE p.{} <= %s").format(
+            sql.Identifier(schema), sql.Identifier(parent), sql.Identifier(fk), sql.Identifier(column))
+        params = [until]
+        if since:
+            query += sql.SQL(" AND p.{} > %s").format(sql.Identifier(column))
+            params.append(since)
+        return query, params, f"{parent}.{column}"
+
+    column = spec.get('watermark') or _watermark_column(columns)
+    if not column:
+        return base, [], None
+    query = base + sql.SQL(" WHERE t.{} <= %s").format(sql.Identifier(column))
+    params = [until]
+    if since:
+        query += sql.SQL(" AND t.{} > %s").format(sql.Identifier(column))
+        params.append(since)
+    return query, params, column
+
+
+def export_table(conn, sink, schema, table, fmt, run_id, until, full=False):
+    """导出单个表；成功后推进水位并提交。返回导出结果字典，表不存在时返回 None。"""
+    spec = EXPORT_TABLES.get(table, {})
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        columns = _table_columns(cur, schema, table)
+        if not columns:
+            return None
+        parent_columns = _table_columns(cur, schema, spec['parent'][0]) if 'parent' in spec else None
+        cur.execute(
+            "SELECT last_value FROM public.export_watermarks WHERE schema_name = %s AND table_name = %s",
+            (schema, table))
+        row = cur.fetchone()
+        since = None if full or not row else row['last_value']
+
+    query, params, watermark = _build_query(schema, table, spec, columns, parent_columns, since, until)
+    key = f"{schema}/{table}/dt={until:%Y-%m-%d}/{table}-{run_id}.{FORMATS[fmt]}"
+    rows = 0
+    with sink.open(key) as f:
+        writer = _open_writer(f, columns, fmt)
+        # 命名游标 = 服务器端游标，每次只取一批
+        with conn.cursor(name=f"export_{table}_{run_id[:8]}", cursor_factory=RealDictCursor) as cur:
+            cur.itersize = BATCH_SIZE
+            cur.execute(query, params)
+            while True:
+                batch = cur.fetchmany(BATCH_SIZE)
+                if not batch:
+                    break
+                writer.write(batch)
+                rows += len(batch)
+        writer.close()
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """INSERT INTO public.export_watermarks (schema_name, table_name, watermark_column, last_value, rows_exported, object_key)
+               VALUES (%s, %s, %s, %s, %s, %s)
+               ON CONFLICT (schema_name, table_name) DO UPDATE SET
+                   watermark_column = EXCLUDED.watermark_column, last_value = EXCLUDED.last_value,
+                   last_run_at = CURRENT_TIMESTAMP, rows_exported = EXCLUDED.rows_exported, object_key = EXCLUDED.object_key""",
+            (schema, table, watermark, until if watermark else None, rows, sink.uri(key)))
+    conn.commit()
+    logger.info(f"[EXPORT] {schema}.{table}: {rows} 行 -> {sink.uri(key)} (水位 {watermark}: {since} ~ {until})")
+    return {'schema': schema, 'table': table, 'rows': rows, 'object': sink.uri(key),
+            'incremental': bool(since), 'watermark_column': watermark}
+
+
+def run_export(conn, sink, schemas, tables, fmt, full=False):
+    if fmt not in FORMATS:
+        raise ExportError(f'不支持的导出格式: {fmt}')
+    with conn.cursor() as cur:
+        cur.execute(CREATE_WATERMARK_TABLE_SQL)
+        cur.execute("SELECT now() - make_interval(secs => %s)", (WATERMARK_LAG_SECONDS,))
+        until = cur.fetchone()[0].astimezone(timezone.utc)
+    conn.commit()
+
+    run_id = uuid.uuid4().hex
+    results = []
+    for schema in schemas:
+        for table in tables:
+            try:
+                result = export_table(conn, sink, schema, table, fmt, run_id, until, full)
+                if result:
+                    results.append(result)
+            except (ExportError, OSError, psycopg2.Error) as e:
+                conn.rollback()
+                logger.error(f"[EXPORT_ERROR] {schema}.{table}: {e}")
+                results.append({'schema': schema, 'table': table, 'error': str(e)})
+    return {'run_id': run_id, 'until': until, 'format': fmt, 'tables': results}
+
+
+@instrument
+def handler(event, context):
+    """
+    导出入口 (定时任务或手动调用)。
+    event: { schemas?: [...], tables?: [...], format?: parquet|arrow|csv, full?: bool, sink?: 's3://bucket/prefix' | 本地目录 }
+    """
+    event = event or {}
+    if isinstance(event.get('body'), str):  # 经 API 调用时参数在 body 中
+        event = json.loads(event['body'] or '{}')
+    conn = get_public_connection()
+    if not conn:
+        return build_response(503, {"message": "Database connection failed"})
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT schema_name FROM public.tenants WHERE schema_name IS NOT NULL ORDER BY schema_name")
+            tenant_schemas = [r[0] for r in cur.fetchall()]
+        # 只导出已登记的租户 schema 与 EXPORT_TABLES 中的表
+        schemas = [s for s in event['schemas'] if s in tenant_schemas] if event.get('schemas') else tenant_schemas
+        tables = [t for t in event['tables'] if t in EXPORT_TABLES] if event.get('tables') else list(EXPORT_TABLES)
+        if event.get('tables') and not tables:
+            raise ExportError(f"tables 须为 {', '.join(EXPORT_TABLES)} 中的表")
+        sink = resolve_sink(event.get('sink'))
+        summary = run_export(conn, sink, schemas, tables, event.get('format') or DEFAULT_FORMAT, bool(event.get('full')))
+        return build_response(200, summary, encoder=CustomEncoder)
+    except ExportError as e:
+        return build_response(400, {"message": str(e)})
+    except (Exception, psycopg2.Error) as e:
+        logger.error(f"[EXPORT_ERROR] 导出失败: {e}", exc_info=True)
+        return build_response(500, {"message": f"导出失败: {e}"})
+    finally:
+        conn.close()
@@ -1,8 +1,13 @@
 
+import base64
+import io
 import json
 import os
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from aging import AgingQueryError, get_aging, invalidate as invalidate_aging
+from payments import PaymentValidationError, apply_payments
+from reconciliation import DEFAULT_TOLERANCE_CENTS, StatementFormatError, reconcile
 
 # 数据库连接信息
 DB_HOST = os.environ.get('DB_HOST')
@@ -20,16 +25,21 @@ def lambda_handler(event, context):
     method = event.get('httpMethod')
     path_parts = path.strip('/').split('/')
     body = json.loads(event.get('body', '{}'))
-    query_params = event.get('queryStringParameters', {})
+    query_params = event.get('queryStringParameters') or {}
+    tenant_id = event.get('requestContext', {}).get('authorizer', {}).get('tenant_id')
 
-    # 路由: /finance/invoices, /finance/transactions
+    # 路由: /finance/invoices, /finance/transactions, /finance/transactions/import, /finance/reconcile, /finance/aging
     router = path_parts[1] if len(path_parts) > 1 else ''
     entity_id = path_parts[2] if len(path_parts) > 2 else None
 
     if router == 'invoices':
         return handle_invoices(method, entity_id, body, query_params)
     elif router == 'transactions':
-        return handle_transactions(method, entity_id, body, query_params)
+        return handle_transactions(method, entity_id, body, query_params, tenant_id)
+    elif router == 'reconcile' and method == 'POST':
+        return handle_reconcile(body, tenant_id)
+    elif router == 'aging' and method == 'GET':
+        return handle_aging(query_params, tenant_id)
 
     return {'statusCode': 404, 'body': json.dumps({'error': '财务资源未找到'})}
 
@@ -86,7 +96,7 @@ def handle_invoices(method, invoice_id, body, query_params):
         cursor.close()
         conn.close()
 
-def handle_transactions(method, transaction_id, body, query_params):
+def handle_transactions(method, transaction_id, body, query_params, tenant_id=None):
     """处理财务流水（收付款）的CRUD操作。"""
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -108,45 +118,88 @@ def handle_transactions(method, transaction_id, body, query_params):
             transactions = cursor.fetchall()
             return {'statusCode': 200, 'body': json.dumps(transactions, default=str)}
 
+        elif method == 'POST' and transaction_id == 'import':
+            # 批量导入银行流水: body: { lines: [{ partner_id, order_id, type, amount, payment_method, description }] }
+            # 整批在一个事务中按集合方式入账，任一行不合法则整批拒绝
+            transactions, orders = apply_payments(cursor, body.get('lines', []), tenant_id)
+            conn.commit()
+            invalidate_aging(tenant_id)
+            return {'statusCode': 201, 'body': json.dumps({'imported': len(transactions), 'orders': orders}, default=str)}
+
         elif method == 'POST':
             # body: { partner_id, order_id, type, amount, payment_method, description }
-            keys = ['partner_id', 'order_id', 'type', 'amount', 'payment_method', 'description']
-            values = [body.get(k) for k in keys]
-
-            # 1. 插入财务流水记录
-            cursor.execute(
-                """INSERT INTO financial_transactions (partner_id, order_id, type, amount, payment_method, description)
-                   VALUES (%s, %s, %s, %s, %s, %s) RETURNING *""",
-                values
-            )
-            new_transaction = cursor.fetchone()
-            
-            # 2. [核心] 更新订单的支付状态和客户/供应商的余额
-            amount = body.get('amount', 0)
-            # 如果是收款(income)，则减少伙伴欠款；如果是付款(expense)，则增加伙伴欠款
-            balance_change = -amount if body.get('type') == 'income' else amount
-            cursor.execute("UPDATE partners SET balance = balance + %s WHERE id = %s", (balance_change, body.get('partner_id')))
-
-            # 3. 更新订单支付状态 (简单逻辑：任何一笔收款/付款都标记为'partial', 金额足够则'paid')
-            order_id = body.get('order_id')
-            if order_id:
-                cursor.execute("SELECT total_amount FROM orders WHERE id = %s", (order_id,))
-                order_total = cursor.fetchone()['total_amount']
-                cursor.execute("SELECT SUM(amount) FROM financial_transactions WHERE order_id = %s", (order_id,))
-                paid_total = cursor.fetchone()['sum'] or 0
-                
-                payment_status = 'partial'
-                if paid_total >= order_total:
-                    payment_status = 'paid'
-                
-                cursor.execute("UPDATE orders SET payment_status = %s WHERE id = %s", (payment_status, order_id))
+            # 写入流水，并在同一批语句中累加订单已付金额 (推导支付状态) 与往来单位余额，见 payments
+            transactions, _ = apply_payments(cursor, [body], tenant_id)
+            new_transaction = transactions[0]
 
             conn.commit()
+            invalidate_aging(tenant_id)
             return {'statusCode': 201, 'body': json.dumps(new_transaction, default=str)}
 
+    except PaymentValidationError as error:
+        conn.rollback()
+        return {'statusCode': 400, 'body': json.dumps({'error': str(error), 'line': error.line})}
     except (Exception, psycopg2.Error) as error:
         conn.rollback()
         return {'statusCode': 500, 'body': json.dumps({'error': f'数据库操作失败: {error}'})}
     finally:
         cursor.close()
         conn.close()
+
+def handle_reconcile(body, tenant_id=None):
+    """
+    银行对账单自动匹配并入账。
+    body: { content | content_base64, format?: csv|ofx, tolerance_cents?, dry_run? }
+    """
+    try:
+        tolerance_cents = int(body.get('tolerance_cents', DEFAULT_TOLERANCE_CENTS))
+    except (TypeError, ValueError):
+        return {'statusCode': 400, 'body': json.dumps({'error': 'tolerance_cents 必须为整数'})}
+    if body.get('content_base64'):
+        content = base64.b64decode(body['content_base64']).decode('utf-8-sig')
+    else:
+        content = body.get('content', '')
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+    try:
+        result = reconcile(cursor, io.StringIO(content), body.get('format'), tolerance_cents, bool(body.get('dry_run')),
+                           tenant_id)
+        conn.commit()
+        if result['posted']:
+            invalidate_aging(tenant_id)
+        return {'statusCode': 200, 'body': json.dumps(result, default=str)}
+
+    except (StatementFormatError, PaymentValidationError) as error:
+        conn.rollback()
+        return {'statusCode': 400, 'body': json.dumps({'error': str(error)})}
+    except (Exception, psycopg2.Error) as error:
+        conn.rollback()
+        return {'statusCode': 500, 'body': json.dumps({'error': f'数据库操作失败: {error}'})}
+    finally:
+        cursor.close()
+        conn.close()
+
+def handle_aging(query_params, tenant_id=None):
+    """
+    应收/应付账龄报表。
+    query: as_of? (YYYY-MM-DD), kind? (receivable|payable), partner_id?, refresh? (1 表示跳过缓存)
+    """
+    kind = query_params.get('kind')
+    if kind and kind not in ('receivable', 'payable'):
+        return {'statusCode': 400, 'body': json.dumps({'error': 'kind 必须为 receivable 或 payable'})}
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+    try:
+        report = get_aging(cursor, tenant_id, query_params.get('as_of'), kind, query_params.get('partner_id'),
+                           refresh=query_params.get('refresh') in ('1', 'true'))
+        return {'statusCode': 200, 'body': json.dumps(report, default=str)}
+
+    except AgingQueryError as error:
+        return {'statusCode': 400, 'body': json.dumps({'error': str(error)})}
+    except (Exception, psycopg2.Error) as error:
+        return {'statusCode': 500, 'body': json.dumps({'error': f'数据库操作失败: {error}'})}
+    finally:
+        cursor.close()
+        conn.close()
@@ -0,0 +1,163 @@
+# backend/lambda/fulfillment.py
+# 出库路由：为订单的每一行挑选实际发货的 (仓库, 货架)，取代原先硬编码的默认仓库。
+#
+# - 所有行的可用库存一次性批量查询 (reservations.free_by_location)，仓库路由配置一次查询。
+# - 路由策略:
+#     priority: 按 warehouse_routing.priority 升序（数值越小越优先）；
+#     distance: 按仓库坐标到收货地 (origin) 的球面距离升序。
+# - 优先选择能整单发货的单个仓库；否则按策略顺序拆单 (split shipment)。
+# - 已由 reservations 分配好的行直接沿用预占的位置；其余部分只使用未被任何订单分配的库存。
+
+import math
+import os
+from collections import defaultdict
+
+import ddl
+from reservations import ensure_tables as ensure_reservation_tables, free_by_location
+
+DEFAULT_POLICY = os.environ.get('FULFILLMENT_POLICY', 'priority')
+DEFAULT_LOCATION_CODE = os.environ.get('DEFAULT_LOCATION_CODE', 'DEFAULT')
+
+CREATE_ROUTING_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS warehouse_routing (
+    warehouse_id UUID PRIMARY KEY REFERENCES warehouses(id) ON DELETE CASCADE,
+    priority INT NOT NULL DEFAULT 100,
+    latitude NUMERIC(9, 6),
+    longitude NUMERIC(9, 6),
+    is_active BOOLEAN DEFAULT TRUE
+);
+"""
+
+_tables_ready = False
+
+
+class RoutingError(Exception):
+    """没有任何仓库组合能满足订单时抛出，shortfall 为 {product_id: 缺口数量}。"""
+
+    def __init__(self, message, shortfall):
+        super().__init__(message)
+        self.shortfall = shortfall
+
+
+def ensure_tables(cursor):
+    global _tables_ready
+    if not _tables_ready:
+        _tables_ready = ddl.apply(cursor, CREATE_ROUTING_TABLE_SQL)
+
+
+def _distance_km(lat1, lng1, lat2, lng2):
+    """两点间的球面距离 (haversine)。"""
+    lat1, lng1, lat2, lng2 = [math.radians(float(v)) for v in (lat1, lng1, lat2, lng2)]
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+
+def _load_routing(cursor):
+    """返回 {warehouse_id: 路由配置}；未配置的仓库使用默认优先级。"""
+    ensure_tables(cursor)
+    cursor.execute(
+        """SELECT w.id AS warehouse_id, COALESCE(r.priority, 100) AS priority, r.latitude, r.longitude
+           FROM warehouses w LEFT JOIN warehouse_routing r ON r.warehouse_id = w.id
+           WHERE COALESCE(r.is_active, TRUE)""")
+    return {str(r['warehouse_id']): r for r in cursor.fetchall()}
+
+
+def _rank_warehouses(routing, policy, origin):
+    """按策略返回仓库排序键函数。"""
+    def key(warehouse_id):
+        cfg = routing.get(warehouse_id) or {'priority': 100, 'latitude': None, 'longitude': None}
+        if policy == 'distance' and origin and cfg['latitude'] is not None and cfg['longitude'] is not None:
+            return (0, _distance_km(origin['lat'], origin['lng'], cfg['latitude'], cfg['longitude']), cfg['priority'])
+        # 没有坐标的仓库排在有坐标的仓库之后
+        return (1 if policy == 'distance' else 0, cfg['priority'], 0)
+    return key
+
+
+def plan_shipments(cursor, lines, policy=None, origin=None):
+    """
+    为订单行规划发货位置。
+    lines: [{'product_id', 'quantity'}]
+    返回: [{'warehouse_id', 'product_id', 'location_code', 'quantity'}]；库存不足时抛出 RoutingError。
+    可用量为在库减去已分配给订单的预占 (含本单的预占，本单已分配的部分由 plan_order_shipments 直接出库)。
+    """
+    policy = policy or DEFAULT_POLICY
+    demand = defaultdict(int)
+    for line in lines:
+        demand[str(line['product_id'])] += line['quantity']
+    if not demand:
+        return []
+
+    routing = _load_routing(cursor)
+    # stock[warehouse_id][product_id] = [[location_code, 可用量], ...]
+    stock = defaultdict(lambda: defaultdict(list))
+    for p_id, slots in free_by_location(cursor, list(demand)).items():
+        for w_id, location_code, qty in slots:
+            if str(w_id) in routing:
+                stock[str(w_id)][p_id].append([location_code, qty])
+    for products in stock.values():
+        for slots in products.values():
+            slots.sort(key=lambda s: -s[1])
+
+    rank = _rank_warehouses(routing, policy, origin)
+    ordered = sorted(stock, key=rank)
+
+    # 优先整单发货：第一个能覆盖全部需求的仓库
+    for w_id in ordered:
+        if all(sum(q for _, q in stock[w_id].get(p, [])) >= qty for p, qty in demand.items()):
+            ordered = [w_id]
+            break
+
+    plan = []
+    remaining = dict(demand)
+    for w_id in ordered:
+        for p_id, slots in stock[w_id].items():
+            for slot in slots:
+                need = remaining.get(p_id, 0)
+                if need <= 0:
+                    break
+                take = min(slot[1], need)
+                if take > 0:
+                    plan.append({'warehouse_id': w_id, 'product_id': p_id, 'location_code': slot[0], 'quantity': take})
+                    slot[1] -= take
+                    remaining[p_id] = need - take
+
+    shortfall = {p: q for p, q in remaining.items() if q > 0}
+    if shortfall:
+        raise RoutingError(f"以下商品库存不足，无法出库: {shortfall}", shortfall)
+    return plan
+
+
+def plan_order_shipments(cursor, order_id, items, policy=None, origin=None):
+    """已分配预占的部分直接按预占位置出库，其余部分再走路由规划。"""
+    ensure_reservation_tables(cursor)
+    cursor.execute(
+        """SELECT product_id, warehouse_id, location_code, SUM(quantity) AS quantity FROM reservations
+           WHERE order_id = %s AND status = 'allocated'
+           GROUP BY product_id, warehouse_id, location_code""",
+        (order_id,))
+    reserved = cursor.fetchall()
+
+    demand = defaultdict(int)
+    for item in items:
+        demand[str(item['product_id'])] += item['quantity']
+    plan = []
+    for r in reserved:
+        p_id = str(r['product_id'])
+        take = min(r['quantity'], demand[p_id])
+        if take > 0:
+            plan.append({'warehouse_id': str(r['warehouse_id']), 'product_id': p_id,
+                         'location_code': r['location_code'], 'quantity': take})
+            demand[p_id] -= take
+
+    rest = [{'product_id': p, 'quantity': q} for p, q in demand.items() if q > 0]
+    return plan + plan_shipments(cursor, rest, policy, origin)
+
+
+def default_inbound_location(cursor, warehouse_id=None):
+    """入库的目标位置：指定仓库或路由优先级最高的仓库，货架为 DEFAULT_LOCATION_CODE。"""
+    if not warehouse_id:
+        routing = _load_routing(cursor)
+        if not routing:
+            raise RoutingError("没有可用的仓库", {})
+        warehouse_id = min(routing, key=_rank_warehouses(routing, 'priority', None))
+    return warehouse_id, DEFAULT_LOCATION_CODE
@@ -3,6 +3,12 @@ import json
 import os
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from stock_shards import (SHARD_TOTALS_SQL, InsufficientStockError, decrement_stock, disable_sharding,
+                          enable_sharding, ensure_tables, get_shard_count, increment_stock, set_stock)
+from reservations import available_to_promise, requeue_backorders, reserved_by_others
+from costing import record_adjustment
+from fulfillment import ensure_tables as ensure_routing_tables
+from parallel import run_parallel
 
 DB_HOST = os.environ.get('DB_HOST')
 DB_USER = os.environ.get('DB_USER')
@@ -34,74 +40,88 @@ def lambda_handler(event, context):
         return handle_inventory_audits(method, entity_id, body)
     elif router == 'stats':
         return get_inventory_stats(query_params)
+    elif router == 'atp':
+        return get_available_to_promise(query_params)
+    elif router == 'routing':
+        return handle_warehouse_routing(method, entity_id, body)
+    elif router == 'shards':
+        return handle_stock_shards(method, entity_id, body)
 
     return {'statusCode': 404, 'body': json.dumps({'error': '资源未找到'})}
 
+def _stock_value(cursor, warehouse_id):
+    ensure_tables(cursor)
+    value_query = """
+        SELECT SUM(s.quantity * p.cost_price) as total_value
+        FROM (SELECT warehouse_id, product_id, quantity FROM stocks
+              UNION ALL SELECT warehouse_id, product_id, quantity FROM stock_shards) s
+        JOIN products p ON s.product_id = p.id
+    """
+    if warehouse_id:
+        cursor.execute(value_query + " WHERE s.warehouse_id = %s", (warehouse_id,))
+    else:
+        cursor.execute(value_query)
+    return cursor.fetchone()['total_value'] or 0
+
 def get_inventory_stats(query_params):
-    """获取库存统计数据, 支持按仓库过滤。"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    """获取库存统计数据, 支持按仓库过滤。五条统计查询互不依赖，并行执行 (见 parallel)。"""
     warehouse_id = query_params.get('warehouse_id')
 
-    try:
+    sku_query = "SELECT COUNT(DISTINCT product_id) as total_sku FROM stocks"
+    results = run_parallel(get_db_connection, {
         # 总SKU数
-        sku_query = "SELECT COUNT(DISTINCT product_id) as total_sku FROM stocks"
-        cursor.execute(sku_query + (f" WHERE warehouse_id = '{warehouse_id}'" if warehouse_id else ''))
-        total_sku = cursor.fetchone()['total_sku']
-
+        'sku': (sku_query + " WHERE warehouse_id = %s", (warehouse_id,)) if warehouse_id else sku_query,
         # 库存总价值
-        value_query = """
-            SELECT SUM(s.quantity * p.cost_price) as total_value
-            FROM stocks s
-            JOIN products p ON s.product_id = p.id
-        """
-        cursor.execute(value_query + (f" WHERE s.warehouse_id = '{warehouse_id}'" if warehouse_id else ''))
-        total_value = cursor.fetchone()['total_value'] or 0
-
+        'value': lambda cursor: _stock_value(cursor, warehouse_id),
         # 库存健康度
-        health_query = """
+        'health': """
             SELECT 
                 p.id, 
                 SUM(s.quantity) as total_quantity,
                 p.safety_stock_level
-            FROM stocks s
+            FROM (SELECT product_id, quantity FROM stocks
+                  UNION ALL SELECT product_id, quantity FROM stock_shards) s
             JOIN products p ON s.product_id = p.id
             GROUP BY p.id, p.safety_stock_level
-        """
-        cursor.execute(health_query)
-        all_products = cursor.fetchall()
-
-        health_stats = {'healthy': 0, 'low': 0, 'out': 0, 'dead': 0}
-        for p in all_products:
-            if p['total_quantity'] == 0:
-                health_stats['out'] += 1
-            elif p['total_quantity'] < p['safety_stock_level']:
-                health_stats['low'] += 1
-            else:
-                health_stats['healthy'] += 1 # 简化：此处未计算呆滞库存
-
+        """,
         # 待办事项 (简化)
-        inbound_query = "SELECT COUNT(*) as count FROM purchase_orders WHERE status = 'pending'"
-        cursor.execute(inbound_query)
-        inbound = cursor.fetchone()['count']
-
-        outbound_query = "SELECT COUNT(*) as count FROM sales_orders WHERE status = 'pending'"
-        cursor.execute(outbound_query)
-        outbound = cursor.fetchone()['count']
-        
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'totalSku': total_sku,
-                'totalValue': float(total_value),
-                'stockHealth': health_stats,
-                'flow': {
-                    'inbound': inbound,
-                    'outbound': outbound
-                },
-                'audit': {'urgent': 0, 'coverage': 0} # 简化
-            })
-        }
+        'inbound': "SELECT COUNT(*) as count FROM purchase_orders WHERE status = 'pending'",
+        'outbound': "SELECT COUNT(*) as count FROM sales_orders WHERE status = 'pending'",
+    })
+
+    health_stats = {'healthy': 0, 'low': 0, 'out': 0, 'dead': 0}
+    for p in results['health']:
+        if p['total_quantity'] == 0:
+            health_stats['out'] += 1
+        elif p['total_quantity'] < p['safety_stock_level']:
+            health_stats['low'] += 1
+        else:
+            health_stats['healthy'] += 1 # 简化：此处未计算呆滞库存
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'totalSku': results['sku'][0]['total_sku'],
+            'totalValue': float(results['value']),
+            'stockHealth': health_stats,
+            'flow': {
+                'inbound': results['inbound'][0]['count'],
+                'outbound': results['outbound'][0]['count']
+            },
+            'audit': {'urgent': 0, 'coverage': 0} # 简化
+        })
+    }
+
+def get_available_to_promise(query_params):
+    """可承诺量查询: /inventory/atp?product_ids=a,b,c&warehouse_id=... (在库 - 已分配预占)。"""
+    product_ids = [p for p in (query_params.get('product_ids') or query_params.get('product_id') or '').split(',') if p]
+    if not product_ids:
+        return {'statusCode': 400, 'body': json.dumps({'error': '必须提供 product_ids'})}
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        atp = available_to_promise(cursor, product_ids, query_params.get('warehouse_id'))
+        return {'statusCode': 200, 'body': json.dumps(atp, default=str)}
     finally:
         cursor.close()
         conn.close()
@@ -116,7 +136,11 @@ def handle_stocks(method, body, query_params):
     try:
         if method == 'GET':
             # 查询: /inventory/stocks?warehouse_id=...&product_id=...
-            query = "SELECT s.*, p.name as product_name, p.sku, p.spec, p.image_url as img, p.category, w.name as warehouse_name FROM stocks s JOIN products p ON s.product_id = p.id JOIN warehouses w ON s.warehouse_id = w.id"
+            # 分片商品的数量 = stocks 行 + 各分片之和
+            ensure_tables(cursor)
+            query = f"""SELECT s.warehouse_id, s.product_id, s.location_code, s.quantity + COALESCE(sh.quantity, 0) AS quantity, p.name as product_name, p.sku, p.spec, p.image_url as img, p.category, w.name as warehouse_name
+                FROM stocks s JOIN products p ON s.product_id = p.id JOIN warehouses w ON s.warehouse_id = w.id
+                LEFT JOIN ({SHARD_TOTALS_SQL}) sh ON sh.warehouse_id = s.warehouse_id AND sh.product_id = s.product_id AND sh.location_code = s.location_code"""
             filters = []
             values = []
             for key in ['warehouse_id', 'product_id', 'location_code']:
@@ -133,16 +157,11 @@ def handle_stocks(method, body, query_params):
             keys = ['warehouse_id', 'product_id', 'location_code', 'quantity']
             w_id, p_id, loc, qty = [body.get(k) for k in keys]
 
-            cursor.execute("SELECT quantity FROM stocks WHERE warehouse_id=%s AND product_id=%s AND location_code=%s", (w_id, p_id, loc))
-            current_qty = (cursor.fetchone() or {}).get('quantity', 0)
+            current_qty = set_stock(cursor, w_id, p_id, loc, qty)
             change_qty = qty - current_qty
-
-            upsert_query = """
-                INSERT INTO stocks (warehouse_id, product_id, location_code, quantity)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (warehouse_id, product_id, location_code) 
-                DO UPDATE SET quantity = %s; """
-            cursor.execute(upsert_query, (w_id, p_id, loc, qty, qty))
+            record_adjustment(cursor, p_id, change_qty)
+            if change_qty > 0:
+                requeue_backorders(cursor, [p_id])
 
             # 记录盘点流水
             log_query = "INSERT INTO inventory_logs (product_id, warehouse_id, change_qty, type, reference_id) VALUES (%s, %s, %s, 'adjustment', NULL)"
@@ -163,17 +182,16 @@ def handle_stock_transfer(method, body):
     try:
         p_id, from_w, from_loc, to_w, to_loc, qty = [body.get(k) for k in ['product_id', 'from_warehouse_id', 'from_location_code', 'to_warehouse_id', 'to_location_code', 'quantity']]
         
-        # 1. 检查源库存
-        cursor.execute("SELECT quantity FROM stocks WHERE warehouse_id=%s AND product_id=%s AND location_code=%s", (from_w, p_id, from_loc))
-        source_stock = cursor.fetchone()
-        if not source_stock or source_stock['quantity'] < qty:
+        # 1 & 2. 检查并扣减源库存
+        try:
+            reserved = reserved_by_others(cursor, [(from_w, p_id, from_loc)])
+            decrement_stock(cursor, from_w, p_id, from_loc, qty, reserved=reserved[(str(from_w), str(p_id), from_loc)])
+        except InsufficientStockError:
+            conn.rollback()
             return {'statusCode': 400, 'body': json.dumps({'error': '源货架库存不足'})}
 
-        # 2. 减源库存
-        cursor.execute("UPDATE stocks SET quantity = quantity - %s WHERE warehouse_id=%s AND product_id=%s AND location_code=%s", (qty, from_w, p_id, from_loc))
-        
         # 3. 加目标库存 (upsert)
-        cursor.execute("INSERT INTO stocks (warehouse_id, product_id, location_code, quantity) VALUES (%s, %s, %s, %s) ON CONFLICT (warehouse_id, product_id, location_code) DO UPDATE SET quantity = stocks.quantity + %s", (to_w, p_id, to_loc, qty, qty))
+        increment_stock(cursor, to_w, p_id, to_loc, qty)
 
         # 4. 记录流水
         cursor.execute("INSERT INTO inventory_logs (product_id, warehouse_id, change_qty, type) VALUES (%s, %s, %s, 'transfer_out')", (p_id, from_w, -qty))
@@ -220,15 +238,16 @@ def handle_inventory_audits(method, audit_id, body):
 
             for item in body['items']:
                 p_id, loc, counted_qty = [item.get(k) for k in ['product_id', 'location_code', 'counted_qty']]
-                cursor.execute("SELECT quantity FROM stocks WHERE warehouse_id=%s AND product_id=%s AND location_code=%s", (w_id, p_id, loc))
-                expected_qty = (cursor.fetchone() or {}).get('quantity', 0)
+                # 更新库存（分片商品同样适用），返回盘点前的账面数量
+                expected_qty = set_stock(cursor, w_id, p_id, loc, counted_qty)
                 diff = counted_qty - expected_qty
+                record_adjustment(cursor, p_id, diff)
+                if diff > 0:
+                    requeue_backorders(cursor, [p_id])
 
                 cursor.execute("INSERT INTO inventory_audit_items (audit_id, product_id, location_code, expected_qty, counted_qty, difference) VALUES (%s, %s, %s, %s, %s, %s)", (audit_id, p_id, loc, expected_qty, counted_qty, diff))
 
-                # 更新库存并记录流水
-                upsert_query = "INSERT INTO stocks (warehouse_id, product_id, location_code, quantity) VALUES (%s, %s, %s, %s) ON CONFLICT (warehouse_id, product_id, location_code) DO UPDATE SET quantity = %s;"
-                cursor.execute(upsert_query, (w_id, p_id, loc, counted_qty, counted_qty))
+                # 记录流水
                 if diff != 0:
                     log_query = "INSERT INTO inventory_logs (product_id, warehouse_id, change_qty, type, reference_id) VALUES (%s, %s, %s, 'adjustment', %s)"
                     cursor.execute(log_query, (p_id, w_id, diff, audit_id))
@@ -244,3 +263,74 @@ def handle_inventory_audits(method, audit_id, body):
     finally:
         cursor.close()
         conn.close()
+
+def handle_stock_shards(method, product_id, body):
+    """热点商品分片开关: POST /inventory/shards/{product_id} 启用或重新均衡, DELETE 关闭。"""
+    if not product_id:
+        return {'statusCode': 400, 'body': json.dumps({'error': '缺少商品ID'})}
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        if method == 'GET':
+            shard_count = get_shard_count(cursor, product_id)
+            cursor.execute(
+                "SELECT warehouse_id, location_code, shard_no, quantity FROM stock_shards WHERE product_id = %s ORDER BY warehouse_id, location_code, shard_no",
+                (product_id,))
+            return {'statusCode': 200, 'body': json.dumps({'shard_count': shard_count, 'shards': cursor.fetchall()}, default=str)}
+
+        elif method == 'POST':
+            # body: { shard_count } ; 已启用时按当前配置重新均衡
+            shard_count = body.get('shard_count') or get_shard_count(cursor, product_id)
+            keys = enable_sharding(cursor, product_id, shard_count)
+            conn.commit()
+            return {'statusCode': 200, 'body': json.dumps({'message': '分片已启用', 'rebalanced_keys': keys})}
+
+        elif method == 'DELETE':
+            disable_sharding(cursor, product_id)
+            conn.commit()
+            return {'statusCode': 200, 'body': json.dumps({'message': '分片已关闭'})}
+
+        return {'statusCode': 405, 'body': json.dumps({'error': '不支持的方法'})}
+    except (Exception, psycopg2.Error) as error:
+        conn.rollback()
+        return {'statusCode': 500, 'body': json.dumps({'error': f'数据库操作失败: {error}'})}
+    finally:
+        cursor.close()
+        conn.close()
+
+def handle_warehouse_routing(method, warehouse_id, body):
+    """仓库出库路由配置: GET /inventory/routing, PUT /inventory/routing/{warehouse_id}。"""
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        ensure_routing_tables(cursor)
+        if method == 'GET':
+            cursor.execute(
+                """SELECT w.id AS warehouse_id, w.name, r.priority, r.latitude, r.longitude, r.is_active
+                   FROM warehouses w LEFT JOIN warehouse_routing r ON r.warehouse_id = w.id ORDER BY r.priority NULLS LAST, w.name""")
+            return {'statusCode': 200, 'body': json.dumps(cursor.fetchall(), default=str)}
+
+        elif method == 'PUT' and warehouse_id:
+            # body: { priority, latitude, longitude, is_active }
+            cursor.execute(
+                """INSERT INTO warehouse_routing (warehouse_id, priority, latitude, longitude, is_active)
+                   VALUES (%s, COALESCE(%s, 100), %s, %s, COALESCE(%s, TRUE))
+                   ON CONFLICT (warehouse_id) DO UPDATE SET
+                       priority = COALESCE(%s, warehouse_routing.priority),
+                       latitude = COALESCE(%s, warehouse_routing.latitude),
+                       longitude = COALESCE(%s, warehouse_routing.longitude),
+                       is_active = COALESCE(%s, warehouse_routing.is_active)
+                   RETURNING *""",
+                (warehouse_id, body.get('priority'), body.get('latitude'), body.get('longitude'), body.get('is_active'),
+                 body.get('priority'), body.get('latitude'), body.get('longitude'), body.get('is_active')))
+            row = cursor.fetchone()
+            conn.commit()
+            return {'statusCode': 200, 'body': json.dumps(row, default=str)}
+
+        return {'statusCode': 405, 'body': json.dumps({'error': '不支持的方法'})}
+    except (Exception, psycopg2.Error) as error:
+        conn.rollback()
+        return {'statusCode': 500, 'body': json.dumps({'error': f'数据库操作失败: {error}'})}
+    finally:
+        cursor.close()
+        conn.close()
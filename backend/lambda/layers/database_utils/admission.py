@@ -0,0 +1,198 @@
+# backend/lambda/layers/database_utils/admission.py
+# 租户准入控制：所有租户共用一个 RDS 实例，防止单个租户 (五年利润报表、debug_dump 等) 拖慢所有人。
+#
+# 1. 令牌桶限流：按 (租户, 路由类别) 各一个桶，@instrument 在进入处理函数前检查 (扁平模块在 lambda_handler
+#    开头自行调用 begin)，超出返回 429 + Retry-After。
+#    桶在进程内 (每个容器各自计量)，用于削峰；跨容器的硬性约束由下面的会话参数与报表通道保证。
+# 2. 会话参数：get_db_connection 设置 search_path 的同一条语句里按类别附带 statement_timeout / work_mem
+#    (不增加往返)。POS 等交互请求超时短、work_mem 小；报表类超时长、work_mem 大。
+# 3. 报表通道：重查询在 with report_lane(conn, tenant_id) 中执行，用 PostgreSQL advisory lock 实现
+#    跨容器的有界并发 —— 全局最多 REPORT_LANE_SLOTS 个、每个租户最多 REPORT_LANE_PER_TENANT 个；
+#    等待超过 REPORT_LANE_WAIT_SECONDS 抛出 Throttled。
+#
+# 指标：被拒次数与排队耗时记在本次调用上，由 db_utils.emit_summary 随 EMF 一起输出
+# (AdmissionRejected / LaneQueueMs，维度含 RouteClass)。
+#
+# 类别参数可用 ADMISSION_CLASSES (JSON，结构同 ROUTE_CLASSES) 覆盖；
+# 个别租户可用 ADMISSION_TENANT_OVERRIDES (JSON，{"租户ID": {"report": {"rate": 0.1}}}) 单独收紧或放宽。
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+import jwt
+
+from tracing import span
+
+JWT_SECRET = os.environ.get("JWT_SECRET")
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "true").lower() == "true"
+REPORT_LANE_SLOTS = int(os.environ.get("REPORT_LANE_SLOTS", "4"))
+REPORT_LANE_PER_TENANT = int(os.environ.get("REPORT_LANE_PER_TENANT", "1"))
+REPORT_LANE_WAIT_SECONDS = float(os.environ.get("REPORT_LANE_WAIT_SECONDS", "10"))
+LANE_LOCK_CLASS = 0x45525052  # advisory lock 的第一个键，区分本通道与其他 advisory lock 用途
+
+# rate: 每秒补充的令牌数；burst: 桶容量
+ROUTE_CLASSES = {
+    'pos': {'rate': 20.0, 'burst': 40, 'statement_timeout': '3s', 'work_mem': '4MB'},
+    'default': {'rate': 10.0, 'burst': 20, 'statement_timeout': '10s', 'work_mem': '4MB'},
+    'report': {'rate': 0.5, 'burst': 3, 'statement_timeout': '60s', 'work_mem': '64MB'},
+}
+ROUTE_CLASSES.update(json.loads(os.environ.get("ADMISSION_CLASSES") or "{}"))
+TENANT_OVERRIDES = json.loads(os.environ.get("ADMISSION_TENANT_OVERRIDES") or "{}")
+
+# 路径中出现这些片段即归类 (按顺序匹配)
+ROUTE_PATTERNS = (
+    ('report', ('/reports', '/export', '/debug', '/aging', '/reconciliation')),
+    ('pos', ('/pos', '/mobile')),
+)
+
+_local = threading.local()
+_buckets = {}   # (tenant_id, 类别) -> [令牌数, 上次补充时间]
+_buckets_lock = threading.Lock()
+
+
+class Throttled(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def classify(event):
+    """按路径把请求归入路由类别。"""
+    path = ((event or {}).get('rawPath') or (event or {}).get('path') or '').lower()
+    for route_class, fragments in ROUTE_PATTERNS:
+        if any(f in path for f in fragments):
+            return route_class
+    return 'default'
+
+
+def settings(tenant_id, route_class):
+    """某租户在某类别下的参数 (类别默认值叠加租户覆盖)。"""
+    config = dict(ROUTE_CLASSES.get(route_class) or ROUTE_CLASSES['default'])
+    config.update((TENANT_OVERRIDES.get(str(tenant_id)) or {}).get(route_class) or {})
+    return config
+
+
+def current_class():
+    return getattr(_local, 'route_class', None) or 'default'
+
+
+def _take(tenant_id, route_class):
+    """从令牌桶取一个令牌；不足时返回需要等待的秒数，否则返回 0。"""
+    config = settings(tenant_id, route_class)
+    rate, burst = float(config['rate']), float(config['burst'])
+    now = time.monotonic()
+    key = (str(tenant_id), route_class)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = [burst, now]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / rate if rate > 0 else 60
+
+
+def _tenant_of(event):
+    """
+    取 tenant_id：扁平模块 (REST API) 的事件带授权方解析好的 requestContext.authorizer，
+    其余从 Authorization 解码 (超级管理员与匿名请求返回 None，不限流)。
+    """
+    authorizer = ((event or {}).get('requestContext') or {}).get('authorizer') or {}
+    if authorizer.get('tenant_id') is not None:
+        return authorizer['tenant_id']
+    for k, v in ((event or {}).get('headers') or {}).items():
+        if k.lower() == 'authorization' and v.startswith('Bearer '):
+            try:
+                return jwt.decode(v.split(' ', 1)[1], JWT_SECRET, algorithms=['HS256']).get('tenant_id')
+            except jwt.PyJWTError:
+                return None  # 由处理函数按原逻辑返回 401/403
+    return None
+
+
+def begin(event):
+    """
+    每次调用开始时由 @instrument (未装饰的扁平模块在 lambda_handler 开头) 调用：归类、重置指标并做令牌桶检查。
+    超出速率时抛出 Throttled。
+    """
+    route_class = classify(event)
+    _local.route_class = route_class
+    _local.rejected = 0
+    _local.queue_ms = 0.0
+    if not ADMISSION_ENABLED:
+        return
+    tenant_id = _tenant_of(event)
+    if tenant_id is None:
+        return
+    wait = _take(tenant_id, route_class)
+    if wait:
+        _local.rejected = 1
+        raise Throttled("请求过于频繁，请稍后重试", max(1, int(wait + 0.999)))
+
+
+def metrics():
+    """本次调用的准入指标，供 emit_summary 输出。"""
+    return {'RouteClass': current_class(), 'AdmissionRejected': getattr(_local, 'rejected', 0),
+            'LaneQueueMs': round(getattr(_local, 'queue_ms', 0.0), 2)}
+
+
+def session_sql(tenant_id, route_class=None):
+    """附加在 SET search_path 之后的会话参数语句及其参数。"""
+    config = settings(tenant_id, route_class or current_class())
+    return " SET statement_timeout = %s; SET work_mem = %s;", (config['statement_timeout'], config['work_mem'])
+
+
+def apply_settings(cursor, tenant_id, route_class):
+    """在已有连接上设置某类别的会话参数 (不经 get_db_connection 的模块使用)。"""
+    sql, params = session_sql(tenant_id, route_class)
+    cursor.execute(sql.strip(), params)
+
+
+def _try_lock(cursor, key):
+    cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (LANE_LOCK_CLASS, key))
+    row = cursor.fetchone()
+    return bool(row[0] if not isinstance(row, dict) else list(row.values())[0])
+
+
+def _unlock(cursor, key):
+    cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (LANE_LOCK_CLASS, key))
+
+
+@contextlib.contextmanager
+def report_lane(conn, tenant_id, wait_seconds=None):
+    """
+    在有界并发的报表通道中执行重查询。先占租户名额，再占全局槽位；两者都是会话级 advisory lock，
+    退出时释放 (连接异常断开时由数据库自动释放)。
+    """
+    deadline = time.monotonic() + (REPORT_LANE_WAIT_SECONDS if wait_seconds is None else wait_seconds)
+    tenant_keys = [-(int(tenant_id) * REPORT_LANE_PER_TENANT + i) - 1 for i in range(REPORT_LANE_PER_TENANT)]
+    held = []
+    started = time.perf_counter()
+    try:
+        with span('admission.report_lane', tenant_id=tenant_id), conn.cursor() as cur:
+            for keys in (tenant_keys, list(range(REPORT_LANE_SLOTS))):
+                delay = 0.05
+                while True:
+                    key = next((k for k in keys if _try_lock(cur, k)), None)
+                    if key is not None:
+                        held.append(key)
+                        break
+                    if time.monotonic() >= deadline:
+                        _local.rejected = 1
+                        raise Throttled("报表通道繁忙，请稍后重试", max(1, int(REPORT_LANE_WAIT_SECONDS)))
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.5)
+        _local.queue_ms = getattr(_local, 'queue_ms', 0.0) + (time.perf_counter() - started) * 1000
+        yield
+    finally:
+        if held:
+            try:
+                with conn.cursor() as cur:
+                    for key in held:
+                        _unlock(cur, key)
+            except Exception as e:  # 连接已断开时锁随会话释放
+                print(f"[WARN] admission: 释放报表通道锁失败: {e}")
@@ -0,0 +1,374 @@
+# backend/lambda/layers/database_utils/datagen.py
+# 合成租户数据生成器：用于规模测试 (库存统计、利润报表、各列表接口在百万行级别下的表现)。
+#
+# - 确定性：同样的 seed 与参数生成完全相同的数据。
+# - 分布偏斜：商品销量、客户/供应商下单频率服从 Zipf 分布 (zipf_s 越大越集中)，
+#   每日订单量带周内波动，订单行数围绕 lines_per_order 波动。
+# - 通过 COPY 批量写入 (按表缓冲，约 BUFFER_BYTES 一批)，不逐行 INSERT。
+# - 两种表结构:
+#     tenant -> schema_tenant.sql 建的 tenant_* 表 (SERIAL 主键；db_setup 的 apply_seed 路径使用)
+#     ops    -> orders/pos/inventory/reports 等模块使用的 UUID 主键业务表 (压测使用)
+#
+# 用法:
+#   from datagen import generate
+#   result = generate(conn, 'tenant_3', skus=20000, days=365, orders_per_day=2000)
+# 调用方负责提交事务。
+
+import bisect
+import io
+import math
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+
+BUFFER_BYTES = 8 * 1024 * 1024
+
+DEFAULTS = {
+    'seed': 0,
+    'skus': 1000,
+    'warehouses': 3,
+    'partners': 500,
+    'users': 5,
+    'days': 90,
+    'orders_per_day': 200,
+    'lines_per_order': 3,
+    'zipf_s': 1.1,
+    'min_stock': 0,
+    'end_date': None,
+}
+# 周一到周日的订单量系数
+WEEKDAY_FACTOR = (0.9, 0.95, 1.0, 1.0, 1.1, 1.35, 1.2)
+CATEGORY_COUNT = 20
+
+
+class Zipf:
+    """在 [0, n) 上按 Zipf(s) 抽样；排名经过打乱，热门商品不会集中在最小的 id 上。"""
+
+    def __init__(self, n, s, rng):
+        total, cumulative = 0.0, []
+        for k in range(1, n + 1):
+            total += 1.0 / k ** s
+            cumulative.append(total)
+        self.cumulative = cumulative
+        self.total = total
+        self.rng = rng
+        self.order = list(range(n))
+        rng.shuffle(self.order)
+
+    def sample(self):
+        return self.order[bisect.bisect_left(self.cumulative, self.rng.random() * self.total)]
+
+
+class _CopyBuffer:
+    """按表缓冲 COPY 文本，超过 BUFFER_BYTES 即写入。"""
+
+    def __init__(self, cursor, schema, table, columns):
+        quote = lambda name: '"' + name.replace('"', '""') + '"'
+        self.cursor = cursor
+        self.sql = f'COPY {quote(schema)}.{quote(table)} ({", ".join(quote(c) for c in columns)}) FROM STDIN'
+        self.lines = []
+        self.size = 0
+        self.rows = 0
+
+    def add(self, row):
+        line = '\t'.join(['\\N' if v is None else str(v) for v in row])
+        self.lines.append(line)
+        self.size += len(line) + 1
+        self.rows += 1
+        if self.size >= BUFFER_BYTES:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.cursor.copy_expert(self.sql, io.StringIO('\n'.join(self.lines) + '\n'))
+            self.lines, self.size = [], 0
+
+
+class _Layout:
+    """表结构差异：主键生成方式、表名与列名。"""
+
+    def __init__(self, cursor, schema, rng):
+        self.cursor = cursor
+        self.schema = schema
+        self.rng = rng
+        self.buffers = {}
+
+    def buffer(self, table, columns):
+        key = (table, columns)
+        if key not in self.buffers:
+            self.buffers[key] = _CopyBuffer(self.cursor, self.schema, table, columns)
+        return self.buffers[key]
+
+    def has_column(self, table, column):
+        self.cursor.execute(
+            "SELECT 1 FROM information_schema.columns WHERE table_schema = %s AND table_name = %s AND column_name = %s",
+            (self.schema, table, column))
+        return self.cursor.fetchone() is not None
+
+    def flush(self):
+        for buf in self.buffers.values():
+            buf.flush()
+
+    def counts(self):
+        counts = {}
+        for (table, _), buf in self.buffers.items():
+            counts[table] = counts.get(table, 0) + buf.rows
+        return counts
+
+
+class TenantLayout(_Layout):
+    """schema_tenant.sql 的表：SERIAL 主键，从各表当前最大 id 之后连续分配，结束时推进序列。"""
+
+    SERIAL_TABLES = ('users', 'categories', 'products', 'warehouses', 'partners', 'orders', 'order_items',
+                     'inventory_movements')
+
+    def __init__(self, cursor, schema, rng):
+        super().__init__(cursor, schema, rng)
+        self.next_ids = {}
+        for table in self.SERIAL_TABLES:
+            cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM "{schema}"."{table}"')
+            self.next_ids[table] = cursor.fetchone()[0] + 1
+
+    def new_id(self, table):
+        value = self.next_ids[table]
+        self.next_ids[table] = value + 1
+        return value
+
+    def user(self, i, tag):
+        user_id = self.new_id('users')
+        # 不可用于登录的占位哈希
+        self.buffer('users', ('id', 'name', 'email', 'password_hash', 'role')).add(
+            (user_id, f'gen-user-{i}', f'gen-{tag}-{user_id}@example.invalid', '!', 'staff'))
+        return user_id
+
+    def category(self, i):
+        category_id = self.new_id('categories')
+        self.buffer('categories', ('id', 'name')).add((category_id, f'分类 {i + 1}'))
+        return category_id
+
+    def product(self, i, tag, category_id, base_price, cost_price):
+        product_id = self.new_id('products')
+        self.buffer('products', ('id', 'category_id', 'sku', 'name', 'specs', 'unit', 'base_price', 'cost_price')).add(
+            (product_id, category_id, f'G{tag}-{product_id}', f'商品 {i + 1}', '', '件', base_price, cost_price))
+        return product_id
+
+    def warehouse(self, i, tag):
+        warehouse_id = self.new_id('warehouses')
+        self.buffer('warehouses', ('id', 'name', 'location')).add((warehouse_id, f'仓库 G{tag}-{warehouse_id}', None))
+        return warehouse_id
+
+    def stock(self, warehouse_id, product_id, quantity):
+        self.buffer('inventory', ('product_id', 'warehouse_id', 'quantity')).add((product_id, warehouse_id, quantity))
+
+    def partner(self, i, partner_type):
+        partner_id = self.new_id('partners')
+        self.buffer('partners', ('id', 'type', 'name')).add((partner_id, partner_type, f'{partner_type}-{i}'))
+        return partner_id
+
+    def order(self, order_type, order_no, partner_id, user_id, status, total, created_at, lines, warehouse_id):
+        order_id = self.new_id('orders')
+        self.buffer('orders', ('id', 'order_no', 'partner_id', 'user_id', 'type', 'status', 'total_amount',
+                               'order_date', 'created_at')).add(
+            (order_id, order_no, partner_id, user_id, order_type, status, total, created_at[:10], created_at))
+        items = self.buffer('order_items', ('id', 'order_id', 'product_id', 'quantity', 'unit_price'))
+        movements = self.buffer('inventory_movements', ('id', 'product_id', 'warehouse_id', 'type', 'quantity_change',
+                                                        'reference_id', 'created_at'))
+        sign, movement_type = (-1, 'sale_out') if order_type == 'sales' else (1, 'purchase_in')
+        for product_id, qty, price, _ in lines:
+            items.add((self.new_id('order_items'), order_id, product_id, qty, price))
+            if status == 'completed':
+                movements.add((self.new_id('inventory_movements'), product_id, warehouse_id, movement_type,
+                               sign * qty, order_id, created_at))
+        return order_id
+
+    def payment(self, *args):
+        pass  # tenant_* 表结构没有收付款表
+
+    def finish(self):
+        for table in self.SERIAL_TABLES:
+            self.cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST(%s, 1), %s)",
+                (f'"{self.schema}"."{table}"', self.next_ids[table] - 1, self.next_ids[table] > 1))
+
+
+class OpsLayout(_Layout):
+    """业务模块使用的 UUID 表；id 由 seed 决定，重复执行不会冲突 (不同 seed)。"""
+
+    def __init__(self, cursor, schema, rng):
+        super().__init__(cursor, schema, rng)
+        self.with_paid_amount = self.has_column('orders', 'paid_amount')
+        self.with_completed_at = self.has_column('orders', 'completed_at')
+
+    def new_id(self):
+        # 比 uuid.UUID(...) 快数倍；PostgreSQL 不校验版本位
+        h = '%032x' % self.rng.getrandbits(128)
+        return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+    def user(self, i, tag):
+        user_id = self.new_id()
+        self.buffer('users', ('id', 'name')).add((user_id, f'gen-user-{i}'))
+        return user_id
+
+    def category(self, i):
+        return f'分类 {i + 1}'
+
+    def product(self, i, tag, category, base_price, cost_price):
+        product_id = self.new_id()
+        self.buffer('products', ('id', 'sku', 'name', 'category', 'base_price', 'cost_price')).add(
+            (product_id, f'G{tag}-{i:07d}', f'商品 {i + 1}', category, base_price, cost_price))
+        return product_id
+
+    def warehouse(self, i, tag):
+        warehouse_id = self.new_id()
+        self.buffer('warehouses', ('id', 'name')).add((warehouse_id, f'仓库 G{tag}-{i + 1}'))
+        return warehouse_id
+
+    def stock(self, warehouse_id, product_id, quantity):
+        self.buffer('stocks', ('warehouse_id', 'product_id', 'location_code', 'quantity')).add(
+            (warehouse_id, product_id, 'A-01', quantity))
+
+    def partner(self, i, partner_type):
+        partner_id = self.new_id()
+        self.buffer('partners', ('id', 'name', 'type')).add((partner_id, f'{partner_type}-{i}', partner_type))
+        return partner_id
+
+    def order(self, order_type, order_no, partner_id, user_id, status, total, created_at, lines, warehouse_id):
+        order_id = self.new_id()
+        paid = status == 'completed'
+        columns = ('id', 'order_no', 'type', 'partner_id', 'user_id', 'total_amount', 'status', 'payment_status',
+                   'created_at', 'updated_at')
+        row = (order_id, order_no, order_type, partner_id, user_id, total, status, 'paid' if paid else 'unpaid',
+               created_at, created_at)
+        if self.with_paid_amount:
+            columns += ('paid_amount',)
+            row += (total if paid else 0,)
+        if self.with_completed_at:
+            columns += ('completed_at',)
+            row += (created_at if status == 'completed' else None,)
+        self.buffer('orders', columns).add(row)
+        items = self.buffer('order_items', ('id', 'order_id', 'product_id', 'quantity', 'unit_price', 'total_price'))
+        logs = self.buffer('inventory_logs', ('product_id', 'warehouse_id', 'change_qty', 'type', 'reference_id',
+                                              'created_at'))
+        sign, log_type = (-1, 'outbound') if order_type == 'sales' else (1, 'inbound')
+        for product_id, qty, price, line_total in lines:
+            items.add((self.new_id(), order_id, product_id, qty, price, line_total))
+            if status == 'completed':
+                logs.add((product_id, warehouse_id, sign * qty, log_type, order_id, created_at))
+        return order_id
+
+    def payment(self, order_id, partner_id, order_type, amount, paid_at):
+        self.buffer('financial_transactions', ('id', 'partner_id', 'order_id', 'type', 'amount', 'payment_method',
+                                               'description', 'created_at')).add(
+            (self.new_id(), partner_id, order_id, 'income' if order_type == 'sales' else 'expense', amount,
+             'bank', 'datagen', paid_at))
+
+    def finish(self):
+        pass
+
+
+LAYOUTS = {'tenant': TenantLayout, 'ops': OpsLayout}
+
+
+def _money(value):
+    return f'{value:.2f}'
+
+
+def generate(conn, schema, layout='tenant', log=print, **options):
+    """
+    向 schema 写入一套合成数据，返回 {'rows': {表: 行数}, 'seconds', 'rows_per_second', 'catalog'}。
+    catalog 含生成的 users / partners / warehouses / products([(id, 售价)])，供压测构造请求。
+    """
+    unknown = set(options) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f'未知参数: {", ".join(sorted(unknown))}')
+    opts = {**DEFAULTS, **options}
+    rng = random.Random(opts['seed'])
+    tag = opts['seed']
+    started = time.perf_counter()
+
+    with conn.cursor() as cursor:
+        target = LAYOUTS[layout](cursor, schema, rng)
+
+        # 1. 主数据
+        user_ids = [target.user(i, tag) for i in range(opts['users'])]
+        categories = [target.category(i) for i in range(CATEGORY_COUNT)]
+        warehouse_ids = [target.warehouse(i, tag) for i in range(opts['warehouses'])]
+        product_zipf = Zipf(opts['skus'], opts['zipf_s'], rng)
+        products = []  # (id, 售价, 成本)
+        for i in range(opts['skus']):
+            cost = round(math.exp(rng.gauss(3.5, 1.2)), 2) + 0.5   # 对数正态：多数几十元，少数上千元
+            price = round(cost * rng.uniform(1.15, 2.2), 2)
+            product_id = target.product(i, tag, categories[i % CATEGORY_COUNT], _money(price), _money(cost))
+            products.append((product_id, price, cost))
+        # 热门商品库存更多；部分冷门商品缺货
+        for rank, index in enumerate(product_zipf.order):
+            product_id = products[index][0]
+            base = int(5000 / (rank + 1) ** 0.5)
+            for warehouse_id in warehouse_ids:
+                quantity = max(opts['min_stock'], 0 if rng.random() < 0.05 else rng.randint(0, base + 20))
+                target.stock(warehouse_id, product_id, quantity)
+
+        customer_count = max(1, opts['partners'] * 4 // 5)
+        supplier_count = max(1, opts['partners'] - customer_count)
+        customers = [target.partner(i, 'customer') for i in range(customer_count)]
+        suppliers = [target.partner(i, 'supplier') for i in range(supplier_count)]
+        customer_zipf = Zipf(customer_count, opts['zipf_s'], rng)
+        supplier_zipf = Zipf(supplier_count, opts['zipf_s'], rng)
+
+        # 2. 历史订单 (按天生成)
+        end = opts['end_date'] or date.today()
+        if isinstance(end, str):
+            end = date.fromisoformat(end)
+        first_day = end - timedelta(days=opts['days'] - 1)
+        mean_lines = max(1, opts['lines_per_order'])
+        order_seq = 0
+        for offset in range(opts['days']):
+            day = first_day + timedelta(days=offset)
+            day_start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+            count = int(opts['orders_per_day'] * WEEKDAY_FACTOR[day.weekday()] * rng.uniform(0.85, 1.15))
+            for _ in range(count):
+                order_seq += 1
+                is_sales = rng.random() < 0.8
+                partner_id = customers[customer_zipf.sample()] if is_sales else suppliers[supplier_zipf.sample()]
+                line_count = max(1, min(int(rng.expovariate(1.0 / mean_lines)) + 1, mean_lines * 5))
+                lines, seen = [], set()
+                for _ in range(line_count):
+                    index = product_zipf.sample()
+                    if index in seen:
+                        continue
+                    seen.add(index)
+                    product_id, price, cost = products[index]
+                    qty = max(1, int(rng.paretovariate(2.0))) * (1 if is_sales else 10)
+                    unit_price = price if is_sales else cost
+                    lines.append((product_id, qty, _money(unit_price), _money(unit_price * qty)))
+                total = _money(sum(float(line[3]) for line in lines))
+                roll = rng.random()
+                status = 'completed' if roll < 0.9 else ('draft' if roll < 0.96 else 'cancelled')
+                created_at = (day_start + timedelta(seconds=rng.randint(8 * 3600, 21 * 3600))).isoformat()
+                order_type = 'sales' if is_sales else 'purchase'
+                order_no = f'G{tag}-{"SO" if is_sales else "PO"}-{order_seq:09d}'
+                order_id = target.order(order_type, order_no, partner_id, rng.choice(user_ids) if user_ids else None,
+                                        status, total, created_at, lines, rng.choice(warehouse_ids))
+                if status == 'completed':
+                    paid_at = (day_start + timedelta(days=rng.randint(0, 30), hours=12)).isoformat()
+                    target.payment(order_id, partner_id, order_type, total, paid_at)
+            if offset % 30 == 29:
+                log(f'[datagen] {schema}: {offset + 1}/{opts["days"]} 天, {order_seq} 张订单')
+
+        target.flush()
+        target.finish()
+        for table in target.counts():
+            cursor.execute(f'ANALYZE "{schema}"."{table}"')
+
+    seconds = time.perf_counter() - started
+    rows = target.counts()
+    total_rows = sum(rows.values())
+    log(f'[datagen] {schema}: 共写入 {total_rows} 行，用时 {seconds:.1f}s ({total_rows / seconds:,.0f} 行/秒)')
+    return {
+        'rows': rows,
+        'seconds': round(seconds, 2),
+        'rows_per_second': round(total_rows / seconds),
+        'catalog': {'users': user_ids, 'partners': customers + suppliers, 'customers': customers,
+                    'suppliers': suppliers, 'warehouses': warehouse_ids,
+                    'products': [(p, price) for p, price, _ in products]},
+    }
@@ -3,17 +3,70 @@
 # 它现在提供三种连接方式：
 # 1. get_db_connection: (安全) 用于需要身份验证的、租户隔离的操作，它会检查 JWT 并设置 search_path。
 # 2. get_public_connection: (公共) 用于无需身份验证的公共数据查询，如获取租户列表。
-# 3. get_tenant_db_connection: (租户直连) 用于在登录时，根据 schema 名称直接连接到特定租户的数据库以验证凭据。
+# 3. get_tenant_db_connection: (租户直连) 根据 schema 名称直接连接到特定租户的数据库。
+# 4. run_pooled: (连接池) 登录等高频公共路径在池中的连接上执行，热容器上不再握手；
+#    配合 resolve_tenant 的域名缓存 (TENANT_CACHE_TTL 秒，update_tenant_status 时 invalidate_tenant)。
+# 5. connect: 按给定参数建立带埋点的连接。常驻服务 (backend/service) 设置 DB_PERSISTENT_CONNECTIONS=true，
+#    以上各函数建立的连接在 close() 时重置会话并留给后续请求复用。
+#
+# build_response 传入 cache_control 时计算强 ETag，请求带匹配的 If-None-Match 则返回 304 (无响应体)。
+# 套餐、行业、登录页租户下拉等很少变化的参考列表用 cached_response 在进程内缓存已序列化的结果
+# (REFERENCE_CACHE_TTL 秒)，修改这些数据的处理函数调用 invalidate_reference 立即失效。
+#
+# 所有连接都使用 InstrumentedConnection：在 @instrument 装饰的处理函数内，每条语句的指纹、耗时、
+# 行数与往返次数都会被记录，调用结束时输出一行 EMF (CloudWatch Embedded Metric Format) JSON，
+# 同时标记 N+1 (同一语句在一次调用内重复执行) 并记录慢查询及其执行计划。
+# 在 tracing.trace_handler 范围内，连接、JWT 解码、设置 search_path、每条语句与响应序列化都会记为 span。
+#
+# @instrument 在进入处理函数前做租户准入检查 (admission：按租户与路由类别的令牌桶，超出返回 429)，
+# get_db_connection 按路由类别为租户会话设置 statement_timeout / work_mem。
+#
+# 读副本：配置了 DB_READER_HOST 时，get_db_connection(event, intent='read') 连接读副本 (路由自行声明只读)。
+# - 写后读一致：本次调用中提交过事务时，响应带 X-Read-After 头 (毫秒时间戳，READ_YOUR_WRITES_SECONDS 后过期)，
+#   客户端在后续请求中带回，过期前的读请求仍走主库。
+# - 延迟保护：在副本上设置 search_path 的同一次往返里查询复制延迟，超过 REPLICA_MAX_LAG_SECONDS 时改连主库，
+#   并在 REPLICA_RECHECK_SECONDS 秒内不再尝试副本。
+#
+# 热点语句用 prepared 按连接预编译；这里建立的连接都会登记其 search_path 作用域，避免跨租户复用预编译语句。
 
+import contextlib
+import functools
+import hashlib
 import json
 import os
+import re
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import jwt
 from datetime import date, datetime
 from decimal import Decimal
 
+import admission
+import metering
+import prepared
+from tracing import current_span, span
+
 JWT_SECRET = os.environ.get("JWT_SECRET")
 
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ZhihuiERP")
+SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", "200"))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("DB_N_PLUS_ONE_THRESHOLD", "10"))
+EXPLAIN_SLOW_QUERIES = os.environ.get("DB_EXPLAIN_SLOW_QUERIES", "true").lower() == "true"
+TOP_QUERIES = 10
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+TENANT_CACHE_TTL = float(os.environ.get("TENANT_CACHE_TTL", "60"))
+REFERENCE_CACHE_TTL = float(os.environ.get("REFERENCE_CACHE_TTL", "300"))
+DB_READER_HOST = os.environ.get("DB_READER_HOST")
+READ_YOUR_WRITES_SECONDS = float(os.environ.get("READ_YOUR_WRITES_SECONDS", "5"))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", "2"))
+REPLICA_RECHECK_SECONDS = float(os.environ.get("REPLICA_RECHECK_SECONDS", "10"))
+DB_PERSISTENT_CONNECTIONS = os.environ.get("DB_PERSISTENT_CONNECTIONS", "false").lower() == "true"
+DB_PERSISTENT_IDLE = int(os.environ.get("DB_PERSISTENT_IDLE", "8"))
+DB_CONNECTION_MAX_AGE = float(os.environ.get("DB_CONNECTION_MAX_AGE", "600"))
+
 class CustomEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, (datetime, date)):
@@ -22,6 +75,406 @@ class CustomEncoder(json.JSONEncoder):
             return float(obj)
         return super(CustomEncoder, self).default(obj)
 
+# --- 查询埋点 ---
+
+_state = threading.local()
+
+_FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),                       # 字符串常量
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),                  # 数字常量
+    (re.compile(r"\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)"), "(?)"), # IN (...) / VALUES (...)
+    (re.compile(r"(?:\(\?\)\s*,\s*)+\(\?\)"), "(?)"),            # 多行 VALUES
+    (re.compile(r"%s|%\(\w+\)s"), "?"),                         # 绑定参数
+    (re.compile(r"\s+"), " "),
+]
+
+
+def fingerprint(query):
+    """把语句归一化为指纹 (去掉常量与参数)，返回 (短 id, 归一化文本)。"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        query = str(query)
+    text = query.strip()
+    for pattern, repl in _FINGERPRINT_RULES:
+        text = pattern.sub(repl, text)
+    text = text.strip()[:500]
+    return hashlib.md5(text.encode('utf-8')).hexdigest()[:12], text
+
+
+class QueryStats:
+    """一次调用内的查询统计。"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.round_trips = 0
+        self.db_ms = 0.0
+        self.rows = 0
+        self.by_fingerprint = {}
+        self.slow = []
+
+    def record(self, query, duration_ms, rowcount):
+        fp, text = fingerprint(query)
+        entry = self.by_fingerprint.setdefault(fp, {'fingerprint': fp, 'sql': text, 'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0})
+        entry['calls'] += 1
+        entry['total_ms'] += duration_ms
+        entry['max_ms'] = max(entry['max_ms'], duration_ms)
+        entry['rows'] += max(rowcount, 0)
+        self.round_trips += 1
+        self.db_ms += duration_ms
+        self.rows += max(rowcount, 0)
+        return fp, text
+
+    def n_plus_one(self):
+        return [e for e in self.by_fingerprint.values() if e['calls'] >= N_PLUS_ONE_THRESHOLD]
+
+
+def current_stats():
+    """当前调用的统计；不在 @instrument 范围内时返回 None (不记录)。"""
+    return getattr(_state, 'stats', None)
+
+
+@contextlib.contextmanager
+def measure():
+    """在 with 块内开启查询统计但不输出 EMF，供压测与脚本逐次读取往返次数。"""
+    previous = current_stats()
+    stats = _state.stats = QueryStats()
+    try:
+        yield stats
+    finally:
+        _state.stats = previous
+
+
+class _InstrumentedCursorMixin:
+    def execute(self, query, vars=None):
+        stats = current_stats()
+        if stats is None and current_span() is None:
+            return super().execute(query, vars)
+        with span('db.query') as query_span:
+            started = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                duration_ms = (time.perf_counter() - started) * 1000
+                if stats is not None:
+                    fp, text = stats.record(query, duration_ms, self.rowcount)
+                    if duration_ms >= SLOW_QUERY_MS:
+                        _log_slow_query(self, query, vars, fp, text, duration_ms)
+                else:
+                    fp = fingerprint(query)[0]
+                if query_span is not None:
+                    query_span.set_tag('fingerprint', fp)
+                    query_span.set_tag('rows', self.rowcount)
+
+    def executemany(self, query, vars_list):
+        stats = current_stats()
+        if stats is None:
+            return super().executemany(query, vars_list)
+        vars_list = list(vars_list)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            stats.record(query, duration_ms, self.rowcount)
+            # executemany 每组参数一次往返
+            stats.round_trips += max(len(vars_list) - 1, 0)
+
+
+def _log_slow_query(cursor, query, vars, fp, text, duration_ms):
+    """记录慢查询；只对 SELECT/UPDATE/DELETE/INSERT 追加 EXPLAIN (不执行 ANALYZE)。"""
+    record = {'event': 'slow_query', 'fingerprint': fp, 'sql': text, 'duration_ms': round(duration_ms, 2)}
+    conn = cursor.connection
+    statement = text.lstrip('( ').split(' ', 1)[0].upper()
+    if (EXPLAIN_SLOW_QUERIES and statement in ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+            and not getattr(cursor, 'name', None)
+            and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INERROR):
+        plan_sql = b"EXPLAIN " + cursor.mogrify(query, vars)
+        in_tx = not conn.autocommit
+        explain = psycopg2.extensions.cursor(conn)
+        try:
+            stats, _state.stats = _state.stats, None  # EXPLAIN 本身不计入统计
+            if in_tx:
+                explain.execute("SAVEPOINT __explain")
+            explain.execute(plan_sql)
+            record['plan'] = [r[0] for r in explain.fetchall()]
+            if in_tx:
+                explain.execute("RELEASE SAVEPOINT __explain")
+        except psycopg2.Error as e:
+            record['plan_error'] = str(e).strip()
+            if in_tx:
+                explain.execute("ROLLBACK TO SAVEPOINT __explain")
+        finally:
+            _state.stats = stats
+            explain.close()
+    print(json.dumps(record, ensure_ascii=False))
+
+
+_instrumented_factories = {}
+
+
+def _instrumented_factory(factory):
+    cls = _instrumented_factories.get(factory)
+    if cls is None:
+        cls = type(f"Instrumented{factory.__name__}", (_InstrumentedCursorMixin, factory), {})
+        _instrumented_factories[factory] = cls
+    return cls
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """cursor() 返回带埋点的游标，保留调用方指定的 cursor_factory (如 RealDictCursor)。"""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _instrumented_factory(factory)
+        return super().cursor(*args, **kwargs)
+
+    _pool_key = None   # 常驻模式下由 _connect 设置；close() 时把连接放回空闲列表而不是断开
+    _opened_at = 0.0
+
+    def close(self):
+        if self._pool_key is None or self.closed or not _park(self):
+            super().close()
+
+    def commit(self):
+        # 提交视为发生了写入：本次调用的响应会带上写后读一致令牌 (见 get_db_connection 的 intent)
+        if self.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+            _state.committed = True
+        return super().commit()
+
+
+_ID_SEGMENT = re.compile(r"/(?:\d+|[0-9a-fA-F-]{32,36})(?=/|$)")
+
+
+def _route_of(event):
+    """路由名：优先 routeKey，否则 方法 + 路径 (数字/UUID 段替换为 {id}，避免维度爆炸)。"""
+    if not isinstance(event, dict):
+        return 'invoke'
+    if event.get('routeKey') and event['routeKey'] != '$default':
+        return event['routeKey']
+    method = event.get('httpMethod') or event.get('requestContext', {}).get('http', {}).get('method') or 'INVOKE'
+    path = event.get('rawPath') or event.get('path') or ''
+    return f"{method} {_ID_SEGMENT.sub('/{id}', path)}".strip()
+
+
+def emit_summary(function_name, route, stats, status_code=None):
+    """输出一行 EMF JSON：CloudWatch 会据此生成指标，其余字段可在 Logs Insights 中查询。"""
+    duration_ms = (time.perf_counter() - stats.started) * 1000
+    top = sorted(stats.by_fingerprint.values(), key=lambda e: e['total_ms'], reverse=True)[:TOP_QUERIES]
+    n_plus_one = stats.n_plus_one()
+    summary = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Function', 'Route'], ['RouteClass']],
+                'Metrics': [
+                    {'Name': 'DurationMs', 'Unit': 'Milliseconds'},
+                    {'Name': 'DbTimeMs', 'Unit': 'Milliseconds'},
+                    {'Name': 'DbRoundTrips', 'Unit': 'Count'},
+                    {'Name': 'DbRows', 'Unit': 'Count'},
+                    {'Name': 'NPlusOnePatterns', 'Unit': 'Count'},
+                    {'Name': 'AdmissionRejected', 'Unit': 'Count'},
+                    {'Name': 'LaneQueueMs', 'Unit': 'Milliseconds'},
+                ],
+            }],
+        },
+        'Function': function_name,
+        'Route': route,
+        'StatusCode': status_code,
+        'DurationMs': round(duration_ms, 2),
+        'DbTimeMs': round(stats.db_ms, 2),
+        'DbRoundTrips': stats.round_trips,
+        'DbRows': stats.rows,
+        'NPlusOnePatterns': len(n_plus_one),
+        **admission.metrics(),
+        'queries': [{**e, 'total_ms': round(e['total_ms'], 2), 'max_ms': round(e['max_ms'], 2)} for e in top],
+    }
+    if n_plus_one:
+        summary['n_plus_one'] = [{'fingerprint': e['fingerprint'], 'sql': e['sql'], 'calls': e['calls']} for e in n_plus_one]
+    print(json.dumps(summary, ensure_ascii=False))
+    return summary
+
+
+def instrument(handler=None, *, name=None):
+    """
+    处理函数装饰器：为本次调用开启查询统计，结束时输出 EMF 汇总。
+    用法: @instrument 或 @instrument(name='tenants')
+    """
+    def decorate(func):
+        function_name = name or os.environ.get('AWS_LAMBDA_FUNCTION_NAME') or func.__module__
+
+        @functools.wraps(func)
+        def wrapper(event, context, *args, **kwargs):
+            previous = current_stats()
+            stats = _state.stats = QueryStats()
+            _state.committed = False
+            status_code = None
+            try:
+                try:
+                    admission.begin(event if isinstance(event, dict) else {})
+                except admission.Throttled as e:
+                    response = build_response(429, {"message": str(e)}, headers={'Retry-After': str(e.retry_after)})
+                    status_code = 429
+                    return response
+                response = func(event, context, *args, **kwargs)
+                if isinstance(response, dict):
+                    status_code = response.get('statusCode')
+                    if getattr(_state, 'committed', False) and DB_READER_HOST:
+                        read_after = int((time.time() + READ_YOUR_WRITES_SECONDS) * 1000)
+                        response.setdefault('headers', {})['X-Read-After'] = str(read_after)
+                return response
+            except Exception:
+                status_code = 500
+                raise
+            finally:
+                _state.stats = previous
+                try:
+                    emit_summary(function_name, _route_of(event), stats, status_code)
+                except Exception as e:  # 埋点失败不能影响业务响应
+                    print(f"[METRICS_ERROR] 输出查询汇总失败: {e}")
+        return wrapper
+
+    return decorate(handler) if handler else decorate
+
+
+# --- 常驻进程的连接复用 (backend/service) ---
+# DB_PERSISTENT_CONNECTIONS=true 时，_connect 建立的连接在 close() 时回滚、RESET ALL (search_path 与
+# statement_timeout 等回到连接参数中的值) 并释放 advisory lock，然后按连接参数放回空闲列表，
+# 下一次相同参数的 _connect 直接复用。预编译语句保留在连接上 (见 prepared)。
+# 每组参数最多保留 DB_PERSISTENT_IDLE 个空闲连接，存活超过 DB_CONNECTION_MAX_AGE 秒的连接关闭后重建。
+# Lambda 上保持关闭 (容器可能被冻结，空闲连接会被数据库或 NAT 断开)。
+
+_idle_connections = {}   # 连接参数 -> [空闲连接]
+_idle_lock = threading.Lock()
+
+def _park(conn):
+    """重置会话并放回空闲列表；返回 False 表示应真正关闭。"""
+    if time.monotonic() - conn._opened_at > DB_CONNECTION_MAX_AGE:
+        return False
+    try:
+        psycopg2.extensions.connection.rollback(conn)
+        with psycopg2.extensions.connection.cursor(conn) as cur:
+            cur.execute("RESET ALL; SELECT pg_advisory_unlock_all();")
+        psycopg2.extensions.connection.commit(conn)
+    except Exception as e:
+        print(f"[WARN] 重置连接失败，直接关闭: {e}")
+        return False
+    with _idle_lock:
+        idle = _idle_connections.setdefault(conn._pool_key, [])
+        if len(idle) >= DB_PERSISTENT_IDLE:
+            return False
+        idle.append(conn)
+    return True
+
+def close_idle_connections():
+    """关闭全部空闲连接 (进程退出或重载前调用)。"""
+    with _idle_lock:
+        idle = [conn for conns in _idle_connections.values() for conn in conns]
+        _idle_connections.clear()
+    for conn in idle:
+        try:
+            psycopg2.extensions.connection.close(conn)
+        except Exception:
+            pass
+
+def _connect(**kwargs):
+    if not DB_PERSISTENT_CONNECTIONS:
+        with span('db.connect'):
+            return psycopg2.connect(**kwargs)
+    key = tuple(sorted((k, str(v)) for k, v in kwargs.items() if k != 'connection_factory'))
+    with _idle_lock:
+        idle = _idle_connections.get(key) or []
+        while idle:
+            conn = idle.pop()
+            if not conn.closed:
+                return conn
+    with span('db.connect'):
+        conn = psycopg2.connect(**kwargs)
+    if isinstance(conn, InstrumentedConnection):
+        conn._pool_key = key
+        conn._opened_at = time.monotonic()
+    return conn
+
+def connect(**kwargs):
+    """按给定参数建立 (常驻模式下复用) 带埋点的连接；供 service 为扁平模块提供连接。"""
+    return _connect(connection_factory=InstrumentedConnection, **kwargs)
+
+# --- 连接池与租户目录缓存 (登录等高频公共路径使用) ---
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    0, DB_POOL_SIZE,
+                    host=os.environ.get('DB_HOST'),
+                    port=os.environ.get('DB_PORT'),
+                    dbname=os.environ.get('DB_NAME'),
+                    user=os.environ.get('DB_USER'),
+                    password=os.environ.get('DB_PASSWORD'),
+                    sslmode=os.environ.get('DB_SSL_MODE', 'prefer'),
+                    options='-c search_path=public',
+                    connection_factory=InstrumentedConnection
+                )
+    return _pool
+
+def run_pooled(fn):
+    """
+    在池中的公共连接 (search_path=public) 上执行 fn(conn) 并返回其结果；热容器上不再握手。
+    连接在容器空闲期间可能已被服务端断开：遇到连接级错误时丢弃该连接并重试一次，因此 fn 必须可重试。
+    fn 需自行 commit；归还前会回滚未提交的事务。
+    """
+    pool = _get_pool()
+    for attempt in (1, 2):
+        with span('db.pool_checkout'):
+            conn = pool.getconn()
+        try:
+            result = fn(conn)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            pool.putconn(conn, close=True)
+            if attempt == 2:
+                raise
+            continue
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            pool.putconn(conn, close=bool(conn.closed))
+            raise
+        conn.rollback()
+        pool.putconn(conn)
+        return result
+
+_tenant_cache = {}   # domain -> (过期时间, {'id', 'schema_name', 'status'})
+_tenant_cache_lock = threading.Lock()
+
+def resolve_tenant(cursor, domain):
+    """按域名查租户 (id, schema_name, status)，结果在进程内缓存 TENANT_CACHE_TTL 秒；不存在时返回 None。"""
+    now = time.monotonic()
+    with _tenant_cache_lock:
+        entry = _tenant_cache.get(domain)
+    if entry and entry[0] > now:
+        return entry[1]
+    cursor.execute("SELECT id, schema_name, status FROM public.tenants WHERE domain = %s;", (domain,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    tenant = dict(row) if isinstance(row, dict) else {'id': row[0], 'schema_name': row[1], 'status': row[2]}
+    with _tenant_cache_lock:
+        _tenant_cache[domain] = (now + TENANT_CACHE_TTL, tenant)
+    return tenant
+
+def invalidate_tenant(tenant_id):
+    """租户状态变更或删除后调用 (同时失效登录页租户列表)；其他进程中的缓存最迟在 TENANT_CACHE_TTL 秒后过期。"""
+    with _tenant_cache_lock:
+        for domain in [d for d, (_, t) in _tenant_cache.items() if str(t['id']) == str(tenant_id)]:
+            del _tenant_cache[domain]
+    invalidate_reference('public_tenants')
+
 # [新增] 用于登录流程的租户直连函数
 def get_tenant_db_connection(tenant_schema):
     """根据给定的 schema 名称，建立一个直连到该租户数据库的连接。"""
@@ -29,7 +482,7 @@ def get_tenant_db_connection(tenant_schema):
         print(f"[SECURITY_ERROR] 无效或危险的 schema 名称: {tenant_schema}")
         return None
     try:
-        conn = psycopg2.connect(
+        conn = _connect(
             host=os.environ.get('DB_HOST'),
             port=os.environ.get('DB_PORT'),
             dbname=os.environ.get('DB_NAME'),
@@ -37,8 +490,10 @@ def get_tenant_db_connection(tenant_schema):
             password=os.environ.get('DB_PASSWORD'),
             sslmode=os.environ.get('DB_SSL_MODE', 'prefer'),
             # [关键] 直接将会话的 search_path 设置为指定的租户 schema
-            options=f'-c search_path={tenant_schema},public'
+            options=f'-c search_path={tenant_schema},public',
+            connection_factory=InstrumentedConnection
         )
+        prepared.set_scope(conn, tenant_schema)
         return conn
     except Exception as e:
         print(f"[DB_ERROR] 在 get_tenant_db_connection 中出现错误: {e}")
@@ -47,52 +502,98 @@ def get_tenant_db_connection(tenant_schema):
 def get_public_connection():
     """建立一个指向 public schema 的、无需认证的数据库连接。"""
     try:
-        conn = psycopg2.connect(
+        conn = _connect(
             host=os.environ.get('DB_HOST'),
             port=os.environ.get('DB_PORT'),
             dbname=os.environ.get('DB_NAME'),
             user=os.environ.get('DB_USER'),
             password=os.environ.get('DB_PASSWORD'),
             sslmode=os.environ.get('DB_SSL_MODE', 'prefer'),
-            options='-c search_path=public'
+            options='-c search_path=public',
+            connection_factory=InstrumentedConnection
         )
         return conn
     except Exception as e:
         print(f"[DB_ERROR] 在 get_public_connection 中出现错误: {e}")
         return None
 
-def get_db_connection(event):
+_REPLICA_LAG_SQL = (" SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+                    " ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END;")
+_replica_skip_until = 0.0
+
+def _read_after_pending(headers):
+    """请求带的写后读令牌是否仍在有效期内 (超出正常窗口两倍的令牌视为无效，避免长期钉在主库)。"""
+    try:
+        read_after = int(headers.get('x-read-after') or 0) / 1000.0
+    except ValueError:
+        return False
+    now = time.time()
+    return now < read_after <= now + 2 * READ_YOUR_WRITES_SECONDS
+
+def get_db_connection(event, intent='write'):
     """
     建立一个安全的、经过身份验证的数据库连接，并根据 JWT 设置租户隔离的 search_path。
+    intent='read' 的只读路由在配置了 DB_READER_HOST 时连接读副本 (写后读窗口内或副本延迟过大时仍用主库)。
     """
+    global _replica_skip_until
     conn = None
     try:
-        conn = psycopg2.connect(
-            host=os.environ.get('DB_HOST'),
-            port=os.environ.get('DB_PORT'),
-            dbname=os.environ.get('DB_NAME'),
-            user=os.environ.get('DB_USER'),
-            password=os.environ.get('DB_PASSWORD'),
-            sslmode=os.environ.get('DB_SSL_MODE', 'prefer')
-        )
-
         headers = {k.lower(): v for k, v in event.get('headers', {}).items()}
+        use_replica = (intent == 'read' and bool(DB_READER_HOST) and time.monotonic() >= _replica_skip_until
+                       and not _read_after_pending(headers))
+        # 先校验令牌再连接：匿名/无效请求 (如登录页的 GET /api/tenants) 不再白白建立一次连接
         auth_header = headers.get('authorization', '')
         
         if not auth_header.startswith('Bearer '):
             raise ValueError("无效或缺失的 Authorization 请求头")
         
         token = auth_header.split(' ')[1]
-        payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+        with span('auth.jwt_decode'):
+            payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+        if payload.get('typ') == 'refresh':
+            raise ValueError("刷新令牌不能用于访问接口")
+
+        try:
+            conn = _connect(
+                host=DB_READER_HOST if use_replica else os.environ.get('DB_HOST'),
+                port=os.environ.get('DB_PORT'),
+                dbname=os.environ.get('DB_NAME'),
+                user=os.environ.get('DB_USER'),
+                password=os.environ.get('DB_PASSWORD'),
+                sslmode=os.environ.get('DB_SSL_MODE', 'prefer'),
+                connection_factory=InstrumentedConnection
+            )
+        except psycopg2.OperationalError as e:
+            if not use_replica:
+                raise
+            print(f"[WARN] get_db_connection: 连接读副本失败，{REPLICA_RECHECK_SECONDS:.0f}s 内改用主库: {e}")
+            _replica_skip_until = time.monotonic() + REPLICA_RECHECK_SECONDS
+            return get_db_connection(event)
 
-        with conn.cursor() as cur:
+        with span('db.set_search_path', replica=use_replica), conn.cursor() as cur:
             if payload.get('is_super_admin'):
-                cur.execute("SET search_path TO public;")
+                sql, params = "SET search_path TO public;", ()
             elif 'tenant_id' in payload:
                 tenant_schema = f"tenant_{payload['tenant_id']}"
-                cur.execute("SET search_path TO %s, public;", (tenant_schema,))
+                # 与 search_path 同一次往返设置本路由类别的 statement_timeout / work_mem
+                limits_sql, limits = admission.session_sql(payload['tenant_id'])
+                sql, params = "SET search_path TO %s, public;" + limits_sql, (tenant_schema, *limits)
             else:
                 raise ValueError("令牌缺少必要的声明 (tenant_id 或 is_super_admin)")
+            if use_replica:
+                # 副本上顺带查询复制延迟，仍是一次往返
+                cur.execute(sql + _REPLICA_LAG_SQL, params)
+                lag = float(cur.fetchone()[0] or 0)
+            else:
+                cur.execute(sql, params)
+        prepared.set_scope(conn, f"tenant_{payload['tenant_id']}" if 'tenant_id' in payload else 'public')
+        if use_replica and lag > REPLICA_MAX_LAG_SECONDS:
+            print(f"[WARN] get_db_connection: 读副本延迟 {lag:.1f}s 超过阈值，{REPLICA_RECHECK_SECONDS:.0f}s 内改用主库")
+            _replica_skip_until = time.monotonic() + REPLICA_RECHECK_SECONDS
+            conn.close()
+            return get_db_connection(event)
+        if 'tenant_id' in payload:
+            metering.record(payload['tenant_id'])  # 进程内计数，批量写库
         return conn
 
     except (jwt.ExpiredSignatureError, jwt.InvalidTokenError, ValueError) as e:
@@ -106,20 +607,73 @@ def get_db_connection(event):
             conn.close()
         return None
 
-def build_response(status_code, body, methods='*', headers=None, encoder=None):
+def build_response(status_code, body, methods='*', headers=None, encoder=None, cache_control=None, event=None):
     """
     构建一个标准的 API Gateway 代理响应。
+    传入 cache_control 时 (仅对 200 生效) 附带 Cache-Control 与 ETag；event 的 If-None-Match 命中时返回 304。
     """
+    with span('serialize'):
+        payload = json.dumps(body, cls=encoder)
+    return _respond(status_code, payload, methods, headers, cache_control, event)
+
+def _etag(payload):
+    return '"' + hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32] + '"'
+
+def _if_none_match(event):
+    for k, v in ((event or {}).get('headers') or {}).items():
+        if k.lower() == 'if-none-match':
+            return [tag.strip() for tag in v.split(',')]
+    return []
+
+def _respond(status_code, payload, methods='*', headers=None, cache_control=None, event=None, etag=None):
     response_headers = {
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': methods,
-        'Access-Control-Allow-Headers': 'Content-Type,Authorization'
+        'Access-Control-Allow-Headers': 'Content-Type,Authorization,If-None-Match,X-Read-After',
+        'Access-Control-Expose-Headers': 'ETag,X-Read-After'
     }
     if headers:
         response_headers.update(headers)
-    
+
+    if cache_control and status_code == 200:
+        etag = etag or _etag(payload)
+        response_headers['Cache-Control'] = cache_control
+        response_headers['ETag'] = etag
+        candidates = _if_none_match(event)
+        if etag in candidates or '*' in candidates:
+            return {'statusCode': 304, 'headers': response_headers, 'body': ''}
     return {
         'statusCode': status_code,
         'headers': response_headers,
-        'body': json.dumps(body, cls=encoder)
+        'body': payload
     }
+
+# --- 参考数据缓存 ---
+
+_reference_cache = {}   # key -> (过期时间, 序列化后的响应体, ETag)
+_reference_cache_lock = threading.Lock()
+
+def cached_response(event, key, loader, cache_control, encoder=None, headers=None, ttl=None):
+    """
+    返回参考列表的 200 响应：命中进程内缓存时既不查库也不序列化，只比对 ETag。
+    loader() 在未命中时调用，返回响应体 (需要连接时在 loader 内自行获取)。
+    """
+    now = time.monotonic()
+    with _reference_cache_lock:
+        entry = _reference_cache.get(key)
+    if not entry or entry[0] <= now:
+        body = loader()
+        with span('serialize'):
+            payload = json.dumps(body, cls=encoder)
+        entry = (now + (REFERENCE_CACHE_TTL if ttl is None else ttl), payload, _etag(payload))
+        with _reference_cache_lock:
+            _reference_cache[key] = entry
+    return _respond(200, entry[1], headers=headers, cache_control=cache_control, event=event, etag=entry[2])
+
+def invalidate_reference(*keys):
+    """参考数据被修改后调用；不传 key 时清空全部。其他进程中的缓存最迟在 REFERENCE_CACHE_TTL 秒后过期。"""
+    with _reference_cache_lock:
+        if not keys:
+            _reference_cache.clear()
+        for key in keys:
+            _reference_cache.pop(key, None)
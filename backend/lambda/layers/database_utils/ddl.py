@@ -0,0 +1,53 @@
+# backend/lambda/layers/database_utils/ddl.py
+# 各模块 ensure_tables 的公共部分：执行幂等建表语句，并告诉调用方能否把 _tables_ready 置为 True。
+#
+# 只读路径 (库存查询、报表等) 从不提交，连接关闭或回滚会把同一事务里的 CREATE TABLE 一起撤销；
+# 若此时已经置位，容器会一直以为表存在，之后的写入全部报 "relation ... does not exist"。因此:
+# - 连接上没有进行中的事务时，DDL 单独成一个事务立即提交；
+# - 已在调用方的事务中时不能提交 (会把调用方尚未完成的写入一并提交)，也不宜在事务内重复执行
+#   (CREATE INDEX IF NOT EXISTS 会对表加 ShareLock 直到调用方事务结束，阻塞其他写入)。
+#   此时用同样连接参数与 search_path 的一条独立 autocommit 连接执行 DDL (设 lock_timeout，避免与调用方
+#   事务互相等待)；独立连接失败时退回在调用方事务内执行，并返回 False，下次调用再试。
+
+import os
+
+import psycopg2
+import psycopg2.extensions
+
+DDL_LOCK_TIMEOUT = os.environ.get("DDL_LOCK_TIMEOUT", "2s")
+
+
+def _apply_on_side_connection(conn, cursor, sql):
+    cursor.execute("SHOW search_path")
+    row = cursor.fetchone()
+    search_path = row[0] if not isinstance(row, dict) else row['search_path']
+    # conn.dsn 中的密码已被隐去，与各模块一样从环境变量取
+    side = psycopg2.connect(conn.dsn, password=os.environ.get('DB_PASSWORD'))
+    try:
+        side.autocommit = True
+        with side.cursor() as cur:
+            cur.execute("SELECT set_config('search_path', %s, false), set_config('lock_timeout', %s, false)",
+                        (search_path, DDL_LOCK_TIMEOUT))
+            cur.execute(sql)
+    finally:
+        side.close()
+
+
+def apply(cursor, sql):
+    """执行幂等 DDL；返回 True 表示已提交，调用方可以不再执行。"""
+    conn = cursor.connection
+    if conn.autocommit:
+        cursor.execute(sql)
+        return True
+    if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        cursor.execute(sql)
+        # 不经 InstrumentedConnection.commit：建表不算业务写入，不应触发写后读令牌
+        psycopg2.extensions.connection.commit(conn)
+        return True
+    try:
+        _apply_on_side_connection(conn, cursor, sql)
+        return True
+    except Exception as e:
+        print(f"[WARN] ddl: 独立连接建表失败，改在当前事务内执行: {e}")
+        cursor.execute(sql)
+        return False
@@ -0,0 +1,280 @@
+# backend/lambda/layers/database_utils/entitlements.py
+# 租户权益快照：把租户的方案、plan_features、用量限额 (max_users / max_storage_gb / ai_calls_per_day)
+# 与角色 -> 权限集合编译成一个紧凑的只读快照，在进程内缓存 ENTITLEMENT_CACHE_TTL 秒 (默认 300)。
+# 鉴权与限额检查都查这个快照，不再每次请求 JOIN tenants/plans/plan_features/features。
+#
+# - 快照带版本号 (内容的短哈希)；拒绝访问时响应头 X-Entitlements-Version 携带它，便于排查是否为旧快照。
+# - update_tenant_plan 提交后调用 refresh_entitlements 立即重建；租户状态变更/删除、方案限额修改时
+#   调用 invalidate_entitlements。其他进程最迟在 TTL 到期后看到变化。
+#
+# 装饰器 (auth 模块同时导出，供业务模块 `from auth import authorize, require_permission` 使用):
+#   @authorize(required_plan=['pro', 'enterprise'], required_roles=['admin'], required_client='app')
+#   @require_permission('products.create')
+#   @require_quota('ai_calls', 'ai_calls_per_day')   # 按方案每日限额计量 (见 metering)
+# 校验通过后把 {'claims', 'entitlements'} 放进 event['auth']，处理函数可直接使用；每次通过计一次 api_calls。
+
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+import jwt
+
+import metering
+from db_utils import build_response, run_pooled
+from tracing import span
+
+JWT_SECRET = os.environ.get("JWT_SECRET")
+ENTITLEMENT_CACHE_TTL = float(os.environ.get("ENTITLEMENT_CACHE_TTL", "300"))
+
+# 角色 -> 权限。'*' 表示全部权限；业务模块新增权限点时在这里登记。
+ROLE_PERMISSIONS = {
+    'admin': {'*'},
+    'sales': {'products.read', 'orders.read', 'orders.create', 'orders.update', 'partners.read', 'partners.create'},
+    'warehouse': {'products.read', 'inventory.read', 'inventory.adjust', 'orders.read'},
+    'warehouse_manager': {'products.read', 'products.create', 'products.update', 'inventory.read',
+                          'inventory.adjust', 'orders.read'},
+    'finance': {'products.read', 'orders.read', 'finance.read', 'finance.write', 'partners.read'},
+    'staff': {'products.read', 'orders.read'},
+}
+
+# 依赖方案功能的权限：方案不含对应功能时，即使角色有该权限也会被拒绝
+PERMISSION_FEATURES = {
+    'inventory.': 'INVENTORY',
+    'orders.': 'ORDERS',
+    'partners.': 'PARTNERS',
+    'finance.': 'FINANCE',
+    'ai.': 'AI_ANALYSIS',
+}
+
+# 客户端类型 -> 所需方案功能
+CLIENT_FEATURES = {'app': 'MOBILE_APP'}
+
+_SNAPSHOT_SQL = """
+    SELECT t.id, t.status, p.id AS plan_id, p.code AS plan_code, p.max_users, p.max_storage_gb, p.ai_calls_per_day,
+           COALESCE(array_agg(f.code ORDER BY f.code) FILTER (WHERE f.code IS NOT NULL), '{}') AS features
+    FROM public.tenants t
+    LEFT JOIN public.plans p ON p.id = t.plan_id
+    LEFT JOIN public.plan_features pf ON pf.plan_id = p.id
+    LEFT JOIN public.features f ON f.id = pf.feature_id
+    WHERE t.id = %s
+    GROUP BY t.id, p.id
+"""
+
+_cache = {}   # tenant_id (str) -> (过期时间, Entitlements)
+_cache_lock = threading.Lock()
+
+
+class Entitlements:
+    """某租户的权益快照 (只读)。"""
+
+    __slots__ = ('tenant_id', 'status', 'plan_id', 'plan', 'features', 'limits', 'version')
+
+    def __init__(self, row):
+        self.tenant_id = row['id']
+        self.status = row['status']
+        self.plan_id = row['plan_id']
+        self.plan = row['plan_code']
+        self.features = frozenset(row['features'] or ())
+        self.limits = {'max_users': row['max_users'], 'max_storage_gb': row['max_storage_gb'],
+                       'ai_calls_per_day': row['ai_calls_per_day']}
+        digest = json.dumps([self.status, self.plan, sorted(self.features), self.limits], sort_keys=True)
+        self.version = hashlib.sha256(digest.encode('utf-8')).hexdigest()[:12]
+
+    @property
+    def active(self):
+        return self.status == 'active'
+
+    def limit(self, name):
+        """限额值；None 表示不限。"""
+        return self.limits.get(name)
+
+    def has_feature(self, code):
+        return code in self.features
+
+    def permissions(self, role):
+        return ROLE_PERMISSIONS.get((role or 'staff').strip().lower(), ROLE_PERMISSIONS['staff'])
+
+    def allows(self, role, permission):
+        """角色是否拥有权限，且方案包含该权限依赖的功能。"""
+        for prefix, feature in PERMISSION_FEATURES.items():
+            if permission.startswith(prefix) and feature not in self.features:
+                return False
+        granted = self.permissions(role)
+        return '*' in granted or permission in granted
+
+    def to_dict(self):
+        return {'tenant_id': self.tenant_id, 'status': self.status, 'plan': self.plan,
+                'features': sorted(self.features), 'limits': dict(self.limits), 'version': self.version}
+
+
+def _compile(cursor, tenant_id):
+    with span('entitlements.compile'):
+        cursor.execute(_SNAPSHOT_SQL, (tenant_id,))
+        row = cursor.fetchone()
+    if not row:
+        return None
+    if not isinstance(row, dict):
+        keys = ('id', 'status', 'plan_id', 'plan_code', 'max_users', 'max_storage_gb', 'ai_calls_per_day', 'features')
+        row = dict(zip(keys, row))
+    return Entitlements(row)
+
+
+def _store(tenant_id, snapshot):
+    with _cache_lock:
+        _cache[str(tenant_id)] = (time.monotonic() + ENTITLEMENT_CACHE_TTL, snapshot)
+
+
+def get_entitlements(tenant_id, cursor=None):
+    """
+    返回租户的 Entitlements；租户不存在时返回 None。
+    命中缓存时不访问数据库；未命中时用传入的 cursor 查询，不传则借用连接池中的连接。
+    """
+    with _cache_lock:
+        entry = _cache.get(str(tenant_id))
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    if cursor is not None:
+        snapshot = _compile(cursor, tenant_id)
+    else:
+        def load(conn):
+            with conn.cursor() as cur:
+                return _compile(cur, tenant_id)
+        snapshot = run_pooled(load)
+    if snapshot is not None:
+        _store(tenant_id, snapshot)
+    return snapshot
+
+
+def refresh_entitlements(conn, tenant_id):
+    """方案变更提交后调用：立即按新方案重建本进程的快照。"""
+    with conn.cursor() as cur:
+        snapshot = _compile(cur, tenant_id)
+    if snapshot is None:
+        invalidate_entitlements(tenant_id)
+    else:
+        _store(tenant_id, snapshot)
+    return snapshot
+
+
+def invalidate_entitlements(tenant_id=None):
+    """丢弃快照；不传 tenant_id 时全部丢弃 (如方案限额或功能被修改)。"""
+    with _cache_lock:
+        if tenant_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(str(tenant_id), None)
+
+
+# --- 装饰器 ---
+
+def _header(event, name):
+    for k, v in (event.get('headers') or {}).items():
+        if k.lower() == name:
+            return v
+    return None
+
+
+def _claims(event):
+    """解码 Authorization 中的 access token；无效时返回 None。"""
+    auth_header = _header(event, 'authorization') or ''
+    if not auth_header.startswith('Bearer '):
+        return None
+    try:
+        with span('auth.jwt_decode'):
+            claims = jwt.decode(auth_header.split(' ', 1)[1], JWT_SECRET, algorithms=['HS256'])
+    except jwt.PyJWTError:
+        return None
+    return None if claims.get('typ') == 'refresh' else claims
+
+
+def _check(event, check):
+    """公共流程：解码令牌、取快照、执行 check(event, claims, entitlements)，返回错误响应或 None。"""
+    claims = _claims(event)
+    if not claims:
+        return build_response(401, {"message": "未提供有效的认证令牌"})
+    if claims.get('is_super_admin'):
+        event['auth'] = {'claims': claims, 'entitlements': None}
+        return None
+    if claims.get('tenant_id') is None:
+        return build_response(403, {"message": "令牌缺少租户信息"})
+    try:
+        snapshot = get_entitlements(claims['tenant_id'])
+    except Exception as e:
+        print(f"[ERROR] entitlements: 加载租户 {claims.get('tenant_id')} 的权益快照失败: {e}")
+        return build_response(503, {"message": "暂时无法校验权限，请稍后重试"})
+    if snapshot is None or not snapshot.active:
+        return build_response(403, {"message": "租户不存在或未激活"})
+    message = check(event, claims, snapshot)
+    if message:
+        return build_response(403, {"message": message}, headers={'X-Entitlements-Version': snapshot.version})
+    event['auth'] = {'claims': claims, 'entitlements': snapshot}
+    metering.record(claims['tenant_id'])
+    return None
+
+
+def authorize(required_plan=None, required_roles=None, required_client=None, required_feature=None):
+    """按方案、角色、客户端类型 (请求头 X-Client) 与方案功能限制访问。"""
+    def check(event, claims, snapshot):
+        if required_plan and snapshot.plan not in required_plan:
+            return "当前方案不支持此功能，请升级方案"
+        if required_roles and (claims.get('role') or '').strip().lower() not in required_roles:
+            return "权限不足"
+        if required_client:
+            if (_header(event, 'x-client') or claims.get('client')) != required_client:
+                return f"仅限 {required_client} 客户端访问"
+            feature = CLIENT_FEATURES.get(required_client)
+            if feature and not snapshot.has_feature(feature):
+                return "当前方案不支持此客户端"
+        if required_feature and not snapshot.has_feature(required_feature):
+            return "当前方案不支持此功能，请升级方案"
+        return None
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(event, context, *args, **kwargs):
+            denied = _check(event, check)
+            if denied:
+                return denied
+            return fn(event, context, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def require_permission(permission):
+    """要求当前用户的角色拥有 permission，且方案包含其依赖的功能。"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(event, context, *args, **kwargs):
+            denied = _check(event, lambda _, claims, snapshot: None if snapshot.allows(claims.get('role'), permission)
+                            else f"权限不足: 需要 {permission}")
+            if denied:
+                return denied
+            return fn(event, context, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def require_quota(metric, limit_name):
+    """按方案限额 (如 ai_calls_per_day) 计量 metric；超出当日限额返回 429。需放在 authorize/require_permission 之下。"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(event, context, *args, **kwargs):
+            snapshot = (event.get('auth') or {}).get('entitlements')
+            if snapshot is None:
+                return fn(event, context, *args, **kwargs)  # 超级管理员不计量
+            try:
+                remaining = metering.consume(snapshot.tenant_id, metric, snapshot.limit(limit_name))
+            except metering.QuotaExceeded as e:
+                return build_response(429, {"message": str(e)})
+            except Exception as e:
+                print(f"[WARN] entitlements: 配额检查失败，放行本次请求: {e}")
+                remaining = None
+            response = fn(event, context, *args, **kwargs)
+            if remaining is not None and isinstance(response, dict):
+                response.setdefault('headers', {})['X-Quota-Remaining'] = str(remaining)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,227 @@
+# backend/lambda/layers/database_utils/metering.py
+# 用量计量：按 (租户, 日期, 指标) 在进程内累加计数，批量 upsert 到 public.tenant_usage_daily，
+# 请求路径上不做同步写库。
+#
+# - 刷新时机：上次刷新后新增的计数达到 METERING_FLUSH_SIZE (默认 100)、距上次刷新超过 METERING_FLUSH_SECONDS 秒
+#   (默认 30，在下一次 record 时检查)，或进程退出 (atexit / SIGTERM)。写库失败时计数并回待写队列，下次刷新重试
+#   (并回的计数不计入阈值，失败后不会每次 record 都同步重试)；连续失败 METERING_MAX_FLUSH_FAILURES 次 (默认 5)
+#   后丢弃这批计数。已删除租户的计数在写入时通过与 public.tenants 连接直接丢弃，不会因外键失败卡住整批。
+# - 配额：consume() 按「已对账的库内总数 + 本进程未刷新的计数」判断是否超出限额。库内总数来自每次刷新的
+#   RETURNING (包含其他容器已写入的量)，超过 METERING_RECONCILE_SECONDS 秒 (默认 60) 未更新时读库对账一次。
+#   多个容器同时消耗时，最多可能超出「容器数 x 对账间隔内的用量」，换取每次请求零写库。
+#
+# 指标: api_calls (每次通过鉴权的租户请求)、ai_calls (受 plans.ai_calls_per_day 限制) 等。
+
+import atexit
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+import ddl
+
+FLUSH_SIZE = int(os.environ.get("METERING_FLUSH_SIZE", "100"))
+FLUSH_SECONDS = float(os.environ.get("METERING_FLUSH_SECONDS", "30"))
+RECONCILE_SECONDS = float(os.environ.get("METERING_RECONCILE_SECONDS", "60"))
+MAX_FLUSH_FAILURES = int(os.environ.get("METERING_MAX_FLUSH_FAILURES", "5"))
+METERING_ENABLED = os.environ.get("METERING_ENABLED", "true").lower() == "true"
+
+CREATE_USAGE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS public.tenant_usage_daily (
+    tenant_id INT NOT NULL REFERENCES public.tenants(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    metric VARCHAR(50) NOT NULL,
+    count BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (tenant_id, day, metric)
+);
+"""
+
+# 只写入仍存在的租户；已删除租户的行被连接过滤掉 (不在 RETURNING 中，调用方据此丢弃)
+UPSERT_SQL = """
+INSERT INTO public.tenant_usage_daily (tenant_id, day, metric, count)
+SELECT v.tenant_id, v.day, v.metric, v.count
+FROM (VALUES %s) AS v(tenant_id, day, metric, count)
+JOIN public.tenants t ON t.id = v.tenant_id
+ORDER BY v.tenant_id, v.day, v.metric
+ON CONFLICT (tenant_id, day, metric) DO UPDATE
+SET count = public.tenant_usage_daily.count + EXCLUDED.count, updated_at = CURRENT_TIMESTAMP
+RETURNING tenant_id, day, metric, count
+"""
+
+_tables_ready = False
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, metric, limit):
+        super().__init__(f"今日 {metric} 用量已达上限 {limit}")
+        self.metric = metric
+        self.limit = limit
+
+
+def ensure_tables(cursor):
+    global _tables_ready
+    if not _tables_ready:
+        _tables_ready = ddl.apply(cursor, CREATE_USAGE_TABLE_SQL)
+
+
+def _today():
+    return datetime.now(timezone.utc).date()
+
+
+def _run(fn):
+    # 延迟导入：db_utils 在模块加载时导入本模块
+    from db_utils import run_pooled
+    return run_pooled(fn)
+
+
+class Meter:
+    """进程内计数器；模块级共享实例见 record / consume / flush。"""
+
+    def __init__(self, flush_size=FLUSH_SIZE, flush_seconds=FLUSH_SECONDS, reconcile_seconds=RECONCILE_SECONDS,
+                 runner=_run, max_failures=MAX_FLUSH_FAILURES):
+        self.flush_size = flush_size
+        self.max_failures = max_failures
+        self.flush_seconds = flush_seconds
+        self.reconcile_seconds = reconcile_seconds
+        self.runner = runner
+        self._pending = {}     # (tenant_id, day, metric) -> 未写库的计数
+        self._pending_total = 0  # 上次刷新以来新增的计数 (不含写库失败并回的部分)
+        self._failures = 0       # 连续写库失败次数
+        self._totals = {}      # (tenant_id, day, metric) -> (库内总数, 对账时间)
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def record(self, tenant_id, metric='api_calls', n=1):
+        """累加计数；达到批量阈值或时间阈值时同步刷新一次。"""
+        key = (int(tenant_id), _today(), metric)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + n
+            self._pending_total += n
+            due = self._pending_total >= self.flush_size or time.monotonic() - self._last_flush >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def used(self, tenant_id, metric):
+        """今日用量 = 已对账的库内总数 + 本进程未刷新的计数；对账结果过期时读库一次。"""
+        key = (int(tenant_id), _today(), metric)
+        with self._lock:
+            total = self._totals.get(key)
+            pending = self._pending.get(key, 0)
+        if total is None or time.monotonic() - total[1] >= self.reconcile_seconds:
+            total = (self._reconcile(key), time.monotonic())
+        return total[0] + pending
+
+    def consume(self, tenant_id, metric, limit, n=1):
+        """在限额内则记一次并返回剩余量；超出时抛出 QuotaExceeded。limit 为 None 表示不限，只计数。"""
+        if limit is not None and self.used(tenant_id, metric) + n > limit:
+            raise QuotaExceeded(metric, limit)
+        self.record(tenant_id, metric, n)
+        return None if limit is None else max(0, limit - self.used(tenant_id, metric))
+
+    def _reconcile(self, key):
+        def load(conn):
+            with conn.cursor() as cur:
+                ensure_tables(cur)
+                cur.execute("SELECT count FROM public.tenant_usage_daily WHERE tenant_id = %s AND day = %s AND metric = %s",
+                            key)
+                row = cur.fetchone()
+            conn.commit()
+            return row[0] if row else 0
+        count = self.runner(load)
+        with self._lock:
+            self._totals[key] = (count, time.monotonic())
+        return count
+
+    def flush(self):
+        """把待写计数一次性 upsert 到库里，并用返回的总数更新对账缓存。"""
+        if not self._flush_lock.acquire(blocking=False):
+            return  # 另一个线程正在刷新
+        try:
+            with self._lock:
+                batch, self._pending, self._pending_total = self._pending, {}, 0
+                self._last_flush = time.monotonic()
+            if not batch:
+                return
+            rows = [(tenant_id, day, metric, n) for (tenant_id, day, metric), n in sorted(batch.items())]
+
+            def write(conn):
+                with conn.cursor() as cur:
+                    ensure_tables(cur)
+                    returned = execute_values(cur, UPSERT_SQL, rows, fetch=True)
+                conn.commit()
+                return returned
+            try:
+                returned = self.runner(write)
+            except Exception as e:
+                self._failures += 1
+                if self._failures >= self.max_failures:
+                    print(f"[ERROR] metering: 连续 {self._failures} 次写入用量失败，丢弃 {len(rows)} 条计数: {e}")
+                    self._failures = 0
+                    return
+                print(f"[WARN] metering: 写入用量失败，{len(rows)} 条计数保留到下次刷新: {e}")
+                with self._lock:
+                    for key, n in batch.items():
+                        self._pending[key] = self._pending.get(key, 0) + n
+                return
+            self._failures = 0
+            now = time.monotonic()
+            written = {(tenant_id, day, metric) for tenant_id, day, metric, _ in returned}
+            dropped = [key for key in batch if key not in written]
+            if dropped:
+                print(f"[WARN] metering: 丢弃 {len(dropped)} 条已删除租户的计数: {sorted({k[0] for k in dropped})}")
+            with self._lock:
+                for key in dropped:
+                    self._totals.pop(key, None)
+                for tenant_id, day, metric, count in returned:
+                    self._totals[(tenant_id, day, metric)] = (count, now)
+                for key in [k for k in self._totals if k[1] != _today()]:
+                    del self._totals[key]
+        finally:
+            self._flush_lock.release()
+
+
+_meter = Meter()
+
+
+def record(tenant_id, metric='api_calls', n=1):
+    if METERING_ENABLED and tenant_id is not None:
+        try:
+            _meter.record(tenant_id, metric, n)
+        except Exception as e:  # 计量失败不能影响业务响应
+            print(f"[WARN] metering: 记录用量失败: {e}")
+
+
+def used(tenant_id, metric):
+    return _meter.used(tenant_id, metric)
+
+
+def consume(tenant_id, metric, limit, n=1):
+    return _meter.consume(tenant_id, metric, limit, n)
+
+
+def flush():
+    try:
+        _meter.flush()
+    except Exception as e:
+        print(f"[WARN] metering: 刷新用量失败: {e}")
+
+
+# 进程退出时刷新。Lambda 只有在注册了扩展时才会在关闭前发送 SIGTERM，其余情况依赖批量/时间阈值。
+atexit.register(flush)
+
+
+def _on_sigterm(signum, frame, _previous=signal.getsignal(signal.SIGTERM)):
+    flush()
+    if callable(_previous):
+        _previous(signum, frame)
+    else:
+        raise SystemExit(0)
+
+
+if threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGTERM, _on_sigterm)
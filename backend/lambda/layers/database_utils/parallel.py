@@ -0,0 +1,111 @@
+# backend/lambda/layers/database_utils/parallel.py
+# 并行执行互不依赖的查询：仪表盘、报表常常顺序执行多条独立的聚合查询，总耗时是各条之和。
+# run_parallel 把一组命名查询分发到小线程池，每个线程使用各自的连接，耗时约等于最慢的一条。
+#
+#   results = run_parallel(get_db_connection, {
+#       'sku': ("SELECT COUNT(DISTINCT product_id) AS total_sku FROM stocks", ()),
+#       'inbound': "SELECT COUNT(*) AS count FROM purchase_orders WHERE status = 'pending'",
+#       'health': lambda cur: compute_health(cur),      # 可传入函数，参数为 cursor，返回值原样放入结果
+#   })
+#   results['sku'][0]['total_sku']
+#
+# - 查询写成 SQL 字符串或 (SQL, 参数) 时结果为 fetchall() 的行列表；cursor 默认为 RealDictCursor。
+# - 连接：connect 为无参工厂 (模块自己的 get_db_connection)，用完即 close()。本模块不另设空闲池：常驻服务中
+#   connect 经 db_utils._connect 建立，close() 时由 db_utils._park 重置会话 (RESET ALL) 后复用，
+#   同样受 DB_CONNECTION_MAX_AGE 约束并由 close_idle_connections 关闭；Lambda 上按 db_utils 的约定不保留空闲连接。
+# - 各查询在不同连接、不同快照上执行，只适合允许轻微不一致的统计类读取；需要同一快照的请继续顺序执行。
+# - 任一查询失败时等待其余查询结束，再抛出第一个异常；出错的连接直接关闭，不放回。
+# - PARALLEL_ENABLED=false 时在一个连接上顺序执行 (排查问题或数据库连接数紧张时使用)。未设置时跟随
+#   DB_PERSISTENT_CONNECTIONS：只在常驻服务中默认并行；Lambda 上每个并行查询都要新建一条连接，
+#   建连耗时抵消了并行的收益，且放大连接数，默认顺序执行。
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+
+from tracing import span
+
+PARALLEL_ENABLED = os.environ.get("PARALLEL_ENABLED",
+                                  os.environ.get("DB_PERSISTENT_CONNECTIONS", "false")).lower() == "true"
+PARALLEL_MAX_WORKERS = int(os.environ.get("PARALLEL_MAX_WORKERS", "4"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PARALLEL_MAX_WORKERS, thread_name_prefix='db-parallel')
+    return _executor
+
+
+def _release(conn, broken):
+    try:
+        if broken:
+            # 出错的连接不交给 db_utils 复用，直接断开
+            psycopg2.extensions.connection.close(conn)
+        else:
+            conn.rollback()   # 结束只读事务
+            conn.close()
+    except Exception as e:
+        print(f"[WARN] parallel: 关闭连接失败: {e}")
+
+
+def _run_one(cursor, query):
+    if callable(query):
+        return query(cursor)
+    sql, params = (query, ()) if isinstance(query, str) else query
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def _worker(connect, cursor_factory, query):
+    started = time.perf_counter()
+    conn = connect()
+    broken = True
+    try:
+        with conn.cursor(cursor_factory=cursor_factory) as cursor:
+            result = _run_one(cursor, query)
+        broken = False
+        return result, (time.perf_counter() - started) * 1000
+    finally:
+        _release(conn, broken)
+
+
+def run_parallel(connect, queries, cursor_factory=RealDictCursor):
+    """并行执行 {名称: 查询} 并返回 {名称: 结果}。"""
+    if not queries:
+        return {}
+    with span('db.parallel', queries=len(queries)) as sp:
+        if not PARALLEL_ENABLED or len(queries) == 1:
+            conn = connect()
+            broken = True
+            try:
+                with conn.cursor(cursor_factory=cursor_factory) as cursor:
+                    results = {name: _run_one(cursor, query) for name, query in queries.items()}
+                broken = False
+                return results
+            finally:
+                _release(conn, broken)
+
+        executor = _get_executor()
+        futures = {name: executor.submit(_worker, connect, cursor_factory, query)
+                   for name, query in queries.items()}
+        results, timings, error = {}, {}, None
+        for name, future in futures.items():
+            try:
+                results[name], timings[name] = future.result()
+            except Exception as e:
+                error = error or e
+        if sp is not None:
+            sp.set_tag('query_ms', {name: round(ms, 2) for name, ms in timings.items()})
+        if error is not None:
+            raise error
+        return results
@@ -0,0 +1,109 @@
+# backend/lambda/layers/database_utils/passwords.py
+# 密码哈希服务：所有 bcrypt 计算统一走这里。
+#
+# - 代价可配置 (PASSWORD_BCRYPT_ROUNDS，默认 12，与历史哈希一致)。登录校验成功后，若已存哈希的代价与配置不同，
+#   verify 会返回新哈希由调用方写回 (rehash-on-verify)，调整代价无需强制用户改密码。
+# - 并发上限 (PASSWORD_HASH_CONCURRENCY，默认 CPU 数)：bcrypt 计算期间释放 GIL，多线程部署 (见 backend/service)
+#   下同时进行的哈希数受信号量限制，等待超过 PASSWORD_HASH_WAIT_SECONDS 抛出 HasherBusy，调用方返回 503，
+#   避免交班登录高峰时所有请求一起排队到超时。
+# - 刷新令牌：登录成功时签发 REFRESH_TOKEN_TTL 秒有效的刷新令牌，access token 过期后凭它换新，不再走 bcrypt。
+#   令牌里带当前密码哈希的指纹 (pwv)，改密码后旧的刷新令牌自动失效。
+
+import hashlib
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import bcrypt
+import jwt
+
+BCRYPT_ROUNDS = int(os.environ.get('PASSWORD_BCRYPT_ROUNDS', '12'))
+HASH_CONCURRENCY = int(os.environ.get('PASSWORD_HASH_CONCURRENCY', str(os.cpu_count() or 1)))
+HASH_WAIT_SECONDS = float(os.environ.get('PASSWORD_HASH_WAIT_SECONDS', '5'))
+REFRESH_TOKEN_TTL = int(os.environ.get('REFRESH_TOKEN_TTL', str(12 * 3600)))
+JWT_SECRET = os.environ.get('JWT_SECRET')
+
+_slots = threading.BoundedSemaphore(max(1, HASH_CONCURRENCY))
+
+
+class HasherBusy(RuntimeError):
+    """等待哈希槽位超时；调用方应返回 503 并提示稍后重试。"""
+
+
+class InvalidRefreshToken(ValueError):
+    pass
+
+
+def _acquire():
+    if not _slots.acquire(timeout=HASH_WAIT_SECONDS):
+        raise HasherBusy('登录请求过多，请稍后重试')
+
+
+def hash_password(password, rounds=None):
+    """返回 bcrypt 哈希 (str)。"""
+    _acquire()
+    try:
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds or BCRYPT_ROUNDS)).decode('utf-8')
+    finally:
+        _slots.release()
+
+
+def hash_rounds(password_hash):
+    """已存哈希的代价；无法识别时返回 None。"""
+    parts = password_hash.split('$')
+    if len(parts) >= 4 and parts[1] in ('2a', '2b', '2y') and parts[2].isdigit():
+        return int(parts[2])
+    return None
+
+
+def verify_password(password, password_hash):
+    """
+    校验密码，返回 (是否正确, 新哈希或 None)。
+    新哈希不为 None 时说明已存哈希的代价与配置不符，调用方应写回。
+    """
+    if isinstance(password_hash, bytes):
+        password_hash = password_hash.decode('utf-8')
+    _acquire()
+    try:
+        ok = bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    finally:
+        _slots.release()
+    if ok and hash_rounds(password_hash) != BCRYPT_ROUNDS:
+        return True, hash_password(password)
+    return ok, None
+
+
+def password_version(password_hash):
+    """密码哈希的短指纹，写入刷新令牌；密码变更后指纹随之变化。"""
+    if isinstance(password_hash, str):
+        password_hash = password_hash.encode('utf-8')
+    return hashlib.sha256(password_hash).hexdigest()[:16]
+
+
+def issue_refresh_token(claims, password_hash):
+    """签发刷新令牌；claims 为换发 access token 所需的身份信息 (user_id / tenant_id / username ...)。"""
+    payload = dict(claims)
+    payload.update({
+        'typ': 'refresh',
+        'pwv': password_version(password_hash),
+        'jti': uuid.uuid4().hex,
+        'exp': datetime.utcnow() + timedelta(seconds=REFRESH_TOKEN_TTL),
+    })
+    return jwt.encode(payload, JWT_SECRET, algorithm='HS256')
+
+
+def decode_refresh_token(token):
+    """校验签名、有效期与类型，返回 payload；pwv 需由调用方对照当前密码哈希检查。"""
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+    except jwt.PyJWTError as e:
+        raise InvalidRefreshToken(str(e))
+    if payload.get('typ') != 'refresh':
+        raise InvalidRefreshToken('不是刷新令牌')
+    return payload
+
+
+def check_password_version(payload, password_hash):
+    if payload.get('pwv') != password_version(password_hash):
+        raise InvalidRefreshToken('密码已变更，请重新登录')
@@ -0,0 +1,177 @@
+# backend/lambda/layers/database_utils/prepared.py
+# 热点语句的预编译注册表：短小的 OLTP 语句 (库存行锁查询、inventory_logs 插入、按 ID 查订单等)
+# 每次执行都要重新解析与规划，这部分开销与执行本身相当。这里按连接 PREPARE 一次，之后只发送 EXECUTE。
+#
+#   STOCK_FOR_UPDATE = prepared.statement('stock_for_update', "SELECT quantity FROM stocks WHERE ... FOR UPDATE")
+#   prepared.execute(cursor, STOCK_FOR_UPDATE, (warehouse_id, product_id, location_code))
+#
+# - 零额外往返：连接上首次执行时 PREPARE 与 EXECUTE 合并为一条语句发送；之后只发 EXECUTE。
+#   因此只活一次请求的连接也不会更慢，复用的连接 (run_pooled 的连接池、常驻服务) 收益最大。
+# - search_path 安全：预编译语句在 PREPARE 时按当时的 search_path 绑定表，切换租户后沿用旧语句会读到
+#   上一个租户的表。语句名因此包含「作用域」(当前 search_path) 的哈希，不同租户各自 PREPARE。
+#   作用域由 get_db_connection 设置；在已有连接上切换 search_path 须通过 set_search_path，
+#   直接执行 SET search_path 的连接不能使用本模块。
+# - 失效：表结构变更后 PostgreSQL 会自动重新规划，但结果列变化时会报 "cached plan must not change
+#   result type"；连接被重置 (DISCARD ALL) 后语句不存在 (或登记丢失导致重名)。这些情况都会清空该连接的登记，
+#   若出错语句是事务中的第一条则回滚并自动重试，否则抛给调用方 (事务已中止，下次执行时重新 PREPARE)。
+#   执行迁移的进程可调用 invalidate()：各连接在下次使用时先 DEALLOCATE ALL。
+#   部署时修改 PREPARED_SCHEMA_VERSION 会换用新的语句名。
+# - 经 PgBouncer 事务模式连接时预编译语句不可用，设置 PREPARED_STATEMENTS=false 回退为普通执行。
+
+import hashlib
+import os
+import threading
+import weakref
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+PREPARED_ENABLED = os.environ.get("PREPARED_STATEMENTS", "true").lower() == "true"
+SCHEMA_VERSION = os.environ.get("PREPARED_SCHEMA_VERSION", "1")
+
+_generation = 0   # invalidate() 递增；连接记录的代数落后时先 DEALLOCATE ALL
+_states = weakref.WeakKeyDictionary()   # 连接 -> _ConnState
+_states_lock = threading.Lock()
+
+
+class Statement:
+    """一条登记的语句：原始 SQL (psycopg2 的 %s 占位符) 与转换后的 PREPARE 正文 ($1, $2 ...)。"""
+
+    __slots__ = ('name', 'sql', 'body', 'param_count')
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.body, self.param_count = _to_positional(sql)
+
+
+class _ConnState:
+    __slots__ = ('scope', 'generation', 'prepared')
+
+    def __init__(self):
+        self.scope = 'default'
+        self.generation = _generation
+        self.prepared = set()   # 已在该连接上 PREPARE 的语句名
+
+
+_registry = {}   # name -> Statement
+
+
+def _to_positional(sql):
+    """把 %s 换成 $1..$n、%% 换成 %。"""
+    out, n, i = [], 0, 0
+    while i < len(sql):
+        if sql.startswith('%%', i):
+            out.append('%')
+            i += 2
+        elif sql.startswith('%s', i):
+            n += 1
+            out.append(f'${n}')
+            i += 2
+        else:
+            out.append(sql[i])
+            i += 1
+    return ''.join(out), n
+
+
+def statement(name, sql):
+    """登记一条语句 (模块加载时调用)；同名语句的 SQL 必须一致。"""
+    existing = _registry.get(name)
+    if existing is not None:
+        if existing.sql != sql:
+            raise ValueError(f"预编译语句 {name} 已以不同的 SQL 登记")
+        return existing
+    stmt = _registry[name] = Statement(name, sql)
+    return stmt
+
+
+def _state(conn):
+    with _states_lock:
+        state = _states.get(conn)
+        if state is None:
+            state = _states[conn] = _ConnState()
+        return state
+
+
+def set_scope(conn, scope):
+    """记录连接当前的 search_path (get_db_connection 设置租户 schema 后调用)。"""
+    _state(conn).scope = scope or 'default'
+
+
+def set_search_path(cursor, schema):
+    """切换租户 schema 并同步作用域，之后的 execute 使用该租户自己的预编译语句。"""
+    cursor.execute("SET search_path TO %s, public", (schema,))
+    set_scope(cursor.connection, schema)
+
+
+def forget(conn):
+    """丢弃某连接上的登记 (连接被 DISCARD ALL 重置或归还给外部连接池时)。"""
+    with _states_lock:
+        _states.pop(conn, None)
+
+
+def invalidate():
+    """迁移后调用：本进程的所有连接在下次使用时先 DEALLOCATE ALL 再重新 PREPARE。"""
+    global _generation
+    with _states_lock:
+        _generation += 1
+
+
+def _stmt_name(stmt, scope):
+    digest = hashlib.sha1(f"{scope}|{SCHEMA_VERSION}|{stmt.sql}".encode('utf-8')).hexdigest()[:10]
+    return f"{stmt.name}_{digest}"
+
+
+def _is_stale(error):
+    if isinstance(error, (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.DuplicatePreparedStatement)):
+        return True
+    return isinstance(error, psycopg2.errors.FeatureNotSupported) and 'cached plan' in str(error)
+
+
+def execute(cursor, stmt, params=()):
+    """按名称执行登记的语句；结果照常用 cursor.fetchone() / fetchall() 读取。"""
+    if not PREPARED_ENABLED:
+        return cursor.execute(stmt.sql, params)
+    if len(params) != stmt.param_count:
+        raise ValueError(f"预编译语句 {stmt.name} 需要 {stmt.param_count} 个参数，传入了 {len(params)} 个")
+    conn = cursor.connection
+    state = _state(conn)
+    # 出错时只有事务中的第一条语句可以安全地回滚重试
+    first_in_tx = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    try:
+        return _execute(cursor, state, stmt, params)
+    except psycopg2.Error as e:
+        if not _is_stale(e):
+            raise
+        # 保留作用域，清空登记；下次使用时先 DEALLOCATE ALL
+        state.prepared.clear()
+        state.generation = -1
+        if not first_in_tx:
+            raise
+        if not conn.autocommit:
+            conn.rollback()
+        return _execute(cursor, state, stmt, params)
+
+
+def _execute(cursor, state, stmt, params):
+    prefix = ""
+    if state.generation != _generation:
+        prefix = "DEALLOCATE ALL; "
+        state.prepared.clear()
+        state.generation = _generation
+    name = _stmt_name(stmt, state.scope)
+    args = f"({', '.join(['%s'] * stmt.param_count)})" if stmt.param_count else ""
+    if name in state.prepared:
+        return cursor.execute(f"{prefix}EXECUTE {name}{args}", params)
+    # PREPARE 正文中的 % 需转义，避免被 psycopg2 当作占位符
+    body = stmt.body.replace('%', '%%')
+    try:
+        result = cursor.execute(f"{prefix}PREPARE {name} AS {body}; EXECUTE {name}{args}", params)
+    except psycopg2.Error as e:
+        if not _is_stale(e):
+            # PREPARE 不随事务回滚：EXECUTE 失败 (如约束冲突) 时语句已存在，照常登记
+            state.prepared.add(name)
+        raise
+    state.prepared.add(name)
+    return result
@@ -0,0 +1,166 @@
+# backend/lambda/layers/database_utils/tracing.py
+# 轻量的进程内请求追踪：每次调用构建一棵 span 树，结束时导出为一行结构化日志。
+#
+# 用法:
+#   @trace_handler('tenants')              # Lambda 入口：创建根 span，标记冷/热启动
+#   def handler(event, context): ...
+#
+#   with span('auth.jwt_decode'):          # 任意代码段
+#       ...
+#
+#   @traced('tenants.create')              # 普通函数
+#   def create_tenant(...): ...
+#
+# 导出位置由 TRACE_EXPORT 决定:
+#   log (默认)      -> 输出一行 JSON 到标准输出 (CloudWatch Logs)
+#   file:/path.jsonl -> 追加写入本地文件，便于本地调试与测试
+#   off             -> 不导出
+# 没有根 span 时 span()/traced 不做任何事，可放心在工具函数中使用。
+
+import functools
+import json
+import os
+import threading
+import time
+
+TRACE_EXPORT = os.environ.get('TRACE_EXPORT', 'log')
+MAX_CHILDREN = int(os.environ.get('TRACE_MAX_CHILDREN', '200'))
+
+_cold_start = True
+_local = threading.local()
+_file_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ('name', 'tags', 'started', 'duration_ms', 'children', 'dropped', 'error')
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self.children = []
+        self.dropped = 0
+        self.error = None
+
+    def set_tag(self, key, value):
+        self.tags[key] = value
+
+    def to_dict(self, origin):
+        node = {'name': self.name, 'start_ms': round((self.started - origin) * 1000, 3),
+                'duration_ms': round(self.duration_ms or 0, 3)}
+        if self.tags:
+            node['tags'] = self.tags
+        if self.error:
+            node['error'] = self.error
+        if self.children:
+            node['children'] = [c.to_dict(origin) for c in self.children]
+        if self.dropped:
+            node['dropped_children'] = self.dropped
+        return node
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def current_span():
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+class span:
+    """子 span 的上下文管理器；不在追踪中时为空操作。"""
+
+    __slots__ = ('name', 'tags', 'span')
+
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+        self.span = None
+
+    def __enter__(self):
+        parent = current_span()
+        if parent is None:
+            return None
+        self.span = Span(self.name, self.tags)
+        if len(parent.children) < MAX_CHILDREN:
+            parent.children.append(self.span)
+        else:
+            parent.dropped += 1
+        _stack().append(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is None:
+            return False
+        self.span.duration_ms = (time.perf_counter() - self.span.started) * 1000
+        if exc_type is not None:
+            self.span.error = exc_type.__name__
+        _stack().pop()
+        return False
+
+
+def traced(name=None):
+    """函数装饰器：把整个函数调用记为一个 span。"""
+    def decorate(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def export(trace):
+    if TRACE_EXPORT == 'off':
+        return
+    line = json.dumps(trace, ensure_ascii=False, default=str)
+    if TRACE_EXPORT.startswith('file:'):
+        with _file_lock, open(TRACE_EXPORT[5:], 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+    else:
+        print(line)
+
+
+def trace_handler(name=None):
+    """Lambda 入口装饰器：创建根 span，结束时导出整棵树。"""
+    def decorate(func):
+        function_name = name or os.environ.get('AWS_LAMBDA_FUNCTION_NAME') or func.__module__
+
+        @functools.wraps(func)
+        def wrapper(event, context, *args, **kwargs):
+            global _cold_start
+            cold, _cold_start = _cold_start, False
+            root = Span(function_name, {'cold_start': cold})
+            if context is not None and hasattr(context, 'aws_request_id'):
+                root.tags['request_id'] = context.aws_request_id
+            if isinstance(event, dict):
+                http = (event.get('requestContext') or {}).get('http') or {}
+                root.tags['method'] = http.get('method') or event.get('httpMethod')
+                root.tags['path'] = event.get('rawPath') or event.get('path')
+            stack = _stack()
+            saved = list(stack)
+            stack[:] = [root]
+            try:
+                response = func(event, context, *args, **kwargs)
+                if isinstance(response, dict):
+                    root.tags['status_code'] = response.get('statusCode')
+                return response
+            except Exception as e:
+                root.error = type(e).__name__
+                raise
+            finally:
+                root.duration_ms = (time.perf_counter() - root.started) * 1000
+                stack[:] = saved
+                try:
+                    export({'trace': root.to_dict(root.started)})
+                except Exception as e:  # 追踪失败不能影响业务响应
+                    print(f"[TRACE_ERROR] 导出追踪失败: {e}")
+        return wrapper
+    return decorate
@@ -2,7 +2,13 @@
 import json
 import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from costing import consume, record_adjustment, record_inbound, snapshot_order_costs
+from fulfillment import RoutingError, default_inbound_location, plan_order_shipments
+from reservations import enqueue, fulfill_order, requeue_backorders, reserved_by_others
+from rollups import ensure_tables as ensure_rollup_tables, record_order_completion, reverse_order_completion
+from stock_shards import InsufficientStockError, decrement_stock, increment_stock
+import prepared
 
 # 数据库连接信息
 DB_HOST = os.environ.get('DB_HOST')
@@ -10,6 +16,15 @@ DB_USER = os.environ.get('DB_USER')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
 DB_NAME = os.environ.get('DB_NAME')
 
+# 出库类订单及其库存流水类型；其余类型 (purchase, return_sales) 视为入库
+OUTBOUND_LOG_TYPES = {'sales': 'outbound', 'return_purchase': 'outbound'}
+
+# 按 ID 查订单的热点语句 (见 prepared)
+ORDER_BY_ID = prepared.statement('order_by_id', "SELECT * FROM orders WHERE id = %s")
+ORDER_ITEMS_BY_ORDER = prepared.statement('order_items_by_order', "SELECT * FROM order_items WHERE order_id = %s")
+# 状态流转时锁定订单行，同一订单的并发流转串行执行
+ORDER_STATE_BY_ID = prepared.statement('order_state_by_id', "SELECT type, status FROM orders WHERE id = %s FOR UPDATE")
+
 def get_db_connection():
     conn = psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME)
     return conn
@@ -21,21 +36,22 @@ def lambda_handler(event, context):
     path_parts = path.strip('/').split('/')
     
     body = json.loads(event.get('body', '{}'))
+    tenant_id = event.get('requestContext', {}).get('authorizer', {}).get('tenant_id')
 
     # 路由: /orders, /orders/{id}, /orders/{id}/status
     if path_parts[0] == 'orders':
         order_id = path_parts[1] if len(path_parts) > 1 else None
         
         if order_id and len(path_parts) > 2 and path_parts[2] == 'status':
-            return handle_order_status_update(order_id, body)
+            return handle_order_status_update(order_id, body, tenant_id)
         elif order_id:
-            return handle_single_order(method, order_id)
+            return handle_single_order(method, order_id, tenant_id)
         else:
-            return handle_multiple_orders(method, body, event.get('queryStringParameters', {}))
+            return handle_multiple_orders(method, body, event.get('queryStringParameters', {}), tenant_id)
 
     return {'statusCode': 404, 'body': json.dumps({'error': '资源未找到'})}
 
-def handle_multiple_orders(method, body, query_params):
+def handle_multiple_orders(method, body, query_params, tenant_id=None):
     """处理订单的批量获取和创建。"""
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -61,11 +77,11 @@ def handle_multiple_orders(method, body, query_params):
             # 创建新订单
             # body: { type, partner_id, user_id, total_amount, items: [...] }
             order = body
-            # 1. 插入主订单表
+            # 1. 插入主订单表 (带租户，日汇总回填按此列归属)
             cursor.execute(
-                """INSERT INTO orders (type, partner_id, user_id, total_amount, status, order_no)
-                   VALUES (%s, %s, %s, %s, 'draft', 'TEMP') RETURNING id""",
-                (order['type'], order['partner_id'], order['user_id'], order['total_amount'])
+                """INSERT INTO orders (type, partner_id, user_id, total_amount, status, order_no, tenant_id)
+                   VALUES (%s, %s, %s, %s, 'draft', 'TEMP', %s) RETURNING id""",
+                (order['type'], order['partner_id'], order['user_id'], order['total_amount'], tenant_id)
             )
             order_id = cursor.fetchone()['id']
             
@@ -81,11 +97,10 @@ def handle_multiple_orders(method, body, query_params):
                     (order_id, item['product_id'], item['quantity'], item['unit_price'], item['total_price'])
                 )
 
-            # [重要] 库存联动：如果是销售单，需检查并预扣库存
+            # [重要] 库存联动：销售单只登记预占任务，由 reservations.worker_handler 异步批量分配，
+            # 下单请求本身不锁任何库存行
             if order['type'] == 'sales':
-                # 此处应调用库存服务检查库存，为简化，我们暂时只记录
-                # 在实际场景中，这里可能会触发一个“待出库”状态
-                pass
+                enqueue(cursor, order_id, 'allocate')
                 
             conn.commit()
             return {'statusCode': 201, 'body': json.dumps({'id': order_id, 'order_no': order_no})}
@@ -97,7 +112,7 @@ def handle_multiple_orders(method, body, query_params):
         cursor.close()
         conn.close()
 
-def handle_single_order(method, order_id):
+def handle_single_order(method, order_id, tenant_id=None):
     """处理单个订单的获取和删除。"""
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -105,26 +120,33 @@ def handle_single_order(method, order_id):
     try:
         if method == 'GET':
             # 获取订单主信息
-            cursor.execute("SELECT * FROM orders WHERE id = %s", (order_id,))
+            prepared.execute(cursor, ORDER_BY_ID, (order_id,))
             order = cursor.fetchone()
             if not order:
                 return {'statusCode': 404, 'body': json.dumps({'error': '订单未找到'})}
             
             # 获取订单明细
-            cursor.execute("SELECT * FROM order_items WHERE order_id = %s", (order_id,))
+            prepared.execute(cursor, ORDER_ITEMS_BY_ORDER, (order_id,))
             order['items'] = cursor.fetchall()
             return {'statusCode': 200, 'body': json.dumps(order, default=str)}
         
         elif method == 'DELETE': # 通常是取消，而不是物理删除
             # 实际业务中很少物理删除，而是更新状态为 'cancelled'
-            cursor.execute("UPDATE orders SET status = 'cancelled' WHERE id = %s RETURNING id", (order_id,))
-            updated = cursor.fetchone()
-            conn.commit()
-            if updated:
-                # [重要] 库存联动: 如果是已批准的销售单被取消，需要释放预扣的库存
-                return {'statusCode': 200, 'body': json.dumps({'message': '订单已取消'})}
-            else:
+            prepared.execute(cursor, ORDER_STATE_BY_ID, (order_id,))
+            previous = cursor.fetchone()
+            if not previous:
                 return {'statusCode': 404, 'body': json.dumps({'error': '订单未找到'})}
+            # 重复取消不再冲回汇总、不再入队
+            if previous['status'] != 'cancelled':
+                if previous['type'] == 'sales' and previous['status'] == 'completed':
+                    # 已计入日汇总的收入与成本在原完成日冲回
+                    reverse_order_completion(cursor, order_id, tenant_id)
+                cursor.execute("UPDATE orders SET status = 'cancelled' WHERE id = %s", (order_id,))
+                if previous['type'] == 'sales':
+                    # [重要] 库存联动: 销售单被取消，异步释放预占的库存
+                    enqueue(cursor, order_id, 'release')
+            conn.commit()
+            return {'statusCode': 200, 'body': json.dumps({'message': '订单已取消'})}
 
     except (Exception, psycopg2.Error) as error:
         conn.rollback()
@@ -133,7 +155,7 @@ def handle_single_order(method, order_id):
         cursor.close()
         conn.close()
 
-def handle_order_status_update(order_id, body):
+def handle_order_status_update(order_id, body, tenant_id=None):
     """处理订单状态的流转，这是工作流的核心。"""
     new_status = body.get('status')
     if not new_status:
@@ -144,7 +166,7 @@ def handle_order_status_update(order_id, body):
 
     try:
         # 1. 获取当前订单信息，特别是类型和当前状态
-        cursor.execute("SELECT type, status FROM orders WHERE id = %s", (order_id,))
+        prepared.execute(cursor, ORDER_STATE_BY_ID, (order_id,))
         order = cursor.fetchone()
         if not order:
             return {'statusCode': 404, 'body': json.dumps({'error': '订单未找到'})}
@@ -153,49 +175,84 @@ def handle_order_status_update(order_id, body):
         # if order['status'] != 'pending_approval' and new_status == 'approved':
         #     return {'statusCode': 400, 'body': json.dumps({'error': '订单状态不正确，无法批准'})}
 
-        # 2. 更新订单状态
-        cursor.execute("UPDATE orders SET status = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (new_status, order_id))
+        # 重复提交当前状态不再扣库存、不再计收入；已完成的订单只能取消，已取消的订单不能再流转
+        if order['status'] == new_status:
+            return {'statusCode': 200, 'body': json.dumps({'message': f'订单 {order_id} 已是 {new_status} 状态', 'shipments': []})}
+        if order['status'] == 'cancelled' or (order['status'] == 'completed' and new_status != 'cancelled'):
+            return {'statusCode': 409, 'body': json.dumps({'error': f"订单当前为 {order['status']}，不能改为 {new_status}"})}
+        if order['status'] == 'completed' and order['type'] == 'sales':
+            # 取消已完成的销售单：在原完成日冲回已计入日汇总的收入与成本
+            reverse_order_completion(cursor, order_id, tenant_id)
+
+        # 2. 更新订单状态；完成时记下完成时间 (日汇总按它取日期，之后的修改不影响)
+        ensure_rollup_tables(cursor)
+        cursor.execute(
+            """UPDATE orders SET status = %s, updated_at = CURRENT_TIMESTAMP,
+                   completed_at = CASE WHEN %s = 'completed' THEN CURRENT_TIMESTAMP ELSE completed_at END
+               WHERE id = %s""",
+            (new_status, new_status, order_id))
+
+        if new_status == 'cancelled' and order['type'] == 'sales':
+            enqueue(cursor, order_id, 'release')
 
         # 3. [核心] 根据新状态触发库存变动
+        shipments = []
         if new_status == 'completed':
-            cursor.execute("SELECT * FROM order_items WHERE order_id = %s", (order_id,))
+            cursor.execute("SELECT product_id, quantity, unit_price FROM order_items WHERE order_id = %s", (order_id,))
             items = cursor.fetchall()
-            
-            # 假设默认仓库ID为 'your_default_warehouse_id' (实际应从配置或订单中获取)
-            warehouse_id = '00000000-0000-0000-0000-000000000001' # 临时硬编码
-
-            for item in items:
-                change_qty = item['quantity']
-                log_type = ''
 
+            if order['type'] in OUTBOUND_LOG_TYPES:
+                # 出库：按路由策略为每一行挑选实际的仓库/货架，必要时拆单
+                shipments = plan_order_shipments(cursor, order_id, items, body.get('routing_policy'), body.get('origin'))
+                # 本单自己的预占可以出库，其他订单的预占须保留
+                reserved = reserved_by_others(cursor, [(s['warehouse_id'], s['product_id'], s['location_code']) for s in shipments],
+                                              order_id if order['type'] == 'sales' else None)
+                for s in shipments:
+                    decrement_stock(cursor, s['warehouse_id'], s['product_id'], s['location_code'], s['quantity'],
+                                    reserved=reserved[(str(s['warehouse_id']), str(s['product_id']), s['location_code'])])
+                logs = [(s['product_id'], s['warehouse_id'], -s['quantity'], OUTBOUND_LOG_TYPES[order['type']], order_id, None) for s in shipments]
                 if order['type'] == 'sales':
-                    change_qty = -change_qty
-                    log_type = 'outbound'
-                elif order['type'] == 'purchase':
-                    log_type = 'inbound'
-                elif order['type'] == 'return_sales':
-                    log_type = 'inbound'
-                elif order['type'] == 'return_purchase':
-                    change_qty = -change_qty
-                    log_type = 'outbound'
-                
-                # 更新库存
-                cursor.execute(
-                    """INSERT INTO stocks (warehouse_id, product_id, quantity)
-                       VALUES (%s, %s, %s)
-                       ON CONFLICT (warehouse_id, product_id) DO UPDATE SET quantity = stocks.quantity + %s""",
-                    (warehouse_id, item['product_id'], change_qty, change_qty)
-                )
-                # 记录流水
-                cursor.execute(
-                    """INSERT INTO inventory_logs (product_id, warehouse_id, change_qty, type, reference_id)
-                       VALUES (%s, %s, %s, %s, %s)""",
-                    (item['product_id'], warehouse_id, change_qty, log_type, order_id)
-                )
+                    # 出库成本固化到 order_items，之后的利润报表不受商品成本变动影响
+                    snapshot_order_costs(cursor, order_id)
+                    fulfill_order(cursor, order_id)
+                    record_order_completion(cursor, order_id, tenant_id)
+                else:
+                    for item in items:
+                        consume(cursor, item['product_id'], item['quantity'])
+            else:
+                # 入库：写入请求指定的仓库，未指定时写入路由优先级最高的仓库
+                warehouse_id, location_code = default_inbound_location(cursor, body.get('warehouse_id'))
+                location_code = body.get('location_code') or location_code
+                for item in items:
+                    increment_stock(cursor, warehouse_id, item['product_id'], location_code, item['quantity'])
+                    if order['type'] == 'purchase':
+                        record_inbound(cursor, item['product_id'], item['quantity'], item['unit_price'])
+                    else:
+                        # 销售退货按当前平均成本回库
+                        record_adjustment(cursor, item['product_id'], item['quantity'])
+                    shipments.append({'warehouse_id': warehouse_id, 'product_id': item['product_id'],
+                                      'location_code': location_code, 'quantity': item['quantity']})
+                logs = [(item['product_id'], warehouse_id, item['quantity'], 'inbound', order_id,
+                         item['unit_price'] if order['type'] == 'purchase' else None) for item in items]
+                # 到货后重新为这些商品上的缺货订单分配
+                requeue_backorders(cursor, sorted({str(item['product_id']) for item in items}))
+
+            # 记录流水 (一次批量写入)；入库行带上单位成本，供 costing.rebuild 重放
+            execute_values(
+                cursor,
+                "INSERT INTO inventory_logs (product_id, warehouse_id, change_qty, type, reference_id, unit_cost) VALUES %s",
+                logs)
 
         conn.commit()
-        return {'statusCode': 200, 'body': json.dumps({'message': f'订单 {order_id} 状态已更新为 {new_status}'})}
+        return {'statusCode': 200, 'body': json.dumps({'message': f'订单 {order_id} 状态已更新为 {new_status}', 'shipments': shipments}, default=str)}
 
+    except RoutingError as error:
+        conn.rollback()
+        return {'statusCode': 409, 'body': json.dumps({'error': str(error), 'shortfall': error.shortfall})}
+    except InsufficientStockError as error:
+        # 规划之后库存被其他出库扣减或被其他订单分配
+        conn.rollback()
+        return {'statusCode': 409, 'body': json.dumps({'error': str(error)})}
     except (Exception, psycopg2.Error) as error:
         conn.rollback()
         return {'statusCode': 500, 'body': json.dumps({'error': f'数据库操作失败: {error}'})}
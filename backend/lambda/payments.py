@@ -0,0 +1,124 @@
+# backend/lambda/payments.py
+# 收付款入账：一次集合操作写入任意条财务流水，并增量维护订单已付金额与往来单位余额。
+#
+# - orders.paid_amount 为累计已付金额，入账时 UPDATE ... RETURNING 原子累加，
+#   支付状态 (partial / paid) 在同一条语句中由累加后的金额推导，不再 SUM 历史流水。
+# - 同一批次内按订单、往来单位先分组求和，每张订单、每个往来单位只更新一次，
+#   且按主键排序更新，并发导入之间不会死锁。
+# - 单笔 POST 与批量导入 (/finance/transactions/import) 共用 apply_payments。
+
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from psycopg2.extras import execute_values
+
+import ddl
+from rollups import record_transactions
+
+TRANSACTION_COLUMNS = ['partner_id', 'order_id', 'type', 'amount', 'payment_method', 'description']
+AMOUNT_LIMIT = Decimal('1e12')
+
+# 首次部署时增加 paid_amount 列，并用已有流水初始化
+CREATE_PAID_AMOUNT_SQL = """
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = 'orders' AND column_name = 'paid_amount') THEN
+        ALTER TABLE orders ADD COLUMN paid_amount NUMERIC(14, 2) NOT NULL DEFAULT 0;
+        UPDATE orders o SET paid_amount = t.paid
+        FROM (SELECT order_id, SUM(amount) AS paid FROM financial_transactions
+              WHERE order_id IS NOT NULL GROUP BY order_id) t
+        WHERE o.id = t.order_id;
+    END IF;
+END $$;
+"""
+
+_tables_ready = False
+
+
+class PaymentValidationError(ValueError):
+    """导入行缺少必填字段或类型不合法，line 为出错行的序号 (从 0 开始)；lines 本身不是数组时为 None。"""
+
+    def __init__(self, message, line):
+        super().__init__(message)
+        self.line = line
+
+
+def ensure_tables(cursor):
+    global _tables_ready
+    if not _tables_ready:
+        _tables_ready = ddl.apply(cursor, CREATE_PAID_AMOUNT_SQL)
+
+
+def _validate(lines):
+    if not isinstance(lines, list):
+        raise PaymentValidationError("lines 必须为数组", None)
+    rows = []
+    for i, line in enumerate(lines):
+        if not isinstance(line, dict):
+            raise PaymentValidationError(f"第 {i} 行: 必须为对象", i)
+        if line.get('type') not in ('income', 'expense'):
+            raise PaymentValidationError(f"第 {i} 行: type 必须为 income 或 expense", i)
+        if line.get('amount') in (None, ''):
+            raise PaymentValidationError(f"第 {i} 行: 缺少 amount", i)
+        try:
+            amount = Decimal(str(line['amount']))
+        except InvalidOperation:
+            raise PaymentValidationError(f"第 {i} 行: amount 不是合法的金额", i) from None
+        # financial_transactions.amount 为 NUMERIC(14, 2)
+        if not amount.is_finite() or abs(amount) >= AMOUNT_LIMIT:
+            raise PaymentValidationError(f"第 {i} 行: amount 超出范围", i)
+        rows.append(tuple(amount if k == 'amount' else line.get(k) for k in TRANSACTION_COLUMNS))
+    return rows
+
+
+def apply_payments(cursor, lines, tenant_id=None):
+    """
+    写入一批收付款并更新订单支付状态与往来单位余额。
+    lines: [{partner_id, order_id, type, amount, payment_method, description}]；tenant_id 取自授权方声明，
+    写入流水并用于日汇总。
+    返回 (新流水列表, 受影响订单的 [{id, paid_amount, payment_status}])。
+    """
+    rows = _validate(lines)
+    if not rows:
+        return [], []
+    ensure_tables(cursor)
+
+    # 1. 批量写入流水 (带租户，日汇总回填按此列归属)
+    transactions = execute_values(
+        cursor,
+        """INSERT INTO financial_transactions (partner_id, order_id, type, amount, payment_method, description, tenant_id)
+           VALUES %s RETURNING *""",
+        [(*row, tenant_id) for row in rows], page_size=1000, fetch=True)
+
+    # 2. 分组：收款减少往来单位欠款，付款增加欠款；订单累计所有收付金额
+    order_paid = defaultdict(Decimal)
+    balance_change = defaultdict(Decimal)
+    for t in transactions:
+        amount = Decimal(t['amount'] or 0)
+        if t['order_id']:
+            order_paid[str(t['order_id'])] += amount
+        if t['partner_id']:
+            balance_change[str(t['partner_id'])] += -amount if t['type'] == 'income' else amount
+
+    orders = []
+    if order_paid:
+        orders = execute_values(
+            cursor,
+            """UPDATE orders o SET
+                   paid_amount = o.paid_amount + v.amount,
+                   payment_status = CASE WHEN o.paid_amount + v.amount >= o.total_amount THEN 'paid' ELSE 'partial' END
+               FROM (VALUES %s) AS v(id, amount)
+               WHERE o.id = v.id::uuid
+               RETURNING o.id, o.paid_amount, o.payment_status""",
+            sorted(order_paid.items()), template='(%s, %s::numeric)', page_size=1000, fetch=True)
+    if balance_change:
+        execute_values(
+            cursor,
+            """UPDATE partners p SET balance = p.balance + v.delta
+               FROM (VALUES %s) AS v(id, delta) WHERE p.id = v.id::uuid""",
+            sorted(balance_change.items()), template='(%s, %s::numeric)', page_size=1000)
+
+    # 3. 累加日汇总
+    record_transactions(cursor, transactions, tenant_id)
+    return transactions, orders
@@ -3,12 +3,26 @@ import json
 import os
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from costing import snapshot_order_costs
+from payments import ensure_tables as ensure_payment_tables
+from reservations import reserved_by_others
+from stock_shards import decrement_stock
+from rollups import ensure_tables as ensure_rollup_tables, record_order_completion, record_transactions
+from admission import Throttled, apply_settings, begin as admit
+import prepared
 
 DB_HOST = os.environ.get('DB_HOST')
 DB_USER = os.environ.get('DB_USER')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
 DB_NAME = os.environ.get('DB_NAME')
 
+ORDER_ITEM_INSERT = prepared.statement(
+    'pos_order_item_insert',
+    "INSERT INTO order_items (order_id, product_id, quantity, unit_price, total_price) VALUES (%s, %s, %s, %s, %s)")
+OUTBOUND_LOG_INSERT = prepared.statement(
+    'pos_outbound_log_insert',
+    "INSERT INTO inventory_logs (product_id, warehouse_id, change_qty, type, reference_id) VALUES (%s, %s, %s, 'outbound', %s)")
+
 def get_db_connection():
     return psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME)
 
@@ -16,12 +30,20 @@ def lambda_handler(event, context):
     """POS 收银台主处理函数，用于快速处理一笔完整的零售交易。"""
     if event.get('httpMethod') != 'POST':
         return {'statusCode': 405, 'body': json.dumps({'error': '仅支持POST方法'})}
+    try:
+        # 租户准入：POS 类令牌桶 (本模块未经 @instrument)
+        admit(event)
+    except Throttled as e:
+        return {'statusCode': 429, 'headers': {'Retry-After': str(e.retry_after)}, 'body': json.dumps({'error': str(e)})}
 
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     body = json.loads(event.get('body', '{}'))
+    tenant_id = event.get('requestContext', {}).get('authorizer', {}).get('tenant_id')
 
     try:
+        # POS 类会话参数 (短 statement_timeout、小 work_mem)
+        apply_settings(cursor, tenant_id, 'pos')
         # body: { user_id, partner_id, warehouse_id, total_amount, payment_method, items: [...] }
         # items: [{ product_id, location_code, quantity, unit_price, total_price }]
         user_id = body.get('user_id')
@@ -37,44 +59,47 @@ def lambda_handler(event, context):
         order_status = 'completed'
         payment_status = 'paid'
         
+        # 现款结清：paid_amount 直接等于订单金额 (见 payments)；带租户与完成时间 (见 rollups)
+        ensure_payment_tables(cursor)
+        ensure_rollup_tables(cursor)
         cursor.execute(
-            """INSERT INTO orders (type, partner_id, user_id, total_amount, status, payment_status, order_no)
-               VALUES (%s, %s, %s, %s, %s, %s, 'TEMP') RETURNING id""",
-            (order_type, partner_id, user_id, total_amount, order_status, payment_status)
+            """INSERT INTO orders (type, partner_id, user_id, total_amount, status, payment_status, paid_amount, order_no,
+                                   tenant_id, completed_at)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, 'TEMP', %s, CURRENT_TIMESTAMP) RETURNING id""",
+            (order_type, partner_id, user_id, total_amount, order_status, payment_status, total_amount, tenant_id)
         )
         order_id = cursor.fetchone()['id']
         order_no = f"POS-{order_id.split('-')[0].upper()}"
         cursor.execute("UPDATE orders SET order_no = %s WHERE id = %s", (order_no, order_id))
 
         # --- 2. 插入订单明细并扣减库存 ---
+        # 其他订单已分配的预占不能卖给散客 (一次查询全部行，同时与分配 worker 互斥)
+        reserved = reserved_by_others(cursor, [(warehouse_id, item.get('product_id'), item.get('location_code')) for item in items])
         for item in items:
             p_id, loc, qty, price, total = [item.get(k) for k in ['product_id', 'location_code', 'quantity', 'unit_price', 'total_price']]
             
             # a. 插入订单明细
-            cursor.execute(
-                """INSERT INTO order_items (order_id, product_id, quantity, unit_price, total_price)
-                   VALUES (%s, %s, %s, %s, %s)""", (order_id, p_id, qty, price, total))
+            prepared.execute(cursor, ORDER_ITEM_INSERT, (order_id, p_id, qty, price, total))
 
-            # b. 检查并扣减库存
-            cursor.execute("SELECT quantity FROM stocks WHERE warehouse_id=%s AND product_id=%s AND location_code=%s FOR UPDATE", (warehouse_id, p_id, loc))
-            stock = cursor.fetchone()
-            if not stock or stock['quantity'] < qty:
-                raise Exception(f"商品 {p_id} 在货架 {loc} 库存不足")
-            
-            cursor.execute("UPDATE stocks SET quantity = quantity - %s WHERE warehouse_id=%s AND product_id=%s AND location_code=%s", (qty, warehouse_id, p_id, loc))
+            # b. 检查并扣减库存 (热点商品走分片计数，见 stock_shards)
+            decrement_stock(cursor, warehouse_id, p_id, loc, qty,
+                            reserved=reserved[(str(warehouse_id), str(p_id), loc)])
 
             # c. 记录库存流水
-            cursor.execute(
-                """INSERT INTO inventory_logs (product_id, warehouse_id, change_qty, type, reference_id)
-                   VALUES (%s, %s, %s, 'outbound', %s)""", (p_id, warehouse_id, -qty, order_id))
+            prepared.execute(cursor, OUTBOUND_LOG_INSERT, (p_id, warehouse_id, -qty, order_id))
 
         # --- 3. 创建财务收款记录 ---
         cursor.execute(
-            """INSERT INTO financial_transactions (partner_id, order_id, type, amount, payment_method, description)
-               VALUES (%s, %s, 'income', %s, %s, %s)""",
-            (partner_id, order_id, total_amount, payment_method, f"POS 销售单 {order_no}")
+            """INSERT INTO financial_transactions (partner_id, order_id, type, amount, payment_method, description, tenant_id)
+               VALUES (%s, %s, 'income', %s, %s, %s, %s) RETURNING partner_id, type, amount, payment_method, created_at""",
+            (partner_id, order_id, total_amount, payment_method, f"POS 销售单 {order_no}", tenant_id)
         )
         # 注意：这里没有像之前一样更新 partner balance，因为对于匿名散客，通常不维护其长期余额
+
+        # --- 4. 累加日汇总 (报表不再扫描明细) ---
+        record_transactions(cursor, [cursor.fetchone()], tenant_id)
+        snapshot_order_costs(cursor, order_id)
+        record_order_completion(cursor, order_id, tenant_id)
         
         conn.commit()
         return {'statusCode': 200, 'body': json.dumps({'message': '交易成功', 'order_id': order_id, 'order_no': order_no})}
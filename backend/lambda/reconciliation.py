@@ -0,0 +1,390 @@
+# backend/lambda/reconciliation.py
+# 银行对账：流式读取 CSV / OFX 对账单，与未结清的应收 (销售单) / 应付 (采购单) 自动匹配，
+# 匹配成功的行通过 payments.apply_payments 一次性入账。
+#
+# - 未结清订单在内存中建两套索引：
+#     按 (方向, 金额分) 分桶 —— 精确金额 O(1) 查找；
+#     按单号归一化后的哈希 —— 对账单摘要/参考号中出现单号即可命中 (同号的订单按先后排队)。
+#   另为每个方向维护一份有序金额列表，容差匹配用 bisect 查找，整体近似线性。
+# - 匹配顺序: 单号+金额 -> 单号 (部分付款) -> 唯一精确金额 -> 容差窗口内最接近的金额。
+# - 只匹配调用方租户的订单 (orders.tenant_id)，不会把一个租户的对账单入账到其他租户的订单上。
+# - 每一行对账单按 (日期, 金额, 参考号, 摘要) 计算哈希，按 (租户, 哈希) 记入 bank_statement_lines，
+#   重复导入同一文件不会重复入账；不同租户的相同流水互不影响。
+#   同一文件中完全相同的多行 (如两笔相同的手续费) 按出现次数区分，第 n 次出现的哈希带上序号。
+# - 对账单按 RECONCILE_CHUNK_SIZE 行分块流式处理：逐块查询已导入的哈希并匹配，只保留匹配结果与未匹配样本。
+# - 入账前先以 INSERT ... ON CONFLICT DO NOTHING RETURNING 登记匹配行，只为本次登记成功的行入账：
+#   并发上传同一文件时，后到的事务在唯一索引上等待先到的提交，随后这些行按重复处理，不会重复入账。
+
+import bisect
+import csv
+import hashlib
+import os
+import re
+from collections import defaultdict, deque
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from psycopg2.extras import execute_values
+
+import ddl
+from payments import apply_payments
+from payments import ensure_tables as ensure_payment_tables
+
+DEFAULT_TOLERANCE_CENTS = int(os.environ.get('RECONCILE_TOLERANCE_CENTS', '100'))
+BANK_PAYMENT_METHOD = os.environ.get('RECONCILE_PAYMENT_METHOD', '银行转账')
+UNMATCHED_SAMPLE_SIZE = 200
+RECONCILE_CHUNK_SIZE = int(os.environ.get('RECONCILE_CHUNK_SIZE', '1000'))
+
+# 早期版本按 line_hash 全局唯一：补 tenant_id 列 (按已入账流水的租户回填) 并改为 (tenant_id, line_hash) 主键
+CREATE_STATEMENT_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS bank_statement_lines (
+    tenant_id VARCHAR(100) NOT NULL DEFAULT '',
+    line_hash CHAR(40) NOT NULL,
+    posted_on DATE,
+    amount NUMERIC(14, 2) NOT NULL,
+    reference VARCHAR(255),
+    transaction_id UUID,
+    imported_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (tenant_id, line_hash)
+);
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = 'bank_statement_lines'
+                     AND column_name = 'tenant_id') THEN
+        ALTER TABLE bank_statement_lines ADD COLUMN tenant_id VARCHAR(100) NOT NULL DEFAULT '';
+        UPDATE bank_statement_lines b SET tenant_id = ft.tenant_id::text
+        FROM financial_transactions ft WHERE ft.id = b.transaction_id AND ft.tenant_id IS NOT NULL;
+        ALTER TABLE bank_statement_lines DROP CONSTRAINT bank_statement_lines_pkey;
+        ALTER TABLE bank_statement_lines ADD PRIMARY KEY (tenant_id, line_hash);
+    END IF;
+END $$;
+"""
+
+# CSV 表头别名 (小写)
+CSV_COLUMNS = {
+    'date': ('date', 'posted_on', 'transaction_date', '日期', '交易日期'),
+    'amount': ('amount', 'amt', '金额', '交易金额'),
+    'reference': ('reference', 'ref', 'fitid', '参考号', '流水号'),
+    'description': ('description', 'memo', 'name', '摘要', '备注'),
+}
+
+_TOKEN_RE = re.compile(r'[A-Z0-9][A-Z0-9\-_/]{3,}')
+_OFX_TAG_RE = re.compile(r'<(/?\w+)>([^<\r\n]*)')
+
+_tables_ready = False
+
+
+class StatementFormatError(ValueError):
+    """对账单格式无法识别。"""
+
+
+def ensure_tables(cursor):
+    global _tables_ready
+    if not _tables_ready:
+        _tables_ready = ddl.apply(cursor, CREATE_STATEMENT_TABLE_SQL)
+
+
+def _to_cents(value):
+    return int((Decimal(value) * 100).to_integral_value())
+
+
+def _normalize_ref(text):
+    return re.sub(r'[^A-Z0-9]', '', (text or '').upper())
+
+
+def _ref_key(text):
+    """单号的哈希键：去掉分隔符后取 8 字节 blake2b，索引只保存定长整数。"""
+    return int.from_bytes(hashlib.blake2b(_normalize_ref(text).encode(), digest_size=8).digest(), 'big')
+
+
+def _parse_date(value):
+    """支持 2024-01-31、2024/01/31、31/01/2024 以及 OFX 的 20240131120000[-8:CST]。"""
+    value = (value or '').strip()
+    for fmt, width in (('%Y-%m-%d', 10), ('%Y/%m/%d', 10), ('%d/%m/%Y', 10), ('%Y%m%d', 8)):
+        try:
+            return datetime.strptime(value[:width], fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+# --- 对账单解析 (生成器，逐行产出，不把整个文件读入内存) ---
+
+def parse_csv(stream):
+    reader = csv.reader(stream)
+    header = [h.strip().lower() for h in next(reader, [])]
+    index = {}
+    for field, aliases in CSV_COLUMNS.items():
+        for alias in aliases:
+            if alias in header:
+                index[field] = header.index(alias)
+                break
+    if 'amount' not in index:
+        raise StatementFormatError('CSV 对账单缺少金额列')
+    for line_no, row in enumerate(reader, start=1):
+        if not row:
+            continue
+        get = lambda f: row[index[f]].strip() if f in index and index[f] < len(row) else ''
+        try:
+            amount = Decimal(get('amount').replace(',', ''))
+        except InvalidOperation:
+            continue
+        yield {'line_no': line_no, 'date': _parse_date(get('date')), 'amount': amount,
+               'reference': get('reference'), 'description': get('description')}
+
+
+def parse_ofx(stream):
+    """解析 OFX (SGML 或 XML，单行或多行) 中的 <STMTTRN> 记录。"""
+    current, line_no = None, 0
+    for raw in stream:
+        for tag, value in _OFX_TAG_RE.findall(raw):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                current = {}
+            elif tag == '/STMTTRN' and current is not None:
+                line_no += 1
+                try:
+                    amount = Decimal(current.get('TRNAMT', ''))
+                except InvalidOperation:
+                    current = None
+                    continue
+                yield {'line_no': line_no, 'date': _parse_date(current.get('DTPOSTED')), 'amount': amount,
+                       'reference': current.get('REFNUM') or current.get('FITID', ''),
+                       'description': ' '.join(filter(None, [current.get('NAME'), current.get('MEMO')]))}
+                current = None
+            elif current is not None and tag in ('TRNAMT', 'DTPOSTED', 'FITID', 'NAME', 'MEMO', 'REFNUM'):
+                current[tag] = value.strip()
+
+
+def parse_statement(stream, fmt=None):
+    """按格式返回对账单行的生成器；fmt 缺省时按内容首行判断。"""
+    if fmt is None:
+        first = stream.readline()
+        fmt = 'ofx' if 'OFX' in first.upper() or first.lstrip().startswith('<') else 'csv'
+        stream = _prepend(first, stream)
+    if fmt == 'csv':
+        return parse_csv(stream)
+    if fmt == 'ofx':
+        return parse_ofx(stream)
+    raise StatementFormatError(f'不支持的对账单格式: {fmt}')
+
+
+def _prepend(first, stream):
+    yield first
+    yield from stream
+
+
+def statement_line_hash(line, occurrence=0):
+    """occurrence 为该行在文件中第几次重复出现 (从 0 开始)；首次出现的哈希与不带序号时相同。"""
+    text = f"{line['date']}|{line['amount']}|{line['reference']}|{line['description']}"
+    if occurrence:
+        text += f"#{occurrence}"
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def hash_lines(lines):
+    """逐行计算哈希 (生成器)；完全相同的行按出现次数区分。"""
+    occurrences = defaultdict(int)
+    for line in lines:
+        base = statement_line_hash(line)
+        seen = occurrences[base]
+        line['hash'] = statement_line_hash(line, seen) if seen else base
+        occurrences[base] = seen + 1
+        yield line
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# --- 索引与匹配 (纯内存，不访问数据库) ---
+
+def build_index(open_items):
+    """
+    open_items: [{'id', 'order_no', 'partner_id', 'type', 'outstanding', 'created_at'}]，按 created_at 升序。
+    返回索引字典，供 match_lines 使用。
+    """
+    by_amount = defaultdict(deque)   # (direction, cents) -> 未匹配订单 (先进先出)
+    by_ref = defaultdict(deque)      # ref_key -> 同号订单 (先进先出)
+    amounts = defaultdict(list)      # direction -> 有序金额分列表
+    for item in open_items:
+        direction = 1 if item['type'] == 'sales' else -1
+        item = dict(item, direction=direction, cents=_to_cents(item['outstanding']), matched=False)
+        by_amount[(direction, item['cents'])].append(item)
+        if item.get('order_no'):
+            by_ref[_ref_key(item['order_no'])].append(item)
+        amounts[direction].append(item['cents'])
+    for values in amounts.values():
+        values.sort()
+    return {'by_amount': by_amount, 'by_ref': by_ref, 'amounts': amounts}
+
+
+def _take_exact(index, direction, cents):
+    bucket = index['by_amount'].get((direction, cents))
+    while bucket:
+        item = bucket.popleft()
+        if not item['matched']:
+            return item
+    return None
+
+
+def _take_nearest(index, direction, cents, tolerance):
+    """在 [cents - tolerance, cents + tolerance] 中找最接近的未匹配金额。"""
+    values = index['amounts'][direction]
+    right = bisect.bisect_left(values, cents)
+    left = right - 1
+    # 从插入点向两侧扩展，先试距离更近的一侧
+    while True:
+        left_gap = cents - values[left] if left >= 0 else None
+        right_gap = values[right] - cents if right < len(values) else None
+        if left_gap is not None and left_gap > tolerance:
+            left_gap = None
+        if right_gap is not None and right_gap > tolerance:
+            right_gap = None
+        if left_gap is None and right_gap is None:
+            return None
+        if right_gap is not None and (left_gap is None or right_gap <= left_gap):
+            item = _take_exact(index, direction, values[right])
+            right += 1
+        else:
+            item = _take_exact(index, direction, values[left])
+            left -= 1
+        if item:
+            return item
+
+
+def _find_by_reference(index, line, direction, cents):
+    """摘要/参考号中出现的单号对应的、方向一致且未结清金额不小于本行的第一张未匹配订单。"""
+    for token in _TOKEN_RE.findall(f"{line['reference']} {line['description']}".upper()):
+        bucket = index['by_ref'].get(_ref_key(token))
+        while bucket and bucket[0]['matched']:
+            bucket.popleft()
+        for item in bucket or ():
+            if not item['matched'] and item['direction'] == direction and cents <= item['cents']:
+                return item
+    return None
+
+
+def match_lines(lines, index, tolerance_cents=DEFAULT_TOLERANCE_CENTS):
+    """
+    逐行匹配，返回 (matches, unmatched)。
+    matches: [{'line', 'item', 'rule'}]，rule 为 reference_exact / reference_partial / amount_exact / amount_tolerance。
+    """
+    matches, unmatched = [], []
+    for line in lines:
+        direction = 1 if line['amount'] > 0 else -1
+        cents = abs(_to_cents(line['amount']))
+        if cents == 0:
+            continue
+        item, rule = _find_by_reference(index, line, direction, cents), None
+        if item:
+            rule = 'reference_exact' if cents == item['cents'] else 'reference_partial'
+        else:
+            item = _take_exact(index, direction, cents)
+            rule = 'amount_exact' if item else None
+            if not item and tolerance_cents:
+                item = _take_nearest(index, direction, cents, tolerance_cents)
+                rule = 'amount_tolerance' if item else None
+        if item:
+            item['matched'] = True
+            matches.append({'line': line, 'item': item, 'rule': rule})
+        else:
+            unmatched.append(line)
+    return matches, unmatched
+
+
+# --- 数据库 ---
+
+def _tenant_key(tenant_id):
+    return '' if tenant_id is None else str(tenant_id)
+
+
+def load_open_items(cursor, tenant_id):
+    """租户未结清的应收/应付订单 (orders 由所有租户共用，按 tenant_id 过滤)。"""
+    cursor.execute(
+        """SELECT id, order_no, partner_id, type, total_amount - paid_amount AS outstanding, created_at
+           FROM orders
+           WHERE tenant_id = %s
+             AND type IN ('sales', 'purchase') AND status <> 'cancelled' AND paid_amount < total_amount
+           ORDER BY created_at""",
+        (tenant_id,))
+    return cursor.fetchall()
+
+
+def _claim(cursor, tenant, matches):
+    """登记匹配行，返回本事务登记成功的 (此前未导入、也没有被并发导入抢先) 那部分。"""
+    claimed = execute_values(
+        cursor,
+        """INSERT INTO bank_statement_lines (tenant_id, line_hash, posted_on, amount, reference) VALUES %s
+           ON CONFLICT (tenant_id, line_hash) DO NOTHING RETURNING line_hash""",
+        [(tenant, m['line']['hash'], m['line']['date'], m['line']['amount'], m['line']['reference'][:255])
+         for m in matches],
+        page_size=1000, fetch=True)
+    claimed = {r['line_hash'] for r in claimed}
+    return [m for m in matches if m['line']['hash'] in claimed]
+
+
+def reconcile(cursor, stream, fmt=None, tolerance_cents=DEFAULT_TOLERANCE_CENTS, dry_run=False, tenant_id=None):
+    """匹配对账单并 (非 dry_run 时) 批量入账，返回汇总结果。"""
+    ensure_tables(cursor)
+    ensure_payment_tables(cursor)
+
+    tenant = _tenant_key(tenant_id)
+    index = build_index(load_open_items(cursor, tenant_id))
+    total, duplicates, unmatched_count = 0, 0, 0
+    matches, unmatched_sample = [], []
+    for chunk in _chunks(hash_lines(parse_statement(stream, fmt)), RECONCILE_CHUNK_SIZE):
+        # 过滤已导入过的行
+        total += len(chunk)
+        cursor.execute("SELECT line_hash FROM bank_statement_lines WHERE tenant_id = %s AND line_hash = ANY(%s)",
+                       (tenant, [l['hash'] for l in chunk]))
+        seen = {r['line_hash'] for r in cursor.fetchall()}
+        fresh = [l for l in chunk if l['hash'] not in seen]
+        duplicates += len(chunk) - len(fresh)
+
+        chunk_matches, unmatched = match_lines(fresh, index, tolerance_cents)
+        matches.extend(chunk_matches)
+        unmatched_count += len(unmatched)
+        unmatched_sample.extend(unmatched[:UNMATCHED_SAMPLE_SIZE - len(unmatched_sample)])
+
+    if matches and not dry_run:
+        claimed = _claim(cursor, tenant, matches)
+        # 其余行已被并发的同一文件导入登记
+        duplicates += len(matches) - len(claimed)
+        matches = claimed
+    rules = defaultdict(int)
+    for m in matches:
+        rules[m['rule']] += 1
+
+    result = {'lines': total, 'duplicates': duplicates, 'matched': len(matches),
+              'unmatched': unmatched_count, 'rules': dict(rules), 'posted': 0,
+              'unmatched_sample': [{k: l[k] for k in ('line_no', 'date', 'amount', 'reference', 'description')}
+                                   for l in unmatched_sample]}
+    if dry_run or not matches:
+        return result
+
+    payments = [{
+        'partner_id': m['item']['partner_id'], 'order_id': m['item']['id'],
+        'type': 'income' if m['item']['direction'] > 0 else 'expense',
+        'amount': abs(m['line']['amount']), 'payment_method': BANK_PAYMENT_METHOD,
+        'description': f"银行对账 {m['line']['reference'] or m['line']['description']}".strip(),
+    } for m in matches]
+    transactions, _ = apply_payments(cursor, payments, tenant_id)
+
+    execute_values(
+        cursor,
+        """UPDATE bank_statement_lines b SET transaction_id = v.transaction_id::uuid
+           FROM (VALUES %s) AS v(tenant_id, line_hash, transaction_id)
+           WHERE b.tenant_id = v.tenant_id AND b.line_hash = v.line_hash""",
+        [(tenant, m['line']['hash'], str(t['id'])) for m, t in zip(matches, transactions)],
+        page_size=1000)
+    result['posted'] = len(transactions)
+    return result
@@ -3,12 +3,15 @@ import json
 import os
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from rollups import sum_rollups
+from admission import Throttled, apply_settings, begin as admit, report_lane
 
 DB_HOST = os.environ.get('DB_HOST')
 DB_USER = os.environ.get('DB_USER')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
 DB_NAME = os.environ.get('DB_NAME')
 
+# 报表连接主库：汇总表的 ensure_tables 可能执行 DDL (副本上会失败)，且本模块不经 db_utils 的复制延迟 / 写后读检查
 def get_db_connection():
     return psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME)
 
@@ -21,71 +24,85 @@ def lambda_handler(event, context):
     report_type = path_parts[1] if len(path_parts) > 1 else None
     start_date = query_params.get('start_date')
     end_date = query_params.get('end_date')
+    # 可选按维度拆分: partner / payment_method
+    dimension = query_params.get('dimension') or 'total'
 
-    if report_type == 'cashflow':
-        return get_cashflow_report(tenant_id, start_date, end_date)
-    elif report_type == 'profit':
-        return get_profit_report(tenant_id, start_date, end_date)
+    try:
+        # 租户准入：报表类令牌桶 (本模块未经 @instrument)
+        admit(event)
+        if report_type == 'cashflow':
+            return get_cashflow_report(tenant_id, start_date, end_date, dimension)
+        elif report_type == 'profit':
+            return get_profit_report(tenant_id, start_date, end_date, dimension)
+    except Throttled as e:
+        # 超出速率或报表通道已满：让客户端稍后重试，而不是在数据库上排队
+        return {'statusCode': 429, 'headers': {'Retry-After': str(e.retry_after)}, 'body': json.dumps({'error': str(e)})}
     
     return {'statusCode': 404, 'body': json.dumps({'error': '报表类型未找到'})}
 
-def get_cashflow_report(tenant_id, start_date, end_date):
-    """生成现金流报告。"""
+def _load_rollups(cursor, tenant_id, start_date, end_date, breakdown=None):
+    """
+    读取区间合计与 (可选的) 按维度明细，返回 (合计, 明细或 None)。
+    两条查询都只读日汇总表、耗时很短，直接在调用方 (持有报表通道) 的连接上顺序执行，一个报表只占一条连接。
+    """
+    totals = sum_rollups(cursor, tenant_id, start_date, end_date)
+    if not breakdown:
+        return totals, None
+    return totals, sum_rollups(cursor, tenant_id, start_date, end_date, breakdown)
+
+def get_cashflow_report(tenant_id, start_date, end_date, dimension='total'):
+    """生成现金流报告（读取日汇总表，区间包含首尾两天）。"""
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        query = """
-            SELECT 
-                COALESCE(SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END), 0) as total_income,
-                COALESCE(SUM(CASE WHEN type = 'expense' THEN amount ELSE 0 END), 0) as total_expense
-            FROM financial_transactions
-            WHERE tenant_id = %s AND created_at BETWEEN %s AND %s;
-        """
-        cursor.execute(query, (tenant_id, start_date, end_date))
-        result = cursor.fetchone()
-        result['net_cashflow'] = result['total_income'] - result['total_expense']
+        # 报表类会话参数 (较长的 statement_timeout、较大的 work_mem)，并在有界并发的报表通道中执行
+        apply_settings(cursor, tenant_id, 'report')
+        with report_lane(conn, tenant_id or 0):
+            # 汇总表由所有租户共用，sum_rollups 按 tenant_id 过滤
+            totals, breakdown = _load_rollups(cursor, tenant_id, start_date, end_date,
+                                              dimension if dimension != 'total' else None)
+            result = {
+                'total_income': totals['income'],
+                'total_expense': totals['expense'],
+                'net_cashflow': totals['income'] - totals['expense'],
+            }
+            if breakdown is not None:
+                result['breakdown'] = [
+                    {'key': r['dimension_key'], 'income': r['income'], 'expense': r['expense'], 'net_cashflow': r['income'] - r['expense']}
+                    for r in breakdown
+                ]
         return {'statusCode': 200, 'body': json.dumps(result, default=str)}
     finally:
         cursor.close()
         conn.close()
 
-def get_profit_report(tenant_id, start_date, end_date):
-    """生成利润报告。"""
+def get_profit_report(tenant_id, start_date, end_date, dimension='total'):
+    """生成利润报告（读取日汇总表中的收入与销售成本）。"""
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        # 1. 计算总销售收入
-        cursor.execute(
-            """SELECT COALESCE(SUM(total_amount), 0) as total_revenue 
-               FROM orders WHERE tenant_id = %s AND type = 'sales' AND status = 'completed' 
-               AND updated_at BETWEEN %s AND %s""",
-            (tenant_id, start_date, end_date)
-        )
-        total_revenue = cursor.fetchone()['total_revenue']
+        apply_settings(cursor, tenant_id, 'report')
+        with report_lane(conn, tenant_id or 0):
+            totals, breakdown = _load_rollups(cursor, tenant_id, start_date, end_date,
+                                              dimension if dimension == 'partner' else None)
+            total_revenue = totals['revenue']
+            total_cost = totals['cogs']
 
-        # 2. 计算总销售成本
-        cursor.execute(
-            """SELECT COALESCE(SUM(oi.quantity * p.cost_price), 0) as total_cost
-               FROM order_items oi
-               JOIN products p ON oi.product_id = p.id
-               JOIN orders o ON oi.order_id = o.id
-               WHERE o.tenant_id = %s AND o.type = 'sales' AND o.status = 'completed'
-               AND o.updated_at BETWEEN %s AND %s""",
-            (tenant_id, start_date, end_date)
-        )
-        total_cost = cursor.fetchone()['total_cost']
+            gross_profit = total_revenue - total_cost
+            profit_margin = (gross_profit / total_revenue) * 100 if total_revenue > 0 else 0
 
-        gross_profit = total_revenue - total_cost
-        profit_margin = (gross_profit / total_revenue) * 100 if total_revenue > 0 else 0
-
-        report = {
-            'total_revenue': total_revenue,
-            'total_cost_of_goods_sold': total_cost,
-            'gross_profit': gross_profit,
-            'profit_margin_percentage': profit_margin
-        }
+            report = {
+                'total_revenue': total_revenue,
+                'total_cost_of_goods_sold': total_cost,
+                'gross_profit': gross_profit,
+                'profit_margin_percentage': profit_margin
+            }
+            if breakdown is not None:
+                report['breakdown'] = [
+                    {'key': r['dimension_key'], 'revenue': r['revenue'], 'cost_of_goods_sold': r['cogs'], 'gross_profit': r['revenue'] - r['cogs']}
+                    for r in breakdown
+                ]
         return {'statusCode': 200, 'body': json.dumps(report, default=str)}
     finally:
         cursor.close()
         conn.close()
-
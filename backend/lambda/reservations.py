@@ -0,0 +1,321 @@
+# backend/lambda/reservations.py
+# 销售订单库存预占（reservation）与异步分配管道。
+#
+# - 下单 (orders POST) 只向 reservation_queue 插入一条 'allocate' 任务，不在请求内锁任何库存行；
+#   取消 (orders DELETE / 状态改为 cancelled) 插入 'release' 任务。
+# - worker_handler 由定时事件或队列触发，可并发运行多个实例：
+#   每个实例用 FOR UPDATE SKIP LOCKED 领取一批任务，互不阻塞。
+# - 同一商品的分配在事务级 advisory lock 下串行，保证多个 worker 不会超额预占；
+#   出库扣减 (POS、订单出库、调拨) 持有同一把锁的共享模式，彼此不阻塞，但与分配互斥，
+#   扣减后的在库量不得低于其他订单已分配的数量 (reserved_by_others)。
+# - 可承诺量 (ATP) = 在库数量 - 已分配 (allocated) 的预占数量。
+# - 缺货 (backordered) 的部分在入库或其他订单释放预占时重新入队 (requeue_backorders)，
+#   再次分配时只补足尚未分配的数量。
+
+import json
+import os
+import time
+from collections import defaultdict
+
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+import ddl
+from stock_shards import fetch_on_hand
+
+DB_HOST = os.environ.get('DB_HOST')
+DB_USER = os.environ.get('DB_USER')
+DB_PASSWORD = os.environ.get('DB_PASSWORD')
+DB_NAME = os.environ.get('DB_NAME')
+
+BATCH_SIZE = int(os.environ.get('RESERVATION_BATCH_SIZE', '100'))
+MAX_ATTEMPTS = int(os.environ.get('RESERVATION_MAX_ATTEMPTS', '5'))
+
+CREATE_RESERVATION_TABLES_SQL = """
+CREATE TABLE IF NOT EXISTS reservations (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    order_id UUID NOT NULL,
+    product_id UUID NOT NULL,
+    warehouse_id UUID,               -- 缺货 (backordered) 时为空
+    location_code VARCHAR(100),
+    quantity INT NOT NULL,
+    status VARCHAR(20) NOT NULL,     -- allocated, backordered, released, fulfilled
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_reservations_order ON reservations (order_id);
+CREATE INDEX IF NOT EXISTS idx_reservations_allocated ON reservations (product_id, warehouse_id, location_code)
+    WHERE status = 'allocated';
+CREATE INDEX IF NOT EXISTS idx_reservations_backordered ON reservations (product_id) WHERE status = 'backordered';
+CREATE TABLE IF NOT EXISTS reservation_queue (
+    id BIGSERIAL PRIMARY KEY,
+    order_id UUID NOT NULL,
+    action VARCHAR(20) NOT NULL,     -- allocate, release
+    status VARCHAR(20) NOT NULL DEFAULT 'pending', -- pending, done, failed
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    processed_at TIMESTAMP WITH TIME ZONE
+);
+CREATE INDEX IF NOT EXISTS idx_reservation_queue_pending ON reservation_queue (id) WHERE status = 'pending';
+"""
+
+_tables_ready = False
+
+
+def get_db_connection():
+    return psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME)
+
+
+def ensure_tables(cursor):
+    global _tables_ready
+    if not _tables_ready:
+        _tables_ready = ddl.apply(cursor, CREATE_RESERVATION_TABLES_SQL)
+
+
+def enqueue(cursor, order_id, action):
+    """登记一条待处理的预占任务 (allocate / release)，随调用方事务一起提交。"""
+    ensure_tables(cursor)
+    cursor.execute("INSERT INTO reservation_queue (order_id, action) VALUES (%s, %s)", (order_id, action))
+
+
+def requeue_backorders(cursor, product_ids):
+    """入库或释放预占后调用：为这些商品上仍有缺货的订单重新登记 'allocate' 任务 (已有待处理任务的跳过)。"""
+    if not product_ids:
+        return 0
+    ensure_tables(cursor)
+    cursor.execute(
+        """INSERT INTO reservation_queue (order_id, action)
+           SELECT DISTINCT r.order_id, 'allocate' FROM reservations r
+           WHERE r.status = 'backordered' AND r.product_id = ANY(%s::uuid[])
+             AND NOT EXISTS (SELECT 1 FROM reservation_queue q WHERE q.order_id = r.order_id
+                             AND q.action = 'allocate' AND q.status = 'pending')""",
+        ([str(p) for p in product_ids],))
+    return cursor.rowcount
+
+
+def reserved_by_others(cursor, keys, order_id=None):
+    """出库扣减前调用：keys 为 [(warehouse_id, product_id, location_code)]，返回 {key: 其他订单在该键上已分配的数量}。
+
+    同时以共享模式持有这些商品的分配锁直到事务结束，分配 worker 不会按扣减前的在库量分配。
+    """
+    ensure_tables(cursor)
+    keys = {(str(w), str(p), loc) for w, p, loc in keys}
+    product_ids = sorted({p for _, p, _ in keys})
+    cursor.execute(
+        "SELECT pg_advisory_xact_lock_shared(hashtext(p)) FROM unnest(%s::text[]) AS p ORDER BY p",
+        (product_ids,))
+    # 须在取得锁之后的新语句中读取 (READ COMMITTED 下每条语句各自取快照)
+    cursor.execute(
+        """SELECT warehouse_id, product_id, location_code, SUM(quantity) AS reserved FROM reservations
+           WHERE status = 'allocated' AND product_id = ANY(%s::uuid[]) AND order_id IS DISTINCT FROM %s
+           GROUP BY warehouse_id, product_id, location_code""",
+        (product_ids, order_id))
+    reserved = dict.fromkeys(keys, 0)
+    for row in cursor.fetchall():
+        key = (str(row['warehouse_id']), str(row['product_id']), row['location_code'])
+        if key in reserved:
+            reserved[key] = row['reserved']
+    return reserved
+
+
+def available_to_promise(cursor, product_ids, warehouse_id=None):
+    """返回 {product_id: 可承诺量}，可承诺量 = 在库 - 已分配预占。"""
+    ensure_tables(cursor)
+    atp = defaultdict(int)
+    for row in fetch_on_hand(cursor, product_ids, warehouse_id):
+        atp[str(row['product_id'])] += row['quantity']
+    cursor.execute(
+        "SELECT product_id, SUM(quantity) AS reserved FROM reservations "
+        "WHERE status = 'allocated' AND product_id = ANY(%s::uuid[])"
+        + (" AND warehouse_id = %s" if warehouse_id else "") + " GROUP BY product_id",
+        ([str(p) for p in product_ids], warehouse_id) if warehouse_id else ([str(p) for p in product_ids],))
+    for row in cursor.fetchall():
+        atp[str(row['product_id'])] -= row['reserved']
+    return {str(p): atp.get(str(p), 0) for p in product_ids}
+
+
+def free_by_location(cursor, product_ids):
+    """按 (product_id) 返回可分配的 [(warehouse_id, location_code, 可用量)]，可用量 = 在库 - 已分配，大的排在前面。"""
+    ensure_tables(cursor)
+    free = defaultdict(int)
+    for row in fetch_on_hand(cursor, product_ids):
+        free[(str(row['product_id']), row['warehouse_id'], row['location_code'])] += row['quantity']
+    cursor.execute(
+        """SELECT product_id, warehouse_id, location_code, SUM(quantity) AS reserved FROM reservations
+           WHERE status = 'allocated' AND product_id = ANY(%s::uuid[])
+           GROUP BY product_id, warehouse_id, location_code""",
+        (list(product_ids),))
+    for row in cursor.fetchall():
+        free[(str(row['product_id']), row['warehouse_id'], row['location_code'])] -= row['reserved']
+    by_product = defaultdict(list)
+    for (p_id, w_id, loc), qty in free.items():
+        if qty > 0:
+            by_product[p_id].append([w_id, loc, qty])
+    for slots in by_product.values():
+        slots.sort(key=lambda s: -s[2])
+    return by_product
+
+
+def allocate_orders(cursor, order_ids):
+    """为一批订单分配库存。只分配尚未分配的数量，已取消或已完成的订单会被跳过（任务可安全重放）。
+
+    订单上已有的缺货行由本次结果取代：能分配的转为 allocated，仍不足的部分重新记为 backordered。
+    """
+    if not order_ids:
+        return 0
+    cursor.execute(
+        """SELECT DISTINCT oi.product_id::text AS product_id FROM order_items oi JOIN orders o ON o.id = oi.order_id
+           WHERE oi.order_id = ANY(%s::uuid[]) AND o.status NOT IN ('cancelled', 'completed')""",
+        (list(order_ids),))
+    product_ids = sorted(r['product_id'] for r in cursor.fetchall())
+    if not product_ids:
+        return 0
+    # 按商品排序加锁，多个 worker 之间不会死锁；同一订单的重复任务也在锁内串行
+    cursor.execute(
+        "SELECT pg_advisory_xact_lock(hashtext(p)) FROM unnest(%s::text[]) AS p ORDER BY p",
+        (product_ids,))
+    cursor.execute(
+        """WITH need AS (
+               SELECT oi.order_id, oi.product_id, SUM(oi.quantity) AS quantity
+               FROM order_items oi JOIN orders o ON o.id = oi.order_id
+               WHERE oi.order_id = ANY(%s::uuid[]) AND o.status NOT IN ('cancelled', 'completed')
+               GROUP BY oi.order_id, oi.product_id)
+           SELECT n.order_id, n.product_id, n.quantity - COALESCE(SUM(r.quantity), 0) AS quantity
+           FROM need n LEFT JOIN reservations r ON r.order_id = n.order_id AND r.product_id = n.product_id
+                AND r.status IN ('allocated', 'fulfilled')
+           GROUP BY n.order_id, n.product_id, n.quantity
+           HAVING n.quantity - COALESCE(SUM(r.quantity), 0) > 0
+           ORDER BY n.order_id""",
+        (list(order_ids),))
+    lines = cursor.fetchall()
+    if not lines:
+        return 0
+
+    cursor.execute(
+        """DELETE FROM reservations WHERE status = 'backordered'
+             AND (order_id, product_id) IN (SELECT * FROM unnest(%s::uuid[], %s::uuid[]))""",
+        ([str(l['order_id']) for l in lines], [str(l['product_id']) for l in lines]))
+    free = free_by_location(cursor, product_ids)
+
+    rows = []
+    # 按入队顺序 (order_ids) 先到先得
+    position = {str(o): i for i, o in enumerate(order_ids)}
+    for line in sorted(lines, key=lambda l: position.get(str(l['order_id']), 0)):
+        p_id, remaining = str(line['product_id']), line['quantity']
+        for slot in free.get(p_id, []):
+            if remaining == 0:
+                break
+            take = min(slot[2], remaining)
+            if take > 0:
+                rows.append((line['order_id'], p_id, slot[0], slot[1], take, 'allocated'))
+                slot[2] -= take
+                remaining -= take
+        if remaining > 0:
+            rows.append((line['order_id'], p_id, None, None, remaining, 'backordered'))
+
+    execute_values(
+        cursor,
+        "INSERT INTO reservations (order_id, product_id, warehouse_id, location_code, quantity, status) VALUES %s",
+        rows)
+    return len(rows)
+
+
+def release_orders(cursor, order_ids):
+    """释放订单上仍有效的预占；腾出的库存让给同商品上缺货的订单。"""
+    if not order_ids:
+        return 0
+    cursor.execute(
+        """UPDATE reservations SET status = 'released', updated_at = CURRENT_TIMESTAMP
+           WHERE order_id = ANY(%s::uuid[]) AND status IN ('allocated', 'backordered')
+           RETURNING product_id, warehouse_id""",
+        (list(order_ids),))
+    released = cursor.fetchall()
+    requeue_backorders(cursor, sorted({str(r['product_id']) for r in released if r['warehouse_id']}))
+    return len(released)
+
+
+def fulfill_order(cursor, order_id):
+    """订单出库完成后，把预占标记为已履约（实物库存已由出库逻辑扣减）。"""
+    ensure_tables(cursor)
+    cursor.execute(
+        """UPDATE reservations SET status = 'fulfilled', updated_at = CURRENT_TIMESTAMP
+           WHERE order_id = %s AND status IN ('allocated', 'backordered')""",
+        (order_id,))
+
+
+def _apply_jobs(cursor, jobs, cancelled):
+    """标记任务完成并执行分配/释放；cancelled 为同一批中有释放任务的订单 (无需再分配)。"""
+    job_ids = [j['id'] for j in jobs]
+    release_ids = list(dict.fromkeys(str(j['order_id']) for j in jobs if j['action'] == 'release'))
+    allocate_ids = [o for o in dict.fromkeys(str(j['order_id']) for j in jobs if j['action'] == 'allocate')
+                    if o not in cancelled]
+    # 先把任务标记为已完成：释放预占时重新登记的缺货任务不会因本批任务仍是 pending 而被跳过
+    cursor.execute(
+        "UPDATE reservation_queue SET status = 'done', attempts = attempts + 1, processed_at = CURRENT_TIMESTAMP WHERE id = ANY(%s)",
+        (job_ids,))
+    allocate_orders(cursor, allocate_ids)
+    release_orders(cursor, release_ids)
+
+
+def process_batch(conn, batch_size=BATCH_SIZE):
+    """
+    领取并处理一批任务，返回处理的任务数。其他 worker 已锁定的任务会被跳过。
+    整批失败时回滚到保存点后逐个任务重试 (任务行锁仍由本事务持有)，只有出错的任务计入 attempts，
+    不会因为一个订单的错误让同批的其他任务一起失败。
+    """
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        ensure_tables(cursor)
+        cursor.execute(
+            """SELECT id, order_id, action FROM reservation_queue
+               WHERE status = 'pending' ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED""",
+            (batch_size,))
+        jobs = cursor.fetchall()
+        if not jobs:
+            conn.commit()
+            return 0
+
+        cancelled = {str(j['order_id']) for j in jobs if j['action'] == 'release'}
+        cursor.execute("SAVEPOINT reservation_batch")
+        try:
+            _apply_jobs(cursor, jobs, cancelled)
+        except psycopg2.Error as error:
+            cursor.execute("ROLLBACK TO SAVEPOINT reservation_batch")
+            print(f"[RESERVATION_ERROR] 处理批次失败，逐个任务重试: {error}")
+            for job in jobs:
+                cursor.execute("SAVEPOINT reservation_job")
+                try:
+                    _apply_jobs(cursor, [job], cancelled)
+                    cursor.execute("RELEASE SAVEPOINT reservation_job")
+                except psycopg2.Error as job_error:
+                    cursor.execute("ROLLBACK TO SAVEPOINT reservation_job")
+                    print(f"[RESERVATION_ERROR] 任务 {job['id']} (订单 {job['order_id']}) 失败: {job_error}")
+                    cursor.execute(
+                        """UPDATE reservation_queue SET attempts = attempts + 1, last_error = %s,
+                               status = CASE WHEN attempts + 1 >= %s THEN 'failed' ELSE 'pending' END
+                           WHERE id = %s""",
+                        (str(job_error), MAX_ATTEMPTS, job['id']))
+        conn.commit()
+        return len(jobs)
+    finally:
+        cursor.close()
+
+
+def worker_handler(event, context):
+    """预占 worker 入口：循环领取任务直到队列为空或接近 Lambda 超时。可同时运行多个实例。"""
+    batch_size = int((event or {}).get('batch_size') or BATCH_SIZE)
+    conn = get_db_connection()
+    processed = 0
+    started = time.time()
+    try:
+        while True:
+            if context and hasattr(context, 'get_remaining_time_in_millis') and context.get_remaining_time_in_millis() < 5000:
+                break
+            handled = process_batch(conn, batch_size)
+            processed += handled
+            if handled == 0:
+                break
+        return {'statusCode': 200, 'body': json.dumps({'processed': processed, 'seconds': round(time.time() - started, 3)})}
+    finally:
+        conn.close()
@@ -0,0 +1,262 @@
+# backend/lambda/rollups.py
+# 财务日汇总表 (daily_financial_rollups)：报表按天求和，而不是每次扫描全部明细。
+#
+# - 订单完成 (orders 状态流转 / POS) 时写入 orders.completed_at 并调用 record_order_completion，累加完成当天的
+#   收入与销售成本 (成本为 costing.snapshot_order_costs 写入 order_items.cost_total 的快照)；
+#   按 completed_at 而不是 updated_at 取日期，订单之后再被修改也不会改变所属日期。
+# - 财务流水入账 (finance / POS) 时调用 record_transactions，累加当天的收支。
+# - 已完成的销售单被取消时调用 reverse_order_completion，在原完成日记入相反数。
+# - 每行按 (tenant_id, dimension, dimension_key, day) 唯一：
+#     total          -> dimension_key = ''，整个租户的合计
+#     partner        -> dimension_key = partner_id
+#     payment_method -> dimension_key = 支付方式（仅收支）
+# - backfill_handler 用于首次上线或修数：按月重算指定区间内的汇总。
+# 扁平模块的业务表由所有租户共用 (按 tenant_id 列区分)：orders / financial_transactions 写入时带上请求授权方声明中的
+# tenant_id，汇总行使用同一个值，回填按明细行的 tenant_id 列归属，两条路径一致；报表必须按 tenant_id 过滤。
+
+import json
+import os
+from collections import defaultdict
+from datetime import date, timedelta
+
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+import ddl
+
+DB_HOST = os.environ.get('DB_HOST')
+DB_USER = os.environ.get('DB_USER')
+DB_PASSWORD = os.environ.get('DB_PASSWORD')
+DB_NAME = os.environ.get('DB_NAME')
+
+# 早期版本的汇总表没有 tenant_id：补列并改主键，无法归属租户的旧汇总行清空 (上线后运行 backfill_handler 重算)。
+# orders.completed_at 首次部署时用已完成订单当时的 updated_at / created_at 初始化。
+CREATE_ROLLUP_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS daily_financial_rollups (
+    tenant_id VARCHAR(100) NOT NULL DEFAULT '',
+    dimension VARCHAR(30) NOT NULL,
+    dimension_key VARCHAR(100) NOT NULL DEFAULT '',
+    day DATE NOT NULL,
+    revenue NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    cogs NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    income NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    expense NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    order_count INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (tenant_id, dimension, dimension_key, day)
+);
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = 'daily_financial_rollups'
+                     AND column_name = 'tenant_id') THEN
+        DELETE FROM daily_financial_rollups;
+        ALTER TABLE daily_financial_rollups ADD COLUMN tenant_id VARCHAR(100) NOT NULL DEFAULT '';
+        ALTER TABLE daily_financial_rollups DROP CONSTRAINT daily_financial_rollups_pkey;
+        ALTER TABLE daily_financial_rollups ADD PRIMARY KEY (tenant_id, dimension, dimension_key, day);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = 'orders' AND column_name = 'completed_at') THEN
+        ALTER TABLE orders ADD COLUMN completed_at TIMESTAMP WITH TIME ZONE;
+        UPDATE orders SET completed_at = COALESCE(updated_at, created_at) WHERE status = 'completed';
+    END IF;
+END $$;
+"""
+
+UPSERT_SQL = """
+INSERT INTO daily_financial_rollups (tenant_id, dimension, dimension_key, day, revenue, cogs, income, expense, order_count)
+VALUES %s
+ON CONFLICT (tenant_id, dimension, dimension_key, day) DO UPDATE SET
+    revenue = daily_financial_rollups.revenue + EXCLUDED.revenue,
+    cogs = daily_financial_rollups.cogs + EXCLUDED.cogs,
+    income = daily_financial_rollups.income + EXCLUDED.income,
+    expense = daily_financial_rollups.expense + EXCLUDED.expense,
+    order_count = daily_financial_rollups.order_count + EXCLUDED.order_count
+"""
+
+# 从明细重算汇总（backfill 使用）。tenant_id 为空的历史明细无法归属租户，不计入
+BACKFILL_SQL = """
+INSERT INTO daily_financial_rollups (tenant_id, dimension, dimension_key, day, revenue, cogs, income, expense, order_count)
+SELECT f.tenant_id, dim.dimension, dim.dimension_key, f.day,
+       SUM(f.revenue), SUM(f.cogs), SUM(f.income), SUM(f.expense), SUM(f.order_count)
+FROM (
+    SELECT o.tenant_id::text AS tenant_id,
+           o.completed_at::date AS day, o.partner_id::text AS partner_key, NULL::text AS method_key,
+           o.total_amount AS revenue,
+           -- 优先使用完成时固化的成本 (costing)；早于成本快照的历史订单退回档案成本
+           COALESCE((SELECT SUM(COALESCE(oi.cost_total, oi.quantity * p.cost_price)) FROM order_items oi
+                     LEFT JOIN products p ON p.id = oi.product_id AND oi.cost_total IS NULL
+                     WHERE oi.order_id = o.id), 0) AS cogs,
+           0 AS income, 0 AS expense, 1 AS order_count
+    FROM orders o
+    WHERE o.type = 'sales' AND o.status = 'completed' AND o.tenant_id IS NOT NULL
+      AND o.completed_at::date BETWEEN %(start)s AND %(end)s
+      AND (%(tenant)s::text IS NULL OR o.tenant_id::text = %(tenant)s)
+    UNION ALL
+    SELECT ft.tenant_id::text, ft.created_at::date, ft.partner_id::text, COALESCE(ft.payment_method, ''),
+           0, 0,
+           CASE WHEN ft.type = 'income' THEN ft.amount ELSE 0 END,
+           CASE WHEN ft.type = 'expense' THEN ft.amount ELSE 0 END,
+           0
+    FROM financial_transactions ft
+    WHERE ft.tenant_id IS NOT NULL AND ft.created_at::date BETWEEN %(start)s AND %(end)s
+      AND (%(tenant)s::text IS NULL OR ft.tenant_id::text = %(tenant)s)
+) f
+CROSS JOIN LATERAL (VALUES ('total', ''), ('partner', f.partner_key), ('payment_method', f.method_key)) AS dim(dimension, dimension_key)
+WHERE dim.dimension_key IS NOT NULL
+GROUP BY f.tenant_id, dim.dimension, dim.dimension_key, f.day
+"""
+
+_tables_ready = False
+
+
+def get_db_connection():
+    return psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME)
+
+
+def ensure_tables(cursor):
+    global _tables_ready
+    if not _tables_ready:
+        _tables_ready = ddl.apply(cursor, CREATE_ROLLUP_TABLE_SQL)
+
+
+def _tenant_key(tenant_id):
+    """授权方声明中的 tenant_id -> 汇总表的 tenant_id 列 (缺失时为 '')。"""
+    return '' if tenant_id is None else str(tenant_id)
+
+
+def _apply(cursor, tenant_id, deltas):
+    """deltas: {(dimension, key, day): [revenue, cogs, income, expense, order_count]}，合并后一次写入。"""
+    if not deltas:
+        return
+    ensure_tables(cursor)
+    # 固定顺序写入，避免并发事务以不同顺序锁汇总行而死锁
+    tenant = _tenant_key(tenant_id)
+    rows = [(tenant, dim, key, day, *values) for (dim, key, day), values in sorted(deltas.items())]
+    execute_values(cursor, UPSERT_SQL, rows)
+
+
+def _order_deltas(cursor, order_id, sign):
+    cursor.execute(
+        """SELECT COALESCE(o.completed_at, CURRENT_TIMESTAMP)::date AS day, o.partner_id, o.total_amount,
+                  COALESCE(SUM(oi.cost_total), 0) AS cogs
+           FROM orders o
+           LEFT JOIN order_items oi ON oi.order_id = o.id
+           WHERE o.id = %s AND o.type = 'sales'
+           GROUP BY o.id""",
+        (order_id,))
+    order = cursor.fetchone()
+    if not order:
+        return {}
+    values = [sign * (order['total_amount'] or 0), sign * order['cogs'], 0, 0, sign]
+    deltas = {('total', '', order['day']): list(values)}
+    if order['partner_id']:
+        deltas[('partner', str(order['partner_id']), order['day'])] = list(values)
+    return deltas
+
+
+def record_order_completion(cursor, order_id, tenant_id):
+    """
+    把一张已完成销售单的收入与成本累加到完成当天 (orders.completed_at) 的汇总行
+    （成本取 costing 固化在 order_items 上的快照）。调用前须已写入 completed_at。
+    """
+    _apply(cursor, tenant_id, _order_deltas(cursor, order_id, 1))
+
+
+def reverse_order_completion(cursor, order_id, tenant_id):
+    """已完成的销售单被取消：在原完成日 (completed_at 不随取消改变) 记入相反数。"""
+    _apply(cursor, tenant_id, _order_deltas(cursor, order_id, -1))
+
+
+def record_transactions(cursor, transactions, tenant_id):
+    """把若干条财务流水 (需含 created_at, type, amount, partner_id, payment_method) 累加到汇总行。"""
+    deltas = defaultdict(lambda: [0, 0, 0, 0, 0])
+    for t in transactions:
+        if t.get('type') not in ('income', 'expense'):
+            continue
+        day = t['created_at'].date() if hasattr(t['created_at'], 'date') else t['created_at']
+        column = 2 if t['type'] == 'income' else 3
+        keys = [('total', ''), ('payment_method', t.get('payment_method') or '')]
+        if t.get('partner_id'):
+            keys.append(('partner', str(t['partner_id'])))
+        for dim, key in keys:
+            deltas[(dim, key, day)][column] += t['amount'] or 0
+    _apply(cursor, tenant_id, dict(deltas))
+
+
+def sum_rollups(cursor, tenant_id, start_date, end_date, dimension='total'):
+    """返回租户在区间内的合计；dimension 不是 total 时按 dimension_key 分组返回明细。"""
+    ensure_tables(cursor)
+    tenant = _tenant_key(tenant_id)
+    if dimension == 'total':
+        cursor.execute(
+            """SELECT COALESCE(SUM(revenue), 0) AS revenue, COALESCE(SUM(cogs), 0) AS cogs,
+                      COALESCE(SUM(income), 0) AS income, COALESCE(SUM(expense), 0) AS expense,
+                      COALESCE(SUM(order_count), 0) AS order_count
+               FROM daily_financial_rollups
+               WHERE tenant_id = %s AND dimension = 'total' AND dimension_key = '' AND day BETWEEN %s AND %s""",
+            (tenant, start_date, end_date))
+        return cursor.fetchone()
+    cursor.execute(
+        """SELECT dimension_key, SUM(revenue) AS revenue, SUM(cogs) AS cogs, SUM(income) AS income,
+                  SUM(expense) AS expense, SUM(order_count) AS order_count
+           FROM daily_financial_rollups
+           WHERE tenant_id = %s AND dimension = %s AND day BETWEEN %s AND %s
+           GROUP BY dimension_key ORDER BY dimension_key""",
+        (tenant, dimension, start_date, end_date))
+    return cursor.fetchall()
+
+
+def backfill(cursor, start_date, end_date, tenant_id=None):
+    """
+    删除并按明细重算 [start_date, end_date] 区间内的汇总，按明细行的 tenant_id 归属租户 (与实时路径一致)；
+    tenant_id 为空则重算全部租户。tenant_id 列为空的历史明细无法归属，不计入并打印告警。
+    """
+    ensure_tables(cursor)
+    tenant = None if tenant_id is None else _tenant_key(tenant_id)
+    cursor.execute(
+        """SELECT (SELECT COUNT(*) FROM orders WHERE type = 'sales' AND status = 'completed' AND tenant_id IS NULL
+                     AND completed_at::date BETWEEN %(start)s AND %(end)s)
+                + (SELECT COUNT(*) FROM financial_transactions WHERE tenant_id IS NULL
+                     AND created_at::date BETWEEN %(start)s AND %(end)s) AS unattributed""",
+        {'start': start_date, 'end': end_date})
+    unattributed = cursor.fetchone()['unattributed']
+    if unattributed:
+        print(f"[ROLLUP_WARN] {start_date}~{end_date} 有 {unattributed} 条明细缺少 tenant_id，未计入汇总")
+    cursor.execute("DELETE FROM daily_financial_rollups WHERE day BETWEEN %s AND %s AND (%s::text IS NULL OR tenant_id = %s)",
+                   (start_date, end_date, tenant, tenant))
+    cursor.execute(BACKFILL_SQL, {'start': start_date, 'end': end_date, 'tenant': tenant})
+    return cursor.rowcount
+
+
+def backfill_handler(event, context):
+    """回填任务入口: event = { start_date?, end_date?, tenant_id? }，缺省为全部历史、全部租户；每个月单独提交以缩短锁持有时间。"""
+    event = event or {}
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        ensure_tables(cursor)
+        start_date = event.get('start_date')
+        end_date = event.get('end_date') or date.today().isoformat()
+        if not start_date:
+            cursor.execute(
+                """SELECT LEAST((SELECT MIN(completed_at)::date FROM orders),
+                                (SELECT MIN(created_at)::date FROM financial_transactions)) AS first_day""")
+            first_day = cursor.fetchone()['first_day']
+            start_date = (first_day or date.today()).isoformat()
+        conn.commit()
+
+        current = date.fromisoformat(start_date)
+        last = date.fromisoformat(end_date)
+        rows = 0
+        while current <= last:
+            month_end = min((current.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1), last)
+            rows += backfill(cursor, current, month_end, event.get('tenant_id'))
+            conn.commit()
+            current = month_end + timedelta(days=1)
+        return {'statusCode': 200, 'body': json.dumps({'start_date': start_date, 'end_date': end_date, 'rollup_rows': rows})}
+    except (Exception, psycopg2.Error) as error:
+        conn.rollback()
+        return {'statusCode': 500, 'body': json.dumps({'error': f'回填失败: {error}'})}
+    finally:
+        cursor.close()
+        conn.close()
@@ -3,12 +3,16 @@
 
 import json
 import logging
-from db_utils import get_db_connection, build_response, CustomEncoder
+from db_utils import get_db_connection, build_response, cached_response, invalidate_reference, CustomEncoder, instrument
 from psycopg2.extras import RealDictCursor
+from entitlements import invalidate_entitlements
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# 套餐/行业列表需要超级管理员凭证，只允许浏览器私有缓存，且每次都带 ETag 重新验证 (未变化时 304)
+REFERENCE_CACHE_CONTROL = 'private, no-cache'
+
 
 def _json_serial(obj):
     if hasattr(obj, 'isoformat'):
@@ -16,6 +20,7 @@ def _json_serial(obj):
     raise TypeError(type(obj).__name__)
 
 
+@instrument
 def handler(event, context):
     path = (event.get('rawPath') or event.get('path', '')).strip('/')
     method = (event.get('requestContext') or {}).get('http', {}).get('method') or event.get('httpMethod', 'GET')
@@ -26,7 +31,8 @@ def handler(event, context):
         except Exception:
             pass
 
-    conn = get_db_connection(event)
+    # GET 只读取 public 中的列表，可走读副本
+    conn = get_db_connection(event, intent='read' if method == 'GET' else 'write')
     if not conn:
         return build_response(403, {"message": "需要有效的超级管理员凭证"})
 
@@ -40,9 +46,9 @@ def handler(event, context):
             if resource == 'tenants':
                 return _handle_tenants(conn)
             if resource == 'plans':
-                return _handle_plans(conn, method, resource_id, body)
+                return _handle_plans(conn, method, resource_id, body, event)
             if resource == 'industries':
-                return _handle_industries(conn, method, resource_id, body)
+                return _handle_industries(conn, method, resource_id, body, event)
         return build_response(404, {"message": f"路径未实现: {path}"})
     except Exception as e:
         logger.exception("saas_admin 处理错误")
@@ -69,22 +75,28 @@ def _handle_tenants(conn):
     return build_response(200, out, encoder=CustomEncoder)
 
 
-def _handle_plans(conn, method, plan_id, body):
+def _load_plans(conn):
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("""
+            SELECT id, code, name, description, max_users, max_storage_gb, ai_calls_per_day
+            FROM public.plans ORDER BY id
+        """)
+        rows = cur.fetchall()
+    out = []
+    for r in rows:
+        d = dict(r)
+        for k, v in d.items():
+            if hasattr(v, 'isoformat'):
+                d[k] = v.isoformat()
+        out.append(d)
+    return out
+
+
+def _handle_plans(conn, method, plan_id, body, event=None):
+    if method == 'GET':
+        return cached_response(event, 'plans', lambda: _load_plans(conn), REFERENCE_CACHE_CONTROL,
+                               encoder=CustomEncoder)
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        if method == 'GET':
-            cur.execute("""
-                SELECT id, code, name, description, max_users, max_storage_gb, ai_calls_per_day
-                FROM public.plans ORDER BY id
-            """)
-            rows = cur.fetchall()
-            out = []
-            for r in rows:
-                d = dict(r)
-                for k, v in d.items():
-                    if hasattr(v, 'isoformat'):
-                        d[k] = v.isoformat()
-                out.append(d)
-            return build_response(200, out, encoder=CustomEncoder)
         if method == 'PUT' and plan_id:
             cur.execute(
                 """UPDATE public.plans SET
@@ -106,6 +118,8 @@ def _handle_plans(conn, method, plan_id, body):
             )
             row = cur.fetchone()
             conn.commit()
+            invalidate_reference('plans')
+            invalidate_entitlements()  # 方案限额变化影响所有使用该方案的租户
             if not row:
                 return build_response(404, {"message": "方案不存在"})
             d = dict(row)
@@ -116,13 +130,17 @@ def _handle_plans(conn, method, plan_id, body):
     return build_response(400, {"message": "请求方法或参数不正确"})
 
 
-def _handle_industries(conn, method, industry_id, body):
+def _load_industries(conn):
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT id, name FROM public.industries ORDER BY id")
+        return [dict(r) for r in cur.fetchall()]
+
+
+def _handle_industries(conn, method, industry_id, body, event=None):
+    if method == 'GET':
+        return cached_response(event, 'industries', lambda: _load_industries(conn), REFERENCE_CACHE_CONTROL,
+                               encoder=CustomEncoder)
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        if method == 'GET':
-            cur.execute("SELECT id, name FROM public.industries ORDER BY id")
-            rows = cur.fetchall()
-            out = [dict(r) for r in rows]
-            return build_response(200, out, encoder=CustomEncoder)
         if method == 'POST' and not industry_id:
             name = (body.get('name') or '').strip()
             if not name:
@@ -133,6 +151,7 @@ def _handle_industries(conn, method, industry_id, body):
             )
             row = cur.fetchone()
             conn.commit()
+            invalidate_reference('industries')
             return build_response(201, dict(row), encoder=CustomEncoder)
         if method == 'PUT' and industry_id:
             name = (body.get('name') or '').strip()
@@ -144,6 +163,7 @@ def _handle_industries(conn, method, industry_id, body):
             )
             row = cur.fetchone()
             conn.commit()
+            invalidate_reference('industries')
             if not row:
                 return build_response(404, {"message": "行业不存在"})
             return build_response(200, dict(row), encoder=CustomEncoder)
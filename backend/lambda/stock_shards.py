@@ -0,0 +1,321 @@
+# backend/lambda/stock_shards.py
+# 热点 SKU 库存分片（sharded counter）。
+#
+# 秒杀/爆款商品的所有收银台都在争抢 stocks 表中同一行的行锁。
+# 对于被标记的商品（sharded_products），同一 (仓库, 商品, 货架) 的在库数量
+# 被拆分到 stock_shards 的 N 个子行中：
+#   - 扣减：随机挑选一个数量足够且未被锁定的分片 (FOR UPDATE SKIP LOCKED)；
+#     若没有单个分片满足，则按 shard_no 顺序锁定全部分片逐个扣减（慢路径）；
+#     该键上有其他订单的预占时也走慢路径，以合计数量核对。
+#   - 读取：在库数量 = stocks.quantity + SUM(stock_shards.quantity)。
+#   - 后台整理 (consolidator_handler)：把 stocks 行上的残留数量并入分片并均衡各分片。
+# 未被标记的商品行为与原先完全一致，仍然只操作 stocks 的单行。
+# 注意：本模块的函数均假设传入的 cursor 为 RealDictCursor。
+
+import json
+import os
+import random
+import time
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+import ddl
+import prepared
+
+DB_HOST = os.environ.get('DB_HOST')
+DB_USER = os.environ.get('DB_USER')
+DB_PASSWORD = os.environ.get('DB_PASSWORD')
+DB_NAME = os.environ.get('DB_NAME')
+
+DEFAULT_SHARD_COUNT = int(os.environ.get('STOCK_SHARD_COUNT', '8'))
+# 分片标记的进程内缓存时间（秒），避免每次扣减都查询 sharded_products
+SHARD_CONFIG_TTL = int(os.environ.get('STOCK_SHARD_CONFIG_TTL', '60'))
+
+CREATE_SHARD_TABLES_SQL = """
+CREATE TABLE IF NOT EXISTS sharded_products (
+    product_id UUID PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+    shard_count INT NOT NULL DEFAULT 8,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS stock_shards (
+    warehouse_id UUID NOT NULL,
+    product_id UUID NOT NULL,
+    location_code VARCHAR(100) NOT NULL,
+    shard_no INT NOT NULL,
+    quantity INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (warehouse_id, product_id, location_code, shard_no)
+);
+"""
+
+# 供读取方 JOIN 使用的分片合计子查询
+SHARD_TOTALS_SQL = """
+    SELECT warehouse_id, product_id, location_code, SUM(quantity) AS quantity
+    FROM stock_shards GROUP BY warehouse_id, product_id, location_code
+"""
+
+# 每次扣减都会执行的热点语句，按连接预编译 (见 prepared)
+STOCK_FOR_UPDATE = prepared.statement(
+    'stock_for_update',
+    "SELECT quantity FROM stocks WHERE warehouse_id=%s AND product_id=%s AND location_code=%s FOR UPDATE")
+STOCK_DECREMENT = prepared.statement(
+    'stock_decrement',
+    "UPDATE stocks SET quantity = quantity - %s WHERE warehouse_id=%s AND product_id=%s AND location_code=%s")
+SHARD_TAKE = prepared.statement(
+    'shard_take',
+    """UPDATE stock_shards SET quantity = quantity - %s
+       WHERE (warehouse_id, product_id, location_code, shard_no) = (
+           SELECT warehouse_id, product_id, location_code, shard_no FROM stock_shards
+           WHERE warehouse_id=%s AND product_id=%s AND location_code=%s AND quantity >= %s
+           ORDER BY (shard_no - %s + %s) %% %s
+           LIMIT 1 FOR UPDATE SKIP LOCKED)
+       RETURNING shard_no""")
+
+_tables_ready = False
+_shard_config_cache = {}  # product_id -> (shard_count 或 None, 过期时间)
+
+
+class InsufficientStockError(Exception):
+    """库存不足时抛出，调用方据此回滚事务。"""
+
+
+def get_db_connection():
+    return psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME)
+
+
+def ensure_tables(cursor):
+    """每个容器只执行一次建表语句，避免在热路径上重复执行 DDL (提交后才置位，见 ddl)。"""
+    global _tables_ready
+    if not _tables_ready:
+        _tables_ready = ddl.apply(cursor, CREATE_SHARD_TABLES_SQL)
+
+
+def get_shard_count(cursor, product_id, refresh=False):
+    """返回商品的分片数；未启用分片时返回 None。结果在进程内缓存 SHARD_CONFIG_TTL 秒，refresh=True 时重新读取。"""
+    cached = _shard_config_cache.get(str(product_id))
+    if cached and cached[1] > time.time() and not refresh:
+        return cached[0]
+    ensure_tables(cursor)
+    cursor.execute("SELECT shard_count FROM sharded_products WHERE product_id = %s", (product_id,))
+    row = cursor.fetchone()
+    shard_count = row['shard_count'] if row else None
+    _shard_config_cache[str(product_id)] = (shard_count, time.time() + SHARD_CONFIG_TTL)
+    return shard_count
+
+
+def _split_evenly(total, shard_count):
+    """把 total 尽量平均地拆成 shard_count 份（余数分给前几个分片）。"""
+    base, remainder = divmod(max(total, 0), shard_count)
+    return [base + (1 if i < remainder else 0) for i in range(shard_count)]
+
+
+def _lock_key(cursor, warehouse_id, product_id, location_code):
+    """按固定顺序 (stocks 行 -> 分片 shard_no 升序) 锁定一个库存键，返回 (stocks 数量, 分片列表)。"""
+    prepared.execute(cursor, STOCK_FOR_UPDATE, (warehouse_id, product_id, location_code))
+    stock = cursor.fetchone()
+    cursor.execute(
+        """SELECT shard_no, quantity FROM stock_shards
+           WHERE warehouse_id=%s AND product_id=%s AND location_code=%s
+           ORDER BY shard_no FOR UPDATE""",
+        (warehouse_id, product_id, location_code))
+    return (stock['quantity'] if stock else None), cursor.fetchall()
+
+
+def _write_shards(cursor, warehouse_id, product_id, location_code, total, shard_count):
+    """把 total 平均写入 shard_count 个分片，并清零 stocks 行上的数量。"""
+    for shard_no, qty in enumerate(_split_evenly(total, shard_count)):
+        cursor.execute(
+            """INSERT INTO stock_shards (warehouse_id, product_id, location_code, shard_no, quantity)
+               VALUES (%s, %s, %s, %s, %s)
+               ON CONFLICT (warehouse_id, product_id, location_code, shard_no) DO UPDATE SET quantity = EXCLUDED.quantity""",
+            (warehouse_id, product_id, location_code, shard_no, qty))
+    cursor.execute(
+        "DELETE FROM stock_shards WHERE warehouse_id=%s AND product_id=%s AND location_code=%s AND shard_no >= %s",
+        (warehouse_id, product_id, location_code, shard_count))
+    # stocks 行保留（供列表 JOIN 使用），数量全部转移到分片
+    cursor.execute(
+        """INSERT INTO stocks (warehouse_id, product_id, location_code, quantity) VALUES (%s, %s, %s, 0)
+           ON CONFLICT (warehouse_id, product_id, location_code) DO UPDATE SET quantity = 0""",
+        (warehouse_id, product_id, location_code))
+
+
+def get_on_hand(cursor, warehouse_id, product_id, location_code):
+    """读取单个库存键的在库数量（stocks 行 + 全部分片）。"""
+    ensure_tables(cursor)
+    cursor.execute(
+        """SELECT COALESCE((SELECT quantity FROM stocks WHERE warehouse_id=%s AND product_id=%s AND location_code=%s), 0)
+                + COALESCE((SELECT SUM(quantity) FROM stock_shards WHERE warehouse_id=%s AND product_id=%s AND location_code=%s), 0)
+                  AS quantity""",
+        (warehouse_id, product_id, location_code) * 2)
+    return cursor.fetchone()['quantity']
+
+
+def fetch_on_hand(cursor, product_ids, warehouse_id=None):
+    """一次查询批量读取多个商品在各 (仓库, 货架) 上的在库数量（含分片），只返回数量大于 0 的行。"""
+    ensure_tables(cursor)
+    product_ids = [str(p) for p in product_ids]
+    warehouse_filter = " AND warehouse_id = %s" if warehouse_id else ""
+    params = [product_ids] + ([warehouse_id] if warehouse_id else [])
+    cursor.execute(
+        f"""SELECT warehouse_id, product_id, location_code, SUM(quantity) AS quantity
+            FROM (SELECT warehouse_id, product_id, location_code, quantity FROM stocks
+                  WHERE product_id = ANY(%s::uuid[]){warehouse_filter}
+                  UNION ALL
+                  SELECT warehouse_id, product_id, location_code, quantity FROM stock_shards
+                  WHERE product_id = ANY(%s::uuid[]){warehouse_filter}) u
+            GROUP BY warehouse_id, product_id, location_code
+            HAVING SUM(quantity) > 0""",
+        tuple(params * 2))
+    return cursor.fetchall()
+
+
+def decrement_stock(cursor, warehouse_id, product_id, location_code, qty, reserved=0):
+    """扣减库存，不足时抛出 InsufficientStockError。
+
+    reserved 为须留给其他订单的已分配数量 (见 reservations.reserved_by_others)，扣减后的在库量不得低于它。
+    """
+    shard_count = get_shard_count(cursor, product_id)
+    if not shard_count:
+        prepared.execute(cursor, STOCK_FOR_UPDATE, (warehouse_id, product_id, location_code))
+        stock = cursor.fetchone()
+        if stock and stock['quantity'] - reserved >= qty:
+            prepared.execute(cursor, STOCK_DECREMENT, (qty, warehouse_id, product_id, location_code))
+            return
+        # 其他容器刚启用分片时 (stocks 行已清零)，本进程缓存的「未分片」最多过期 SHARD_CONFIG_TTL 秒：
+        # 判定不足前不经缓存再确认一次，已分片则按分片路径扣减
+        shard_count = get_shard_count(cursor, product_id, refresh=True)
+        if not shard_count:
+            raise InsufficientStockError(f"商品 {product_id} 在货架 {location_code} 库存不足")
+
+    # 快路径：随机起点轮询，跳过其他事务正在持有的分片。有预占时须核对全部分片的合计，走慢路径
+    if not reserved:
+        start = random.randrange(shard_count)
+        prepared.execute(cursor, SHARD_TAKE,
+                         (qty, warehouse_id, product_id, location_code, qty, start, shard_count, shard_count))
+        if cursor.fetchone():
+            return
+
+    # 慢路径：没有单个分片满足需求（或全部被锁），按固定顺序锁定全部分片后逐个扣减
+    stock_qty, shards = _lock_key(cursor, warehouse_id, product_id, location_code)
+    available = (stock_qty or 0) + sum(s['quantity'] for s in shards) - reserved
+    if available < qty:
+        raise InsufficientStockError(f"商品 {product_id} 在货架 {location_code} 库存不足")
+    remaining = qty
+    for shard in shards:
+        take = min(shard['quantity'], remaining)
+        if take > 0:
+            cursor.execute(
+                """UPDATE stock_shards SET quantity = quantity - %s
+                   WHERE warehouse_id=%s AND product_id=%s AND location_code=%s AND shard_no=%s""",
+                (take, warehouse_id, product_id, location_code, shard['shard_no']))
+            remaining -= take
+        if remaining == 0:
+            return
+    prepared.execute(cursor, STOCK_DECREMENT, (remaining, warehouse_id, product_id, location_code))
+
+
+def increment_stock(cursor, warehouse_id, product_id, location_code, qty):
+    """增加库存；分片商品随机落到一个分片上，避免入库也争抢同一行。"""
+    shard_count = get_shard_count(cursor, product_id)
+    if shard_count:
+        cursor.execute(
+            """INSERT INTO stock_shards (warehouse_id, product_id, location_code, shard_no, quantity)
+               VALUES (%s, %s, %s, %s, %s)
+               ON CONFLICT (warehouse_id, product_id, location_code, shard_no) DO UPDATE SET quantity = stock_shards.quantity + EXCLUDED.quantity""",
+            (warehouse_id, product_id, location_code, random.randrange(shard_count), qty))
+        cursor.execute(
+            """INSERT INTO stocks (warehouse_id, product_id, location_code, quantity) VALUES (%s, %s, %s, 0)
+               ON CONFLICT (warehouse_id, product_id, location_code) DO NOTHING""",
+            (warehouse_id, product_id, location_code))
+        return
+    cursor.execute(
+        """INSERT INTO stocks (warehouse_id, product_id, location_code, quantity) VALUES (%s, %s, %s, %s)
+           ON CONFLICT (warehouse_id, product_id, location_code) DO UPDATE SET quantity = stocks.quantity + %s""",
+        (warehouse_id, product_id, location_code, qty, qty))
+
+
+def set_stock(cursor, warehouse_id, product_id, location_code, qty):
+    """把库存直接设置为 qty（盘点/手工调整），返回调整前的在库数量。"""
+    # 不经缓存：按过期的「未分片」直接覆盖 stocks 行会漏算各分片上的数量
+    shard_count = get_shard_count(cursor, product_id, refresh=True)
+    if shard_count:
+        stock_qty, shards = _lock_key(cursor, warehouse_id, product_id, location_code)
+        current = (stock_qty or 0) + sum(s['quantity'] for s in shards)
+        _write_shards(cursor, warehouse_id, product_id, location_code, qty, shard_count)
+        return current
+    prepared.execute(cursor, STOCK_FOR_UPDATE, (warehouse_id, product_id, location_code))
+    current = (cursor.fetchone() or {}).get('quantity', 0)
+    cursor.execute(
+        """INSERT INTO stocks (warehouse_id, product_id, location_code, quantity) VALUES (%s, %s, %s, %s)
+           ON CONFLICT (warehouse_id, product_id, location_code) DO UPDATE SET quantity = %s""",
+        (warehouse_id, product_id, location_code, qty, qty))
+    return current
+
+
+def rebalance_product(cursor, product_id, shard_count):
+    """把商品所有库存键上的 stocks 残留并入分片，并在 shard_count 个分片间均衡。"""
+    cursor.execute(
+        """SELECT warehouse_id, product_id, location_code FROM stocks WHERE product_id = %s
+           UNION
+           SELECT warehouse_id, product_id, location_code FROM stock_shards WHERE product_id = %s
+           ORDER BY warehouse_id, location_code""",
+        (product_id, product_id))
+    keys = cursor.fetchall()
+    for key in keys:
+        w_id, loc = key['warehouse_id'], key['location_code']
+        stock_qty, shards = _lock_key(cursor, w_id, product_id, loc)
+        total = (stock_qty or 0) + sum(s['quantity'] for s in shards)
+        _write_shards(cursor, w_id, product_id, loc, total, shard_count)
+    return len(keys)
+
+
+def enable_sharding(cursor, product_id, shard_count=None):
+    """为商品启用分片模式，并把现有库存拆分到各分片。"""
+    ensure_tables(cursor)
+    shard_count = shard_count or DEFAULT_SHARD_COUNT
+    cursor.execute(
+        """INSERT INTO sharded_products (product_id, shard_count) VALUES (%s, %s)
+           ON CONFLICT (product_id) DO UPDATE SET shard_count = EXCLUDED.shard_count""",
+        (product_id, shard_count))
+    _shard_config_cache.pop(str(product_id), None)
+    return rebalance_product(cursor, product_id, shard_count)
+
+
+def disable_sharding(cursor, product_id):
+    """关闭分片模式：把各分片数量合并回 stocks 单行。"""
+    ensure_tables(cursor)
+    cursor.execute(
+        "SELECT DISTINCT warehouse_id, location_code FROM stock_shards WHERE product_id = %s ORDER BY warehouse_id, location_code",
+        (product_id,))
+    for key in cursor.fetchall():
+        w_id, loc = key['warehouse_id'], key['location_code']
+        stock_qty, shards = _lock_key(cursor, w_id, product_id, loc)
+        total = (stock_qty or 0) + sum(s['quantity'] for s in shards)
+        cursor.execute(
+            """INSERT INTO stocks (warehouse_id, product_id, location_code, quantity) VALUES (%s, %s, %s, %s)
+               ON CONFLICT (warehouse_id, product_id, location_code) DO UPDATE SET quantity = %s""",
+            (w_id, product_id, loc, total, total))
+    cursor.execute("DELETE FROM stock_shards WHERE product_id = %s", (product_id,))
+    cursor.execute("DELETE FROM sharded_products WHERE product_id = %s", (product_id,))
+    _shard_config_cache.pop(str(product_id), None)
+
+
+def consolidator_handler(event, context):
+    """后台整理任务（可由定时事件触发）：逐个商品均衡分片，每个商品单独提交以缩短持锁时间。"""
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    rebalanced = 0
+    try:
+        ensure_tables(cursor)
+        conn.commit()
+        cursor.execute("SELECT product_id, shard_count FROM sharded_products ORDER BY product_id")
+        for product in cursor.fetchall():
+            try:
+                rebalanced += rebalance_product(cursor, product['product_id'], product['shard_count'])
+                conn.commit()
+            except psycopg2.Error as error:
+                conn.rollback()
+                print(f"[SHARD_ERROR] 均衡商品 {product['product_id']} 的分片失败: {error}")
+        return {'statusCode': 200, 'body': json.dumps({'rebalanced_keys': rebalanced})}
+    finally:
+        cursor.close()
+        conn.close()
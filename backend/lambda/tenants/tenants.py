@@ -3,7 +3,6 @@
 
 import json
 import psycopg2
-import bcrypt
 import logging
 import os
 import random
@@ -11,7 +10,12 @@ import string
 from psycopg2.extras import RealDictCursor
 
 # 导入设计好的工具
-from db_utils import get_public_connection, get_db_connection, build_response, CustomEncoder
+from db_utils import (get_public_connection, get_db_connection, build_response, cached_response, CustomEncoder, instrument,
+                      invalidate_reference, invalidate_tenant)
+from tracing import span, trace_handler
+from passwords import hash_password
+from entitlements import invalidate_entitlements, refresh_entitlements
+import metering
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -23,29 +27,32 @@ def generate_password(length=12):
 
 # --- API 功能实现 ---
 
+# 登录页租户列表：浏览器与 CDN 缓存 60 秒，之后 5 分钟内可先用旧值再后台重新验证 (ETag 命中返回 304)。
+# 同一路径带管理员凭证时返回完整列表，因此按 Authorization 区分缓存。
+PUBLIC_TENANTS_CACHE_CONTROL = 'public, max-age=60, s-maxage=60, stale-while-revalidate=300'
+
 # [公共函数] 为登录页提供公开的、无需授权的租户列表
-def get_public_tenants_list(conn):
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        query = "SELECT name, domain FROM public.tenants WHERE status = 'active' ORDER BY name;"
-        cur.execute(query)
-        rows = cur.fetchall()
-        logger.info(f"[TENANTS_DEBUG] public list (no auth) returned {len(rows)} rows from public.tenants")
-        return build_response(200, rows, encoder=CustomEncoder)
+def get_public_tenants_list(event):
+    def load():
+        conn = get_public_connection()
+        if not conn:
+            raise psycopg2.OperationalError("数据库连接失败")
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                query = "SELECT name, domain FROM public.tenants WHERE status = 'active' ORDER BY name;"
+                cur.execute(query)
+                return cur.fetchall()
+        finally:
+            conn.close()
+    try:
+        return cached_response(event, 'public_tenants', load, PUBLIC_TENANTS_CACHE_CONTROL,
+                               encoder=CustomEncoder, headers={'Vary': 'Authorization'})
+    except psycopg2.OperationalError:
+        return build_response(503, {"message": "数据库连接失败"})
 
 # [受保护函数] 为管理员提供包含所有详细信息的完整租户列表（与前端 transformTenantFromApi 字段一致）
 def get_all_tenants_for_admin(conn):
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        # 调试：确认当前库与 schema，以及 public.tenants 行数
-        try:
-            cur.execute("SELECT current_database() AS db, current_schema() AS schema;")
-            diag = cur.fetchone()
-            logger.info(f"[TENANTS_DEBUG] current_database={diag.get('db')}, current_schema={diag.get('schema')}")
-            cur.execute("SELECT count(*) AS n FROM public.tenants;")
-            cnt = cur.fetchone().get('n')
-            logger.info(f"[TENANTS_DEBUG] public.tenants row count={cnt}")
-        except Exception as e:
-            logger.warning(f"[TENANTS_DEBUG] diagnostic query failed: {e}")
-
         query = """
             SELECT 
                 t.id, t.name, t.domain, t.status, t.admin_name, t.admin_email, t.created_at, 
@@ -57,13 +64,6 @@ def get_all_tenants_for_admin(conn):
         """
         cur.execute(query)
         rows = cur.fetchall()
-        logger.info(f"[TENANTS_DEBUG] admin list query returned {len(rows)} rows")
-        if rows:
-            first = dict(rows[0])
-            for k, v in list(first.items()):
-                if hasattr(v, 'isoformat'):
-                    first[k] = v.isoformat()
-            logger.info(f"[TENANTS_DEBUG] first row keys={list(first.keys())}, id={first.get('id')}, name={first.get('name')}, domain={first.get('domain')}")
 
         # 前端 Tenant.id 为 string；统一把 id 转为 str，避免类型不一致
         out = []
@@ -112,7 +112,7 @@ def create_tenant(conn, body):
             return build_response(500, {"message": "触发器未设置 schema_name"})
         cur.execute("SELECT create_tenant_tables_and_roles(%s);", (schema_name,))
         initial_password = generate_password()
-        hashed = bcrypt.hashpw(initial_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed = hash_password(initial_password)
         cur.execute(
             f'INSERT INTO {psycopg2.extensions.quote_ident(schema_name, cur)}."users" (name, email, password_hash, role) VALUES (%s, %s, %s, %s);',
             ('admin', admin_email, hashed, 'admin'),
@@ -151,6 +151,7 @@ def create_tenant(conn, body):
             (tenant_id, json.dumps({"name": name, "domain": domain, "plan_id": plan_id, "industry_id": industry_id})),
         )
         conn.commit()
+    invalidate_reference('public_tenants')
     tenant_out = {
         "id": str(row['id']),
         "name": row['name'],
@@ -181,7 +182,14 @@ def get_tenant_usage(conn, tenant_id):
         schema_bytes = cur.fetchone()['schema_bytes'] or 0
         storage_mb = round(schema_bytes / (1024 * 1024), 2)
         storage_gb = round(schema_bytes / (1024 * 1024 * 1024), 2)
-        out = {"userCount": user_count, "storageSize": f"{storage_gb} GB", "storageSizeMb": storage_mb, "storageBytes": schema_bytes}
+        metering.ensure_tables(cur)
+        cur.execute(
+            "SELECT metric, count FROM public.tenant_usage_daily WHERE tenant_id = %s AND day = (now() AT TIME ZONE 'utc')::date;",
+            (tenant_id,),
+        )
+        today = {r['metric']: r['count'] for r in cur.fetchall()}
+        out = {"userCount": user_count, "storageSize": f"{storage_gb} GB", "storageSizeMb": storage_mb, "storageBytes": schema_bytes,
+               "apiCallsToday": today.get('api_calls', 0), "aiCallsToday": today.get('ai_calls', 0)}
         if max_users is not None:
             out["maxUsers"] = max_users
         if max_storage_gb is not None:
@@ -199,7 +207,7 @@ def reset_admin_password(conn, tenant_id):
         schema_name = tenant['schema_name']
         admin_email = tenant['admin_email']
         new_password = generate_password()
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = hash_password(new_password)
         update_sql = f"""UPDATE {psycopg2.extensions.quote_ident(schema_name, cur)}.users SET password_hash = %s WHERE email = %s AND role = 'admin';"""
         cur.execute(update_sql, (hashed_password, admin_email))
         conn.commit()
@@ -215,6 +223,8 @@ def delete_tenant(conn, tenant_id):
         cur.execute("DELETE FROM public.tenants WHERE id = %s;", (tenant_id,))
         cur.execute(f"DROP SCHEMA IF EXISTS {psycopg2.extensions.quote_ident(schema_name, cur)} CASCADE;")
         conn.commit()
+        invalidate_tenant(tenant_id)
+        invalidate_entitlements(tenant_id)
         return build_response(200, {"message": f"租户 {tenant_id} 及其所有数据已被永久删除"})
 
 def _append_tenant_history(conn, tenant_id, action, payload):
@@ -233,6 +243,9 @@ def update_tenant_status(conn, tenant_id, body):
         cur.execute("UPDATE public.tenants SET status = %s WHERE id = %s;", (status, tenant_id))
         _append_tenant_history(conn, tenant_id, 'updated', {"status": {"from": old['status'] if old else None, "to": status}})
     conn.commit()
+    # 登录使用的域名缓存立即失效 (其他容器最迟 TENANT_CACHE_TTL 秒后生效)
+    invalidate_tenant(tenant_id)
+    invalidate_entitlements(tenant_id)
     return build_response(200, {"message": "状态更新成功"})
 
 def update_tenant_plan(conn, tenant_id, body):
@@ -251,6 +264,8 @@ def update_tenant_plan(conn, tenant_id, body):
         cur.execute("UPDATE public.tenants SET plan_id = %s WHERE id = %s;", (plan_id, tenant_id))
         _append_tenant_history(conn, tenant_id, 'updated', {"plan_id": {"from": old['plan_id'] if old else None, "to": plan_id}})
     conn.commit()
+    # 本进程的权益快照立即按新方案重建，其他进程最迟 ENTITLEMENT_CACHE_TTL 秒后生效
+    refresh_entitlements(conn, tenant_id)
     return build_response(200, {"message": "方案更新成功"})
 
 def get_tenant_history(conn, tenant_id):
@@ -283,6 +298,8 @@ def provision_subdomain(conn, tenant_id):
 
 
 # --- 主路由 (V12 最终智能路由修复版) ---
+@instrument
+@trace_handler('tenants')
 def handler(event, context):
     logger.info("--- TenantsFunction v12.0 Handler START ---")
     conn = None
@@ -302,20 +319,20 @@ def handler(event, context):
                 return get_all_tenants_for_admin(conn)
             else:
                 logger.info("未检测到凭证，作为公共请求，返回公开租户列表")
-                conn = get_public_connection()
-                if not conn: return build_response(503, {"message": "数据库连接失败"})
-                return get_public_tenants_list(conn)
+                return get_public_tenants_list(event)
+
+        resource = path_parts[1] if len(path_parts) > 1 else ''
+        tenant_id = path_parts[2] if len(path_parts) > 2 else None
+        action = path_parts[3] if len(path_parts) > 3 else ''
 
         # --- 从此处开始，所有其他路由都必须经过授权 ---
-        conn = get_db_connection(event)
+        # 变更历史是纯读取，可走读副本；usage 会按需建表，仍用主库
+        conn = get_db_connection(event, intent='read' if method == 'GET' and action == 'history' else 'write')
         if not conn:
             return build_response(403, {"message": "访问被拒绝：需要有效的凭证或凭证已过期"})
 
-        body = json.loads(event.get("body", "{}")) if event.get("body") else {}
-        
-        resource = path_parts[1] if len(path_parts) > 1 else ''
-        tenant_id = path_parts[2] if len(path_parts) > 2 else None
-        action = path_parts[3] if len(path_parts) > 3 else ''
+        with span('parse'):
+            body = json.loads(event.get("body", "{}")) if event.get("body") else {}
 
         if resource == 'tenants':
             # [受保护] 创建新租户
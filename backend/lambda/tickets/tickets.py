@@ -5,7 +5,8 @@ import json
 import os
 import jwt
 import logging
-from db_utils import get_public_connection, build_response, CustomEncoder
+from db_utils import get_public_connection, build_response, CustomEncoder, instrument
+from tracing import span, trace_handler, traced
 from psycopg2.extras import RealDictCursor
 
 logger = logging.getLogger()
@@ -13,6 +14,7 @@ logger.setLevel(logging.INFO)
 JWT_SECRET = os.environ.get('JWT_SECRET')
 
 
+@traced('auth.jwt_decode')
 def _auth(event):
     headers = {k.lower(): v for k, v in event.get('headers', {}).items()}
     auth = headers.get('authorization', '')
@@ -20,6 +22,8 @@ def _auth(event):
         return None, None
     try:
         payload = jwt.decode(auth.split(' ')[1], JWT_SECRET, algorithms=['HS256'])
+        if payload.get('typ') == 'refresh':
+            return None, None
         is_super = bool(payload.get('is_super_admin'))
         tenant_id = payload.get('tenant_id')
         return is_super, str(tenant_id) if tenant_id is not None else None
@@ -35,6 +39,8 @@ def _cors_headers():
     }
 
 
+@instrument
+@trace_handler('tickets')
 def handler(event, context):
     method = (event.get('requestContext') or {}).get('http', {}).get('method') or event.get('httpMethod', 'GET')
     path = (event.get('rawPath') or event.get('path', '')).strip('/')
@@ -46,10 +52,11 @@ def handler(event, context):
     action = path_parts[3] if len(path_parts) > 3 else None  # reply | status
     body = {}
     if event.get('body'):
-        try:
-            body = json.loads(event['body'])
-        except Exception:
-            pass
+        with span('parse'):
+            try:
+                body = json.loads(event['body'])
+            except Exception:
+                pass
 
     is_super, tenant_id = _auth(event)
     if is_super is None and tenant_id is None:
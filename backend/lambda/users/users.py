@@ -4,14 +4,17 @@
 import json
 import os
 import jwt
-import bcrypt
 from psycopg2.extras import RealDictCursor
 
 # 从 Lambda Layer 直接导入共享模块
-from db_utils import get_db_connection, build_response, CustomEncoder
+from db_utils import get_db_connection, build_response, CustomEncoder, instrument
+from tracing import span, trace_handler, traced
+from passwords import hash_password
+from entitlements import get_entitlements
 
 JWT_SECRET = os.environ.get("JWT_SECRET")
 
+@traced('auth.jwt_decode')
 def _decode_jwt(event):
     """Decodes the JWT from the request headers, returns payload or None."""
     try:
@@ -20,12 +23,16 @@ def _decode_jwt(event):
             return None
         token = auth_header.split(' ')[1]
         decoded = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+        if decoded.get('typ') == 'refresh':
+            raise jwt.InvalidTokenError("Refresh token cannot be used for API access")
         return decoded
     except jwt.ExpiredSignatureError:
         raise Exception("Token has expired")
     except jwt.InvalidTokenError:
         raise Exception("Invalid token")
 
+@instrument
+@trace_handler('users')
 def handler(event, context):
     """
     Lambda handler for user CRUD operations. Uses the shared db_utils layer.
@@ -41,13 +48,13 @@ def handler(event, context):
         if not jwt_payload:
             return build_response(401, {"message": "未提供有效的认证令牌"})
 
-        # 2. 获取数据库连接 (get_db_connection 现在会处理多租户逻辑)
-        conn = get_db_connection(event)
+        # 2. 获取数据库连接 (get_db_connection 现在会处理多租户逻辑；GET 为纯读取，可走读副本)
+        method = event.get('requestContext', {}).get('http', {}).get('method')
+        conn = get_db_connection(event, intent='read' if method == 'GET' else 'write')
         if not conn:
             return build_response(403, {"message": "无法确定租户或访问被拒绝"})
 
         # 3. 路由和业务逻辑
-        method = event.get('requestContext', {}).get('http', {}).get('method')
         path_parameters = event.get('pathParameters') or {}
         user_id_from_path = path_parameters.get('userId')
 
@@ -87,7 +94,8 @@ def handler(event, context):
             elif method == 'POST' and not user_id_from_path:
                 if not is_admin:
                     return build_response(403, {"message": "权限不足，只有管理员才能创建用户。"})
-                body = json.loads(event.get("body") or "{}")
+                with span('parse'):
+                    body = json.loads(event.get("body") or "{}")
                 name = (body.get("name") or "").strip()
                 email = (body.get("email") or "").strip()
                 password = body.get("password") or ""
@@ -96,18 +104,15 @@ def handler(event, context):
                     return build_response(400, {"message": "缺少 name、email 或 password。"})
                 tenant_id = jwt_payload.get("tenant_id")
                 if tenant_id is not None:
-                    cur.execute(
-                        "SELECT p.max_users FROM public.tenants t LEFT JOIN public.plans p ON t.plan_id = p.id WHERE t.id = %s",
-                        (tenant_id,),
-                    )
-                    row = cur.fetchone()
-                    max_users = row.get("max_users") if row else None
+                    # 限额来自缓存的权益快照；不限人数的方案无需计数
+                    entitlements = get_entitlements(tenant_id, cur)
+                    max_users = entitlements.limit("max_users") if entitlements else None
                     if max_users is not None:
                         cur.execute("SELECT count(*) AS c FROM users")
                         count = cur.fetchone()["c"]
                         if count >= max_users:
                             return build_response(400, {"message": f"当前方案最多允许 {max_users} 个用户，已达上限。"})
-                hashed = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+                hashed = hash_password(password)
                 cur.execute(
                     "INSERT INTO users (name, email, password_hash, role) VALUES (%s, %s, %s, %s) RETURNING id, name, email, role, created_at",
                     (name, email, hashed, role),
@@ -0,0 +1,155 @@
+# backend/service/app.py
+# 常驻服务模式：在一个 WSGI 应用中挂载全部 Lambda 处理函数，供高用量租户运行在长期存活的容器上，
+# 连接复用、权益/租户/参考列表等进程内缓存与预编译语句都能跨请求生效。
+#
+# 启动 (多进程 worker，见 gunicorn.conf.py):
+#   gunicorn -c backend/service/gunicorn.conf.py app:application
+# 平滑重载: kill -HUP <master pid>  (新 worker 就绪后旧 worker 处理完手头请求再退出)
+#
+# - 路由表见 routes.py；请求按路由声明的格式转换为 API Gateway 1.0 / 2.0 事件 (见 events.py)，
+#   处理函数的返回值按 Lambda 代理集成的规则转换为 HTTP 响应。
+# - 连接：本进程设置 DB_PERSISTENT_CONNECTIONS=true，db_utils 建立的连接在 close() 后重置会话并复用；
+#   扁平模块各自的 get_db_connection 改为经 db_utils.connect 建立 (参数不变)，同样复用且带查询埋点。
+# - 1.0 路由需要有效的访问令牌，令牌声明作为 requestContext.authorizer 传入 (模拟 REST API 授权方)。
+# - GET /healthz 用于负载均衡健康检查，不访问数据库。
+# - 预占分配、分片整理、成本合并等定时任务由各 worker 的后台线程执行 (见 jobs.py)。
+#
+# 环境变量与 Lambda 相同 (DB_*、JWT_SECRET 等)，另有:
+#   SERVICE_HANDLER_TIMEOUT  传给处理函数的 context 剩余时间 (秒，默认 30)
+
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import uuid
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.normpath(os.path.join(SERVICE_DIR, '..', 'lambda'))
+
+# 须在导入 db_utils 之前设置
+os.environ.setdefault('DB_PERSISTENT_CONNECTIONS', 'true')
+
+for _sub in ('auth', 'users', 'tenants', 'tickets', 'debug_dump', 'saas_admin', 'layers/database_utils', ''):
+    _path = os.path.normpath(os.path.join(LAMBDA_DIR, _sub))
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
+if SERVICE_DIR not in sys.path:
+    sys.path.insert(0, SERVICE_DIR)
+
+import jwt  # noqa: E402
+
+import db_utils  # noqa: E402
+import events  # noqa: E402
+import routes  # noqa: E402
+
+JWT_SECRET = os.environ.get("JWT_SECRET")
+HANDLER_TIMEOUT = float(os.environ.get("SERVICE_HANDLER_TIMEOUT", "30"))
+
+_handlers = {}   # 'dir/module.func' -> 处理函数
+
+
+def _load_module(target):
+    """按 '目录/模块' 加载处理函数所在模块。模块名与目录名不同的 (如 saas_admin/main，与扁平的 main 重名) 以 '目录_模块' 注册。"""
+    directory, _, module = target.rpartition('/')
+    if not directory:
+        return importlib.import_module(module)
+    name = module if module == directory else f"{directory}_{module}"
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(LAMBDA_DIR, directory, f"{module}.py"))
+    loaded = importlib.util.module_from_spec(spec)
+    sys.modules[name] = loaded
+    try:
+        spec.loader.exec_module(loaded)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return loaded
+
+
+def _persistent_flat_connections():
+    """扁平模块的 get_db_connection 按原参数改经 db_utils.connect 建立，关闭后复用。"""
+    for module in list(sys.modules.values()):
+        module_file = getattr(module, '__file__', None) or ''
+        if os.path.dirname(os.path.abspath(module_file)) != LAMBDA_DIR:
+            continue
+        if not callable(getattr(module, 'get_db_connection', None)) or not hasattr(module, 'DB_HOST'):
+            continue
+
+        def connect(module=module):
+            # 与各模块原实现相同的参数 (扁平模块都连主库)
+            return db_utils.connect(host=module.DB_HOST, user=module.DB_USER, password=module.DB_PASSWORD,
+                                    dbname=module.DB_NAME)
+        module.get_db_connection = connect
+
+
+def load_handlers():
+    """导入路由表中的全部处理函数 (worker 启动时调用，首个请求不再承担导入耗时)。"""
+    for route in routes.TABLE:
+        if route.target not in _handlers:
+            module_target, _, func = route.target.rpartition('.')
+            _handlers[route.target] = getattr(_load_module(module_target), func)
+    _persistent_flat_connections()
+    return _handlers
+
+
+def load_handler(target):
+    """按 '目录/模块.函数' 取单个处理函数 (后台任务使用，见 jobs.py)；不在路由表中的同样改用复用连接。"""
+    if target not in _handlers:
+        module_target, _, func = target.rpartition('.')
+        _handlers[target] = getattr(_load_module(module_target), func)
+        _persistent_flat_connections()
+    return _handlers[target]
+
+
+def _claims(environ):
+    auth_header = environ.get('HTTP_AUTHORIZATION', '')
+    if not auth_header.startswith('Bearer '):
+        return None
+    try:
+        claims = jwt.decode(auth_header.split(' ', 1)[1], JWT_SECRET, algorithms=['HS256'])
+    except jwt.PyJWTError:
+        return None
+    return None if claims.get('typ') == 'refresh' else claims
+
+
+def _send(start_response, status, headers, payload):
+    headers = [(k, v) for k, v in headers if k.lower() not in ('content-length', 'connection', 'transfer-encoding')]
+    headers.append(('Content-Length', str(len(payload))))
+    start_response(status, headers)
+    return [payload]
+
+
+def _json(start_response, status, body):
+    return _send(start_response, status, [('Content-Type', 'application/json')],
+                 json.dumps(body, ensure_ascii=False).encode('utf-8'))
+
+
+def application(environ, start_response):
+    method = environ['REQUEST_METHOD'].upper()
+    path = environ.get('PATH_INFO') or '/'
+    if path == '/healthz':
+        return _json(start_response, '200 OK', {'status': 'ok'})
+
+    route, path_params = routes.resolve(method, path)
+    if route is None:
+        return _json(start_response, '404 Not Found', {'message': 'Not Found'})
+
+    claims = None
+    if route.version == '1.0':
+        claims = _claims(environ)
+        if claims is None and method != 'OPTIONS':
+            return _json(start_response, '401 Unauthorized', {'message': 'Unauthorized'})
+    event = events.build_event(environ, route, path_params, claims)
+
+    handler = _handlers.get(route.target) or load_handlers()[route.target]
+    function_name = route.target.rpartition('.')[0].replace('/', '-')
+    context = events.LambdaContext(function_name, HANDLER_TIMEOUT,
+                                   event['requestContext'].get('requestId') or str(uuid.uuid4()))
+    try:
+        result = handler(event, context)
+    except Exception as e:  # 与 Lambda 未捕获异常时 API Gateway 的行为一致
+        print(f"[SERVICE_ERROR] {route.route_key} 处理失败: {e!r}")
+        return _json(start_response, '500 Internal Server Error', {'message': 'Internal Server Error'})
+    return _send(start_response, *events.build_response(result, route.version))
@@ -0,0 +1,181 @@
+# backend/service/events.py
+# WSGI 请求 <-> API Gateway 事件/响应的转换，使 Lambda 处理函数无需修改即可在常驻服务中运行。
+#
+# - 2.0 (HttpApi): rawPath / rawQueryString / routeKey / requestContext.http / cookies，请求头名小写，
+#   同名请求头以逗号合并；空查询串、无路径参数、无请求体时省略对应字段。
+# - 1.0 (REST API): path / httpMethod / resource / multiValue*，requestContext.authorizer 为访问令牌中的声明
+#   (tenant_id、user_id 等)，与 REST API 授权方传给处理函数的内容一致。
+#   queryStringParameters / pathParameters 为空时给 {} 而不是 None (与压测 harness 一致，部分扁平模块未处理 None)。
+# - 请求体不是文本时按 base64 传入 (isBase64Encoded=true)。
+# - 响应：支持 headers / multiValueHeaders / cookies / isBase64Encoded；
+#   2.0 处理函数返回的不是带 statusCode 的 dict 时，按 HttpApi 的规则作为 JSON 响应体返回 200。
+
+import base64
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+from http import HTTPStatus
+from urllib.parse import parse_qsl, unquote
+
+TEXT_TYPES = ('text/', 'application/json', 'application/xml', 'application/x-www-form-urlencoded',
+              'application/javascript')
+
+
+class LambdaContext:
+    """处理函数使用的 context 子集 (aws_request_id、函数名、剩余时间)。"""
+
+    def __init__(self, function_name, timeout_seconds, request_id):
+        self.function_name = function_name
+        self.aws_request_id = request_id
+        self.memory_limit_in_mb = None
+        self._deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+def _headers(environ):
+    """WSGI environ 中的请求头 -> [(小写名称, 值)]。"""
+    headers = []
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            headers.append((key[5:].replace('_', '-').lower(), value))
+        elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH') and value:
+            headers.append((key.replace('_', '-').lower(), value))
+    return headers
+
+
+def _body(environ, content_type):
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    raw = environ['wsgi.input'].read(length) if length > 0 else b''
+    if not raw:
+        return None, False
+    if content_type.startswith(TEXT_TYPES):
+        try:
+            return raw.decode('utf-8'), False
+        except UnicodeDecodeError:
+            pass
+    return base64.b64encode(raw).decode('ascii'), True
+
+
+def _source_ip(environ, headers):
+    forwarded = dict(headers).get('x-forwarded-for')
+    return forwarded.split(',')[0].strip() if forwarded else environ.get('REMOTE_ADDR', '')
+
+
+def build_event(environ, route, path_params, claims=None):
+    """把 WSGI 请求转换为 route.version 对应格式的事件。"""
+    method = environ['REQUEST_METHOD'].upper()
+    path = unquote(environ.get('PATH_INFO') or '/')
+    raw_query = environ.get('QUERY_STRING', '')
+    query_pairs = parse_qsl(raw_query, keep_blank_values=True)
+    header_list = _headers(environ)
+    merged = {}
+    multi = {}
+    for name, value in header_list:
+        merged[name] = f"{merged[name]},{value}" if name in merged else value
+        multi.setdefault(name, []).append(value)
+    body, is_base64 = _body(environ, merged.get('content-type', ''))
+    request_id = merged.get('x-request-id') or str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    source_ip = _source_ip(environ, header_list)
+    user_agent = merged.get('user-agent', '')
+
+    if route.version == '2.0':
+        query = {}
+        for name, value in query_pairs:
+            query[name] = f"{query[name]},{value}" if name in query else value
+        cookies = [c.strip() for c in merged.pop('cookie', '').split(';') if c.strip()]
+        event = {
+            'version': '2.0',
+            'routeKey': route.route_key,
+            'rawPath': path,
+            'rawQueryString': raw_query,
+            'headers': merged,
+            'requestContext': {
+                'domainName': merged.get('host', ''),
+                'http': {'method': method, 'path': path, 'protocol': environ.get('SERVER_PROTOCOL', 'HTTP/1.1'),
+                         'sourceIp': source_ip, 'userAgent': user_agent},
+                'requestId': request_id,
+                'routeKey': route.route_key,
+                'stage': '$default',
+                'time': now.strftime('%d/%b/%Y:%H:%M:%S +0000'),
+                'timeEpoch': int(now.timestamp() * 1000),
+            },
+            'isBase64Encoded': is_base64,
+        }
+        if cookies:
+            event['cookies'] = cookies
+        if query:
+            event['queryStringParameters'] = query
+        if path_params:
+            event['pathParameters'] = path_params
+        if body is not None:
+            event['body'] = body
+        return event
+
+    multi_query = {}
+    for name, value in query_pairs:
+        multi_query.setdefault(name, []).append(value)
+    event = {
+        'version': '1.0',
+        'resource': route.template,
+        'path': path,
+        'httpMethod': method,
+        'headers': {name: values[-1] for name, values in multi.items()},
+        'multiValueHeaders': multi,
+        'queryStringParameters': {name: values[-1] for name, values in multi_query.items()},
+        'multiValueQueryStringParameters': multi_query or None,
+        'pathParameters': path_params or {},
+        'stageVariables': None,
+        'requestContext': {
+            'resourcePath': route.template,
+            'httpMethod': method,
+            'path': path,
+            'stage': '$default',
+            'requestId': request_id,
+            'requestTimeEpoch': int(now.timestamp() * 1000),
+            'identity': {'sourceIp': source_ip, 'userAgent': user_agent},
+            'authorizer': dict(claims or {}),
+        },
+        'isBase64Encoded': is_base64,
+    }
+    if body is not None:
+        event['body'] = body
+    return event
+
+
+def build_response(result, version):
+    """处理函数的返回值 -> (状态行, [(名称, 值)], 响应体 bytes)。"""
+    if not (isinstance(result, dict) and 'statusCode' in result):
+        if version == '2.0':
+            result = {'statusCode': 200, 'headers': {'Content-Type': 'application/json'},
+                      'body': result if isinstance(result, str) else json.dumps(result, ensure_ascii=False)}
+        else:
+            result = {'statusCode': 502, 'body': json.dumps({'message': 'Internal server error'})}
+    status_code = int(result['statusCode'])
+    headers = [(str(k), str(v)) for k, v in (result.get('headers') or {}).items()]
+    seen = {k.lower() for k, _ in headers}
+    for name, values in (result.get('multiValueHeaders') or {}).items():
+        if name.lower() not in seen:
+            headers.extend((str(name), str(v)) for v in values)
+    headers.extend(('Set-Cookie', str(c)) for c in result.get('cookies') or ())
+
+    body = result.get('body')
+    if body is None:
+        payload = b''
+    elif result.get('isBase64Encoded'):
+        payload = base64.b64decode(body)
+    else:
+        payload = body.encode('utf-8') if isinstance(body, str) else str(body).encode('utf-8')
+    if not any(k.lower() == 'content-type' for k, _ in headers) and payload:
+        headers.append(('Content-Type', 'application/json'))
+    try:
+        reason = HTTPStatus(status_code).phrase
+    except ValueError:
+        reason = ''
+    return f"{status_code} {reason}".strip(), headers, payload
@@ -0,0 +1,48 @@
+# backend/service/gunicorn.conf.py
+# 常驻服务的 gunicorn 配置：多进程 worker，每个 worker 内多线程 (gthread)。
+#   gunicorn -c backend/service/gunicorn.conf.py app:application
+#
+# - 不预加载应用 (preload_app=False)：每个 worker 自己导入处理函数并建立连接，避免 fork 共享数据库连接，
+#   也使 SIGHUP 平滑重载能加载新代码 (新 worker 启动后旧 worker 处理完手头请求再退出)。
+# - worker 启动后立即导入全部处理函数并启动后台定时任务 (jobs.py)；退出前停止任务、刷新用量计数并关闭空闲连接。
+# - max_requests 让 worker 定期轮换，释放长期运行积累的内存；jitter 避免所有 worker 同时重启。
+# - 每个 worker 的数据库连接数约为 threads (空闲保留上限见 DB_PERSISTENT_IDLE)，
+#   workers x threads 应小于数据库 max_connections 中分给本服务的份额。
+
+import multiprocessing
+import os
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = os.environ.get("SERVICE_BIND", "0.0.0.0:8080")
+workers = int(os.environ.get("WEB_CONCURRENCY", str(min(multiprocessing.cpu_count() * 2 + 1, 8))))
+worker_class = "gthread"
+threads = int(os.environ.get("SERVICE_THREADS", "4"))
+timeout = int(os.environ.get("SERVICE_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("SERVICE_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+max_requests = int(os.environ.get("SERVICE_MAX_REQUESTS", "10000"))
+max_requests_jitter = max_requests // 10
+preload_app = False
+accesslog = "-"
+errorlog = "-"
+forwarded_allow_ips = os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+
+def post_worker_init(worker):
+    import app
+    import jobs
+    handlers = app.load_handlers()
+    worker.log.info("已加载 %d 个处理函数", len(handlers))
+    jobs.start(app.load_handler)
+
+
+def worker_exit(server, worker):
+    try:
+        import db_utils
+        import jobs
+        import metering
+    except ImportError:
+        return
+    jobs.stop()
+    metering.flush()
+    db_utils.close_idle_connections()
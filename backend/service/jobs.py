@@ -0,0 +1,58 @@
+# backend/service/jobs.py
+# 常驻服务中的后台定时任务：与 template.yaml 中 Schedule 触发的函数一一对应，
+# 只以常驻服务部署时由各 worker 的后台线程按间隔调用同一个处理函数。
+#
+# - 每个 worker 各跑一份：这些任务都可以并发运行 (预占 worker 用 SKIP LOCKED 领取任务，
+#   分片整理与成本合并按商品加锁)，首次执行加随机延迟，避免所有 worker 同时开始。
+# - SERVICE_JOBS_ENABLED=false 时不启动 (例如另有 Lambda 定时函数负责)。
+#
+# 每个任务: (处理函数, 间隔秒数)，处理函数写法同 routes.py。
+
+import os
+import random
+import threading
+import time
+import uuid
+
+import events
+
+SERVICE_JOBS_ENABLED = os.environ.get("SERVICE_JOBS_ENABLED", "true").lower() == "true"
+JOB_TIMEOUT = float(os.environ.get("SERVICE_JOB_TIMEOUT", "60"))
+
+JOBS = [
+    ('reservations.worker_handler', 60),
+    ('stock_shards.consolidator_handler', 300),
+    ('costing.fold_handler', 60),
+]
+
+_started = False
+_stop = threading.Event()
+
+
+def _run(target, handler, interval):
+    _stop.wait(random.uniform(0, interval))
+    while not _stop.is_set():
+        context = events.LambdaContext(target.rpartition('.')[0], JOB_TIMEOUT, str(uuid.uuid4()))
+        started = time.monotonic()
+        try:
+            result = handler({}, context)
+            if isinstance(result, dict) and int(result.get('statusCode', 200)) >= 400:
+                print(f"[JOB_ERROR] {target}: {result.get('body')}")
+        except Exception as e:  # 单次失败不终止线程，下个周期重试
+            print(f"[JOB_ERROR] {target}: {e}")
+        _stop.wait(max(0.0, interval - (time.monotonic() - started)))
+
+
+def start(resolve):
+    """启动后台任务线程；resolve('模块.函数') 返回处理函数 (见 app.load_handler)。"""
+    global _started
+    if _started or not SERVICE_JOBS_ENABLED:
+        return
+    _started = True
+    for target, interval in JOBS:
+        threading.Thread(target=_run, args=(target, resolve(target), interval),
+                         name=f"job-{target}", daemon=True).start()
+
+
+def stop():
+    _stop.set()
@@ -0,0 +1,93 @@
+# backend/service/routes.py
+# 常驻服务的路由表：所有 worker 共用同一份定义，与 template.yaml 中各函数的 HttpApi 事件一一对应。
+#
+# 每条路由: (方法, 路径模板, 处理函数, 事件格式)
+#   - 处理函数写成 '目录/模块.函数' (目录为 backend/lambda 下的子目录，扁平模块不写目录)
+#   - 路径模板与 API Gateway 相同：{name} 匹配一段，{proxy+} 匹配剩余全部；方法 ANY 匹配任意方法
+#   - 事件格式 '2.0' 为 HttpApi (payload format 2.0)；'1.0' 为 REST API 风格，供读取 event['path'] /
+#     event['httpMethod'] 与 requestContext.authorizer 的扁平模块使用，需要有效的访问令牌 (模拟 REST API 的授权方)
+#
+# 新增 Lambda 路由时同步在这里登记；先登记的路由优先匹配。
+
+import re
+
+ROUTES = [
+    # --- HttpApi (template.yaml) ---
+    ('POST', '/api/auth/login', 'auth/auth.handler', '2.0'),
+    ('ANY', '/admin/{proxy+}', 'saas_admin/main.handler', '2.0'),
+    ('GET', '/api/tenants', 'tenants/tenants.handler', '2.0'),
+    ('POST', '/api/tenants', 'tenants/tenants.handler', '2.0'),
+    ('PUT', '/api/tenants/{tenantId}/status', 'tenants/tenants.handler', '2.0'),
+    ('PUT', '/api/tenants/{tenantId}/plan', 'tenants/tenants.handler', '2.0'),
+    ('POST', '/api/tenants/{tenantId}/reset-password', 'tenants/tenants.handler', '2.0'),
+    ('GET', '/api/tenants/{tenantId}/usage', 'tenants/tenants.handler', '2.0'),
+    ('GET', '/api/tenants/{tenantId}/history', 'tenants/tenants.handler', '2.0'),
+    ('POST', '/api/tenants/{tenantId}/provision-subdomain', 'tenants/tenants.handler', '2.0'),
+    ('DELETE', '/api/tenants/{tenantId}', 'tenants/tenants.handler', '2.0'),
+    ('GET', '/api/users', 'users/users.handler', '2.0'),
+    ('POST', '/api/users', 'users/users.handler', '2.0'),
+    ('GET', '/api/users/{userId}', 'users/users.handler', '2.0'),
+    ('ANY', '/api/tickets', 'tickets/tickets.handler', '2.0'),
+    ('ANY', '/api/tickets/{proxy+}', 'tickets/tickets.handler', '2.0'),
+    ('GET', '/api/debug/dump', 'debug_dump/debug_dump.handler', '2.0'),
+
+    # --- 扁平业务模块 (按各模块 lambda_handler 解析的路径挂载) ---
+    ('ANY', '/products', 'products.lambda_handler', '1.0'),
+    ('ANY', '/products/{proxy+}', 'products.lambda_handler', '1.0'),
+    ('ANY', '/orders', 'orders.lambda_handler', '1.0'),
+    ('ANY', '/orders/{proxy+}', 'orders.lambda_handler', '1.0'),
+    ('ANY', '/inventory/{proxy+}', 'inventory.lambda_handler', '1.0'),
+    ('ANY', '/finance/{proxy+}', 'finance.lambda_handler', '1.0'),
+    ('ANY', '/approvals', 'approvals.lambda_handler', '1.0'),
+    ('ANY', '/approvals/{proxy+}', 'approvals.lambda_handler', '1.0'),
+    ('ANY', '/partners', 'partners.lambda_handler', '1.0'),
+    ('ANY', '/partners/{proxy+}', 'partners.lambda_handler', '1.0'),
+    ('ANY', '/expenses', 'expenses.lambda_handler', '1.0'),
+    ('POST', '/pos', 'pos.lambda_handler', '1.0'),
+    ('GET', '/reports/{proxy+}', 'reports.lambda_handler', '1.0'),
+    ('ANY', '/mobile/approvals', 'mobile_approvals.lambda_handler', '1.0'),
+    ('ANY', '/mobile/inventory', 'mobile_inventory.lambda_handler', '1.0'),
+]
+
+_PARAM = re.compile(r"\{([^}+]+)(\+?)\}")
+
+
+class Route:
+    __slots__ = ('method', 'template', 'target', 'version', 'pattern')
+
+    def __init__(self, method, template, target, version):
+        self.method = method
+        self.template = template
+        self.target = target
+        self.version = version
+        regex, pos = [], 0
+        for m in _PARAM.finditer(template):
+            regex.append(re.escape(template[pos:m.start()]))
+            regex.append(f"(?P<{m.group(1)}>.+)" if m.group(2) else f"(?P<{m.group(1)}>[^/]+)")
+            pos = m.end()
+        regex.append(re.escape(template[pos:]))
+        self.pattern = re.compile(''.join(regex) + '$')
+
+    @property
+    def route_key(self):
+        return f"{self.method} {self.template}"
+
+    def match(self, method, path):
+        """匹配时返回路径参数 (dict)，否则返回 None。"""
+        if self.method != 'ANY' and self.method != method:
+            return None
+        m = self.pattern.match(path)
+        return m.groupdict() if m else None
+
+
+TABLE = [Route(*entry) for entry in ROUTES]
+
+
+def resolve(method, path):
+    """返回 (Route, 路径参数)；OPTIONS 预检按路径匹配任意方法的路由。未匹配时返回 (None, None)。"""
+    path = path.rstrip('/') or '/'
+    for route in TABLE:
+        params = route.match(route.method if method == 'OPTIONS' else method, path)
+        if params is not None:
+            return route, params
+    return None, None